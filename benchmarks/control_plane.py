@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+"""
+End-to-end benchmark of the control plane: real upgrade and recover sessions between two wirescale daemons on one machine.
+
+Each daemon is a separate process (the semaphores and the socket switching are process-wide) with its own mount namespace, so it
+gets a private /run, /etc/wirescale and /sys/class/net, and its own loopback address as Tailscale IP. tailscale, wg, wg-quick, ip,
+iptables, ss, systemctl and the rest are replaced by the stubs in fakebin.py, with configurable latencies, so the whole UnixServer ->
+TCPClient -> TCPServer flow runs offline. The report shows the wall time, the daemon CPU time and the external commands of every
+phase, on each side, as recorded by the daemons themselves. Every stub starts a Python interpreter, so wall times are inflated by a
+few tens of milliseconds per fork; the fork counts and the CPU time are the figures to compare between commits, and --max-forks turns
+them into a budget that fails the run. It needs unprivileged user namespaces (or root) and overlayfs. Run it from the repository root:
+
+    python -m benchmarks.control_plane --runs 10 --latency 'systemctl start=0.5' 'wg-quick=0.1' --max-forks upgrade=100 recover=100
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import re
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+from collections import Counter, deque
+from contextlib import suppress
+from ipaddress import IPv4Address
+from pathlib import Path
+from statistics import mean
+from threading import Event, Thread
+from time import monotonic, sleep
+from typing import Dict, List, Tuple
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+from wirescale.communications.commands import COMMANDS  # noqa: E402
+from wirescale.communications.messages import ActionCodes, MessageFields, UnixMessages  # noqa: E402
+
+DEADLOCK_RESOLVED = re.compile(r'Deadlock resolved: detected ([\d.]+) s .* ([\d.]+) s later')
+READY = 'fakebin-ready'
+PEERS = {'alice': '127.0.0.2', 'bob': '127.0.0.3'}
+STUBS = ('ip', 'iptables', 'iptables-restore', 'ping', 'ss', 'sysctl', 'systemctl', 'systemd-run', 'tailscale', 'wg', 'wg-quick', 'wirescale')
+
+
+def keypair() -> Tuple[str, str]:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+    from cryptography.hazmat.primitives.serialization import Encoding, NoEncryption, PrivateFormat, PublicFormat
+    private = X25519PrivateKey.generate()
+    private_raw = private.private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption())
+    return base64.b64encode(private_raw).decode(), base64.b64encode(private.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)).decode()
+
+
+def tunnel_address(peers: Dict[str, str], name: str) -> IPv4Address:
+    return IPv4Address('10.77.0.0') + list(peers).index(name) + 1
+
+
+def prepare(directory: Path, peers: Dict[str, str], latency: Dict[str, float]) -> Tuple[Path, Path, Path]:
+    bin_dir, world, log = directory.joinpath('bin'), directory.joinpath('world.json'), directory.joinpath('calls.jsonl')
+    bin_dir.mkdir()
+    for stub in STUBS:
+        path = bin_dir.joinpath(stub)
+        path.write_text(f'#!{sys.executable} -I\nimport sys\nsys.path.insert(0, {str(REPO)!r})\nfrom benchmarks.fakebin import main\nmain()\n')
+        path.chmod(0o755)
+    world.write_text(json.dumps({'peers': peers, 'latency': latency}))
+    log.touch()
+    return bin_dir, world, log
+
+
+def parse_latency(values: List[str]) -> Dict[str, float]:
+    return {name.strip(): float(seconds) for name, seconds in (value.rsplit('=', 1) for value in values)}
+
+
+def upgrade_message(peer: str) -> Dict:
+    return {MessageFields.CODE: ActionCodes.UPGRADE, MessageFields.ERROR_CODE: None, MessageFields.ALLOW_SUFFIX: None, MessageFields.EXPECTED_INTERFACE: None,
+            MessageFields.INTERFACE: peer, MessageFields.IPTABLES_ACCEPT: None, MessageFields.IPTABLES_FORWARD: None, MessageFields.IPTABLES_MASQUERADE: None,
+            MessageFields.PEER: peer, MessageFields.RECOVER_TRIES: None, MessageFields.RECREATE_TRIES: None, MessageFields.SUFFIX_NUMBER: None}
+
+
+def serve(name: str, directory: Path, watch_interval: float = None):
+    # Runs inside the mount namespace prepared by Daemon.start
+    from parallel_utils.thread import create_thread
+    from wirescale.communications.common import SHUTDOWN
+    from wirescale.communications.tcp_server import TCPServer
+    from wirescale.communications.unix_server import UnixServer
+    from wirescale.vpn.watch import ACTIVE_SOCKETS
+    logging.basicConfig(format='%(message)s', level=logging.ERROR)
+    Path('/run/wirescale/control').mkdir(parents=True, exist_ok=True)
+    Path('/run/wirescale/control/locker').touch()
+    if watch_interval is not None:
+        ACTIVE_SOCKETS.INTERVAL = watch_interval
+    unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    unix_socket.bind(str(directory.joinpath(f'{name}.sock')))
+    unix_socket.listen()
+    UnixServer.SOCKET = unix_socket
+    UnixServer.set_server()
+    TCPServer.set_server()
+    create_thread(TCPServer.run_server)
+    create_thread(UnixServer.run_server)
+    create_thread(ACTIVE_SOCKETS.watch)
+    print(READY, flush=True)
+    SHUTDOWN.wait()
+
+
+class Daemon:
+
+    def __init__(self, name: str, directory: Path, peers: Dict[str, str], keys: Dict[str, Tuple[str, str]], verbose: bool):
+        self.name = name
+        self.directory = directory
+        self.peers = peers
+        self.verbose = verbose
+        self.socket = directory.joinpath(f'{name}.sock')
+        self.state = directory.joinpath(f'{name}-state.json')
+        self.tail = deque(maxlen=40)
+        self.deadlocks: List[Tuple[float, float]] = []
+        self.ready = Event()
+        self.process: subprocess.Popen = None
+        self.write_config(keys)
+
+    def write_config(self, keys: Dict[str, Tuple[str, str]]):
+        directory = self.directory.joinpath(f'{self.name}-etc', 'wirescale')
+        directory.mkdir(parents=True)
+        for peer in self.peers:
+            if peer != self.name:
+                directory.joinpath(f'{peer}.conf').write_text(f'[Interface]\nPrivateKey = {keys[self.name][0]}\nAddress = {tunnel_address(self.peers, self.name)}\n\n'
+                                                              f'[Peer]\nPublicKey = {keys[peer][1]}\nAllowedIPs = {tunnel_address(self.peers, peer)}/32\n')
+
+    def start(self, bin_dir: Path, world: Path, log: Path, *options: str):
+        work = self.directory.joinpath(f'{self.name}-work')
+        work.mkdir()
+        mounts = (f'mount -t tmpfs tmpfs /run && mount -t tmpfs tmpfs /sys/class/net && '
+                  f'mount -t overlay overlay -o lowerdir=/etc,upperdir={self.directory.joinpath(f"{self.name}-etc")},workdir={work} /etc && '
+                  f'exec "$0" -m benchmarks.control_plane --serve {self.name} --directory {self.directory} {shlex.join(options)}')
+        env = {**os.environ, 'PATH': f'{bin_dir}:{os.environ["PATH"]}', 'PYTHONPATH': str(REPO), 'FAKEBIN_LOG': str(log), 'FAKEBIN_NAME': self.name,
+               'FAKEBIN_STATE': str(self.state), 'FAKEBIN_WORLD': str(world)}
+        command = ['unshare', '--map-root-user', '--mount', 'sh', '-c', mounts, sys.executable]
+        self.process = subprocess.Popen(command, cwd=REPO, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        Thread(target=self.read, daemon=True).start()
+
+    def read(self):
+        for line in self.process.stdout:
+            line = line.rstrip('\n')
+            if line == READY:
+                self.ready.set()
+            elif deadlock := DEADLOCK_RESOLVED.search(line):
+                self.deadlocks.append((float(deadlock[1]), float(deadlock[2])))
+            self.tail.append(line)
+            if self.verbose:
+                print(f'[{self.name}] {line}', flush=True)
+
+    def wait_ready(self, timeout: float = 30):
+        if not self.ready.wait(timeout) or self.process.poll() is not None:
+            self.fail('did not start')
+
+    def fail(self, reason: str):
+        sleep(0.5)
+        print(f"Daemon '{self.name}' {reason}. Last lines of its output:", file=sys.stderr)
+        print('\n'.join(self.tail), file=sys.stderr, flush=True)
+        sys.exit(1)
+
+    def request(self, message: dict, timeout: float = None) -> Tuple[bool, float, str]:
+        from websockets.exceptions import ConnectionClosed
+        from websockets.sync.client import unix_connect
+        start = monotonic()
+        with unix_connect(str(self.socket)) as websocket, suppress(ConnectionClosed):
+            websocket.send(json.dumps(message))
+            while True:
+                try:
+                    reply = json.loads(websocket.recv(timeout=None if timeout is None else max(0, start + timeout - monotonic())))
+                except TimeoutError:
+                    return False, monotonic() - start, f'No answer after {timeout:g} seconds'
+                if reply[MessageFields.ERROR_CODE]:
+                    return False, monotonic() - start, reply[MessageFields.ERROR_MESSAGE]
+                if reply[MessageFields.CODE] == ActionCodes.SUCCESS:
+                    return True, monotonic() - start, reply[MessageFields.MESSAGE]
+        return False, monotonic() - start, 'The daemon closed the connection'
+
+    def sessions(self) -> List[dict]:
+        from websockets.sync.client import unix_connect
+        with unix_connect(str(self.socket)) as websocket:
+            websocket.send(json.dumps(UnixMessages.STATS_MESSAGE))
+            return json.loads(websocket.recv())[MessageFields.SESSIONS]
+
+    def recover_message(self, peer: str) -> Dict:
+        from benchmarks.fakebin import handshake
+        latest_handshake = handshake(json.loads(self.state.read_text())[peer])
+        return {MessageFields.CODE: ActionCodes.RECOVER, MessageFields.ERROR_CODE: None, MessageFields.INTERFACE: peer, MessageFields.LATEST_HANDSHAKE: latest_handshake,
+                MessageFields.PEER_IP: self.peers[peer]}
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait(timeout=10)
+
+
+def wait_sessions(daemons: List[Daemon], count: int, timeout: float = 60):
+    deadline = monotonic() + timeout
+    while any(len(daemon.sessions()) < count for daemon in daemons):
+        if monotonic() > deadline:
+            daemons[0].fail(f'has not finished session number {count} after {timeout} seconds')
+        sleep(0.05)
+
+
+def percentile(values: List[float], percent: int) -> float:
+    values = sorted(values)
+    return values[max(0, -(-len(values) * percent // 100) - 1)]
+
+
+def report(daemons: List[Daemon], wall: Dict[str, List[float]], log: Path) -> Dict:
+    rows: Dict[Tuple[str, str, str], Dict[str, list]] = {}
+    forks_per_session: Dict[str, Counter] = {}
+    in_sessions = 0
+    for daemon in daemons:
+        for session in daemon.sessions():
+            kind, side = session['kind'], session['side']
+            for phase, seconds in session['spans'].items():
+                row = rows.setdefault((kind, side, phase), {'wall': [], 'cpu': [], 'forks': []})
+                row['wall'].append(seconds * 1000)
+                row['cpu'].append((sum(session['cpu'].values()) if phase == 'total' else session['cpu'].get(phase, 0)) * 1000)
+                row['forks'].append(COMMANDS.forks(session['commands'], phase=None if phase == 'total' else phase)[0])
+            forks_per_session.setdefault(kind, Counter())[session['id']] += len(session['commands'])
+            in_sessions += len(session['commands'])
+    print(f"{'kind':<9}{'side':<11}{'phase':<24}{'p50 ms':>10}{'p90 ms':>10}{'cpu ms':>10}{'forks':>8}")
+    for (kind, side, phase), row in sorted(rows.items(), key=lambda item: (item[0][0], item[0][1], item[0][2] == 'total')):
+        print(f"{kind:<9}{side:<11}{phase:<24}{percentile(row['wall'], 50):>10.1f}{percentile(row['wall'], 90):>10.1f}{mean(row['cpu']):>10.1f}{mean(row['forks']):>8.1f}")
+    print()
+    summary = {}
+    for kind, times in wall.items():
+        forks = mean(forks_per_session.get(kind, {0: 0}).values())
+        summary[kind] = {'p50_ms': percentile(times, 50) * 1000, 'p90_ms': percentile(times, 90) * 1000, 'forks': forks}
+        print(f"{kind.capitalize()} as seen by the CLI: p50 {summary[kind]['p50_ms']:.1f} ms, p90 {summary[kind]['p90_ms']:.1f} ms, {forks:.1f} forks per session on both sides")
+    stub_calls = [json.loads(line) for line in log.read_text().splitlines()]
+    background = len(stub_calls) - in_sessions
+    print(f'Forks outside of any session: {background}. Stub calls in total: {len(stub_calls)}')
+    return {'phases': {' '.join(key): {name: values for name, values in row.items()} for key, row in rows.items()}, 'summary': summary, 'calls': stub_calls}
+
+
+def parse_budgets(values: List[str]) -> Dict[str, float]:
+    return {kind: float(limit) for kind, limit in (value.split('=', 1) for value in values)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure full upgrade and recover sessions between two local daemons with stubbed system binaries')
+    parser.add_argument('--runs', type=int, default=5, help='upgrade and recover sessions to run')
+    parser.add_argument('--latency', nargs='*', default=[], metavar="'COMMAND[ SUBCOMMAND]=SECONDS'",
+                        help="extra latency of a stub, e.g. 'systemctl start=0.5' or 'wg-quick=0.1'. 'handshake' delays the first handshake after setting an endpoint")
+    parser.add_argument('--max-forks', nargs='*', default=[], metavar='KIND=N', help='fail if a kind of session (upgrade, recover) runs more forks on average')
+    parser.add_argument('--json', type=Path, help='write every measurement and stub call to this file')
+    parser.add_argument('--verbose', action='store_true', help='print the output of both daemons')
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    parser.add_argument('--directory', type=Path, help=argparse.SUPPRESS)
+    parser.add_argument('--watch-interval', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        return serve(args.serve, args.directory, watch_interval=args.watch_interval)
+    directory = Path(tempfile.mkdtemp(prefix='wirescale-bench-'))
+    bin_dir, world, log = prepare(directory, PEERS, parse_latency(args.latency))
+    keys = {name: keypair() for name in PEERS}
+    daemons = [Daemon(name, directory, PEERS, keys, args.verbose) for name in PEERS]
+    alice = daemons[0]
+    wall: Dict[str, List[float]] = {'upgrade': [], 'recover': []}
+    try:
+        for daemon in daemons:
+            daemon.start(bin_dir, world, log)
+        for daemon in daemons:
+            daemon.wait_ready()
+        for run in range(args.runs):
+            for kind in wall:
+                message = upgrade_message('bob') if kind == 'upgrade' else alice.recover_message('bob')
+                ok, seconds, text = alice.request(message)
+                if not ok:
+                    alice.fail(f'could not finish {kind} number {run + 1}: {text}')
+                wall[kind].append(seconds)
+                wait_sessions(daemons, count=len(wall['upgrade']) + len(wall['recover']))
+            print(f'Run {run + 1}/{args.runs}: upgrade {wall["upgrade"][-1] * 1000:.0f} ms, recover {wall["recover"][-1] * 1000:.0f} ms', flush=True)
+        print()
+        results = report(daemons, wall, log)
+    finally:
+        for daemon in daemons:
+            daemon.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=2))
+    exceeded = [f"{kind}: {results['summary'][kind]['forks']:.1f} forks, budget {limit:g}" for kind, limit in parse_budgets(args.max_forks).items()
+                if results['summary'].get(kind, {}).get('forks', 0) > limit]
+    if exceeded:
+        print('Over budget: ' + '; '.join(exceeded), file=sys.stderr, flush=True)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
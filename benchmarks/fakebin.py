@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+"""
+Stand-ins for tailscale, wg, wg-quick, ip, iptables, ss, systemctl and the other binaries wirescale runs.
+
+The harness in control_plane.py puts one small launcher per binary on PATH, each calling main() with the name it was run as. All of
+them share the world description in $FAKEBIN_WORLD (the peers of the fake tailnet, plus the latency and output overrides) and keep
+the WireGuard interfaces of each daemon in $FAKEBIN_STATE, so `wg show` reports what `wg-quick up` and `wg set` did. `wg-quick` also
+adds and removes the interface in /sys/class/net, which the harness mounts as a tmpfs. Every call is appended to $FAKEBIN_LOG.
+
+Latencies are looked up by the most specific key first, e.g. 'tailscale ping', then 'tailscale'. The 'handshake' latency is the time
+between setting an endpoint and the first handshake that `wg show latest-handshakes` reports. Outputs can be replaced with
+{"outputs": {"tailscale status": {"stdout": "...", "returncode": 0}}}.
+"""
+
+import base64
+import fcntl
+import json
+import os
+import re
+import resource
+import sys
+from configparser import ConfigParser
+from contextlib import contextmanager, suppress
+from pathlib import Path
+from time import monotonic, sleep, time
+
+DEFAULT_LATENCY = {
+    'handshake': 0.05,
+    'systemctl start': 0.2,
+    'systemctl stop': 0.05,
+    'tailscale ping': 0.02,
+    'wg-quick': 0.03,
+}
+
+
+def world() -> dict:
+    return json.loads(Path(os.environ['FAKEBIN_WORLD']).read_text())
+
+
+def key(argv: list) -> list:
+    name = Path(argv[0]).name
+    words = [arg for arg in argv[1:] if not arg.startswith('-')]
+    return [f'{name} {words[0]}', name] if words else [name]
+
+
+def lookup(table: dict, argv: list):
+    return next((table[k] for k in key(argv) if k in table), None)
+
+
+@contextmanager
+def state():
+    path = Path(os.environ['FAKEBIN_STATE'])
+    with open(path.with_suffix('.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        data = json.loads(path.read_text()) if path.exists() else {}
+        yield data
+        path.write_text(json.dumps(data))
+
+
+def keypair_public(private: str) -> str:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+    raw = X25519PrivateKey.from_private_bytes(base64.b64decode(private)).public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+    return base64.b64encode(raw).decode()
+
+
+def handshake(interface: dict) -> int:
+    return interface['handshake'] if time() >= interface.get('handshake_at', 0) else interface.get('previous', 0)
+
+
+def tailscale(args: list, peers: dict, me: str) -> int:
+    suffix = 'bench.ts.net'
+
+    def node(name: str) -> dict:
+        return {'DNSName': f'{name}.{suffix}', 'HostName': name, 'TailscaleIPs': [peers[name]], 'Online': True}
+
+    def find(ip_or_name: str) -> str:
+        return next((name for name, ip in peers.items() if ip_or_name in (ip, name, f'{name}.{suffix}')), None)
+
+    match args:
+        case ['status', *_]:
+            status = {'BackendState': 'Running', 'MagicDNSSuffix': suffix, 'Self': node(me), 'Peer': {f'nodekey:{name}': node(name) for name in peers if name != me}}
+            print(json.dumps(status))
+        case ['ip', '-4']:
+            print(peers[me])
+        case ['ip', '-4', name]:
+            if (name := find(name)) is None:
+                return 1
+            print(peers[name])
+        case ['whois', '--json', ip]:
+            if (name := find(ip)) is None:
+                return 1
+            print(json.dumps({'Node': {'Key': f'nodekey:{name}'}}))
+        case ['ping', *_, ip]:
+            if (name := find(ip)) is None:
+                return 1
+            print(f'pong from {name} ({peers[name]}) via {peers[name]}:41641 in 1ms')
+    return 0
+
+
+def wg(args: list) -> int:
+    match args:
+        case ['genkey']:
+            print(base64.b64encode(os.urandom(32)).decode())
+        case ['genpsk']:
+            print(base64.b64encode(os.urandom(32)).decode())
+        case ['pubkey']:
+            try:
+                print(keypair_public(sys.stdin.read().strip()))
+            except Exception:
+                print('wg: Key is not the correct length or format', file=sys.stderr)
+                return 1
+        case ['set', name, *options]:
+            with state() as interfaces:
+                if (interface := interfaces.get(name)) is None:
+                    return 1
+                options = dict(zip(options[::2], options[1::2]))
+                interface['port'] = int(options.get('listen-port', interface['port']))
+                if 'endpoint' in options:
+                    schedule(interface)
+        case ['show', 'all', 'dump']:
+            with state() as interfaces:
+                for name, interface in interfaces.items():
+                    print('\t'.join((name, interface['private'], keypair_public(interface['private']), str(interface['port']), 'off')))
+                    print('\t'.join((name, interface['peer'], interface['psk'], '(none)', '0.0.0.0/0', str(handshake(interface)), str(interface['rx']), str(interface['tx']), 'off')))
+        case ['show', 'all', 'fwmark']:
+            with state() as interfaces:
+                for name, interface in interfaces.items():
+                    print(f"{name}\t{interface.get('fwmark') or 'off'}")
+        case ['show', 'all', 'transfer']:
+            with state() as interfaces:
+                for name, interface in interfaces.items():
+                    print('\t'.join((name, interface['peer'], str(interface['rx']), str(interface['tx']))))
+        case ['show', name, field]:
+            with state() as interfaces:
+                if (interface := interfaces.get(name)) is None:
+                    print('Unable to access interface: No such device', file=sys.stderr)
+                    return 1
+                match field:
+                    case 'listen-port':
+                        print(interface['port'])
+                    case 'private-key':
+                        print(interface['private'])
+                    case 'preshared-keys':
+                        print(f"{interface['peer']}\t{interface['psk']}")
+                    case 'latest-handshakes':
+                        print(f"{interface['peer']}\t{handshake(interface)}")
+                    case 'transfer':
+                        print(f"{interface['peer']}\t{interface['rx']}\t{interface['tx']}")
+    return 0
+
+
+def schedule(interface: dict):
+    latency = world().get('latency', {})
+    interface['previous'] = handshake(interface)
+    interface['handshake'] = max(int(time()), interface['previous'] + 1)
+    interface['handshake_at'] = time() + latency.get('handshake', DEFAULT_LATENCY['handshake'])
+    interface['rx'] += 92
+    interface['tx'] += 148
+
+
+def wg_quick(args: list) -> int:
+    action, path = args
+    name = Path(path).stem
+    with state() as interfaces:
+        if action == 'down':
+            with suppress(FileNotFoundError):
+                Path('/sys/class/net', name).rmdir()
+            return 0 if interfaces.pop(name, None) is not None else 1
+        config = ConfigParser(interpolation=None, strict=False)
+        config.read_string(re.sub(r'^\s*(PostUp|PostDown|PreUp|PreDown)\s*=.*$', '', Path(path).read_text(), flags=re.IGNORECASE | re.MULTILINE))
+        interface = {
+            'private': config.get('Interface', 'PrivateKey'),
+            'port': config.getint('Interface', 'ListenPort', fallback=51820),
+            'peer': config.get('Peer', 'PublicKey'),
+            'psk': config.get('Peer', 'PresharedKey', fallback='(none)'),
+            'handshake': 0,
+            'rx': 0,
+            'tx': 0,
+        }
+        if config.has_option('Peer', 'Endpoint'):
+            schedule(interface)
+        interfaces[name] = interface
+        Path('/sys/class/net', name).mkdir(exist_ok=True)
+        print(f'[#] ip link add {name} type wireguard', file=sys.stderr)
+    return 0
+
+
+def run(argv: list) -> int:
+    data = world()
+    if (output := lookup(data.get('outputs', {}), argv)) is not None:
+        print(output.get('stdout', ''), end='')
+        return output.get('returncode', 0)
+    name, args = Path(argv[0]).name, argv[1:]
+    match name:
+        case 'tailscale':
+            return tailscale(args, data['peers'], os.environ['FAKEBIN_NAME'])
+        case 'wg':
+            return wg(args)
+        case 'wg-quick':
+            return wg_quick(args)
+        case 'ss':
+            print('UNCONN 0      0          0.0.0.0:41641      0.0.0.0:*    users:(("tailscaled",pid=1,fd=14))')
+        case 'systemctl':
+            if args[:1] == ['is-active']:
+                return 0 if args[1].startswith('tailscaled') else 3
+            if args[:1] == ['show']:
+                print('MainPID=0' if 'MainPID' in args else '')
+    return 0
+
+
+def main():
+    start, wall = monotonic(), time()
+    latency = lookup({**DEFAULT_LATENCY, **world().get('latency', {})}, sys.argv)
+    if latency:
+        sleep(latency)
+    returncode = run(sys.argv)
+    sys.stdout.flush()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    entry = {'daemon': os.environ['FAKEBIN_NAME'], 'argv': [Path(sys.argv[0]).name, *sys.argv[1:]], 'time': wall, 'seconds': monotonic() - start,
+             'cpu': usage.ru_utime + usage.ru_stime, 'returncode': returncode}
+    with open(os.environ['FAKEBIN_LOG'], 'a') as log:
+        log.write(json.dumps(entry) + '\n')
+    sys.exit(returncode)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+"""
+Compares the regular upgrade handshake against the fast path over a simulated high-RTT link.
+
+Both daemons are replaced by websocket endpoints that follow the same message flights as TCPClient and TCPServer, and every byte
+between them goes through a relay that delays each direction by half the RTT. Run it from the repository root:
+
+    python -m benchmarks.handshake_rtt --rtt 20 100 300 --runs 5
+"""
+
+import argparse
+import json
+import socket
+from queue import Queue
+from statistics import median
+from threading import Thread
+from time import monotonic, sleep
+
+from websockets.sync.client import connect
+from websockets.sync.server import serve, ServerConnection
+
+from wirescale.communications.messages import ActionCodes, MessageFields
+
+UPGRADE_FIELDS = {
+    MessageFields.ERROR_CODE: None,
+    MessageFields.ADDRESSES: ['192.168.50.1'],
+    MessageFields.EXPECTED_INTERFACE: None,
+    MessageFields.HAS_PSK: True,
+    MessageFields.INTERFACE: 'bob',
+    MessageFields.PORT: 51820,
+    MessageFields.PSK: None,
+    MessageFields.PUBLIC_IP: '203.0.113.7',
+    MessageFields.EXPOSED_PORT: 41641,
+    MessageFields.PUBKEY: 'x' * 44,
+    MessageFields.REMOTE_PUBKEY: 'y' * 44,
+}
+
+
+class DelayRelay:
+    def __init__(self, target_port: int, one_way: float):
+        self.target_port = target_port
+        self.one_way = one_way
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            client, _ = self.listener.accept()
+            server = socket.create_connection(('127.0.0.1', self.target_port))
+            for src, dst in ((client, server), (server, client)):
+                queue = Queue()
+                Thread(target=self.read, args=(src, queue), daemon=True).start()
+                Thread(target=self.write, args=(dst, queue), daemon=True).start()
+
+    def read(self, src: socket.socket, queue: Queue):
+        while data := src.recv(65536):
+            queue.put((monotonic() + self.one_way, data))
+        queue.put((monotonic() + self.one_way, b''))
+
+    @staticmethod
+    def write(dst: socket.socket, queue: Queue):
+        while True:
+            deadline, data = queue.get()
+            if (wait := deadline - monotonic()) > 0:
+                sleep(wait)
+            if not data:
+                dst.shutdown(socket.SHUT_WR)
+                return
+            dst.sendall(data)
+
+
+def response():
+    return json.dumps({MessageFields.CODE: ActionCodes.UPGRADE_RESPONSE, **UPGRADE_FIELDS, MessageFields.NAT: False, MessageFields.START_TIME: 0})
+
+
+def handler(websocket: ServerConnection):
+    first = json.loads(websocket.recv())
+    if first[MessageFields.CODE] == ActionCodes.FAST_UPGRADE:
+        websocket.send(response())
+    for message in websocket:
+        match json.loads(message)[MessageFields.CODE]:
+            case ActionCodes.HELLO if first[MessageFields.CODE] != ActionCodes.FAST_UPGRADE:
+                websocket.send(json.dumps({MessageFields.CODE: ActionCodes.ACK, MessageFields.ERROR_CODE: None}))
+            case ActionCodes.UPGRADE:
+                websocket.send(response())
+
+
+def run_client(port: int, fast: bool) -> float:
+    start = monotonic()
+    with connect(f'ws://127.0.0.1:{port}') as websocket:
+        if fast:
+            websocket.send(json.dumps({MessageFields.CODE: ActionCodes.FAST_UPGRADE, **UPGRADE_FIELDS, MessageFields.TOKEN: 'token', MessageFields.VERSION: '0'}))
+        else:
+            websocket.send(json.dumps({MessageFields.CODE: ActionCodes.TOKEN, MessageFields.ERROR_CODE: None, MessageFields.TOKEN: 'token', MessageFields.VERSION: '0'}))
+        websocket.send(json.dumps({MessageFields.CODE: ActionCodes.HELLO, MessageFields.ERROR_CODE: None}))
+        for message in websocket:
+            match json.loads(message)[MessageFields.CODE]:
+                case ActionCodes.ACK:
+                    websocket.send(json.dumps({MessageFields.CODE: ActionCodes.UPGRADE, **UPGRADE_FIELDS}))
+                case ActionCodes.UPGRADE_RESPONSE:
+                    websocket.send(json.dumps({MessageFields.CODE: ActionCodes.GO, MessageFields.ERROR_CODE: None, MessageFields.NAT: False}))
+                    websocket.ping().wait(timeout=30)
+                    break
+    return monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the latency saved by the fast path upgrade handshake')
+    parser.add_argument('--rtt', type=float, nargs='+', default=[20, 100, 300], help='simulated round trip times, in milliseconds')
+    parser.add_argument('--runs', type=int, default=5, help='handshakes per flow and RTT')
+    args = parser.parse_args()
+    with serve(handler, '127.0.0.1', 0) as server:
+        Thread(target=server.serve_forever, daemon=True).start()
+        print(f"{'RTT (ms)':>10}{'regular (ms)':>15}{'fast path (ms)':>17}{'saved (ms)':>13}")
+        for rtt in args.rtt:
+            relay = DelayRelay(target_port=server.socket.getsockname()[1], one_way=rtt / 2000)
+            regular = median(run_client(relay.port, fast=False) for _ in range(args.runs)) * 1000
+            fast = median(run_client(relay.port, fast=True) for _ in range(args.runs)) * 1000
+            print(f'{rtt:>10.0f}{regular:>15.1f}{fast:>17.1f}{regular - fast:>13.1f}')
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+"""
+Import-time budget for the wirescale CLI.
+
+Every command below is launched in a fresh interpreter with `-X importtime`. The script fails if a command pulls in a module it
+should not need, or if its total import time goes over budget. Hook-driven commands like `exit-node --status` and `exit-node --sync`
+fork once per event, so they are kept well away from websockets, cryptography and netifaces.
+
+Commands run their real code path, not only their --help, in a private mount namespace like the one control_plane.py gives its
+daemons: /run and /sys/class/net are tmpfs holding a wg0 interface, its config file and an exit node state, and wg, wg-quick, ip,
+systemctl and the rest are the stubs in fakebin.py. There is no daemon listening, so `stats`, `bench`, `recover` and `upgrade` stop
+right after importing what they need to reach it. Only imports are timed, so the stubs do not count. The budgets are about twice the
+slowest of several medians measured on a loaded machine, so that noise alone never fails the run. It needs unprivileged user
+namespaces (or root). Run it from the repository root:
+
+    python -m benchmarks.import_time --runs 5
+
+tests/test_import_time.py runs the same checks with pytest, and skips them where namespaces are not available.
+"""
+
+import argparse
+import json
+import re
+import shlex
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from statistics import median
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+from benchmarks.control_plane import keypair, prepare  # noqa: E402
+
+HEAVY = ('cryptography', 'netifaces', 'parallel_utils', 'websockets')
+HOOK = ('cryptography', 'netifaces', 'websockets')
+CLIENT = ()
+LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+INTERFACE = 'wg0'
+PEER = 'bench'
+
+# argv, budget in ms, modules that must not be imported
+COMMANDS = (
+    (('--version',), 150, HEAVY),
+    (('--help',), 150, HEAVY),
+    (('daemon', '--help'), 150, HEAVY),
+    (('down', '--help'), 150, HEAVY),
+    (('down', INTERFACE), 150, HEAVY),
+    (('exit-node', '--help'), 150, HEAVY),
+    (('exit-node', '--status'), 200, HOOK),
+    (('exit-node', '--sync'), 200, HOOK),
+    (('exit-node', '--sync', INTERFACE), 200, HOOK),
+    (('recover', '--help'), 150, HEAVY),
+    (('recover', INTERFACE), 500, CLIENT),
+    (('stats', '--help'), 150, HEAVY),
+    (('stats',), 500, CLIENT),
+    (('bench', '--help'), 150, HEAVY),
+    (('bench', INTERFACE), 500, CLIENT),
+    (('upgrade', '--help'), 150, HEAVY),
+    (('upgrade', PEER), 500, CLIENT),
+)
+
+
+class Environment:
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        bin_dir, world, log = prepare(directory, peers={PEER: '127.0.0.1'}, latency={})
+        world.write_text(json.dumps({**json.loads(world.read_text()), 'outputs': {'systemctl is-active': {'returncode': 0}}}))  # For the autoremove unit of `recover`
+        self.state = directory.joinpath('state.json')
+        exit_node = directory.joinpath('exit-node')
+        exit_node.write_text(json.dumps({'exit-node': INTERFACE, 'members': {INTERFACE: 1}, 'nodes': {}, 'add-allowedips': [], 'marks': {}, 'baseline': {}}))
+        private, peer = keypair()
+        self.interface = {'private': private, 'port': 51820, 'peer': peer, 'psk': '(none)', 'fwmark': '0xca6c', 'handshake': 0, 'rx': 0, 'tx': 0}
+        self.env = {'PATH': f'{bin_dir}:/usr/sbin:/usr/bin:/sbin:/bin', 'PYTHONPATH': str(REPO), 'FAKEBIN_LOG': str(log), 'FAKEBIN_NAME': 'bench',
+                    'FAKEBIN_STATE': str(self.state), 'FAKEBIN_WORLD': str(world)}
+        self.setup = (f'mount -t tmpfs tmpfs /run && mount -t tmpfs tmpfs /sys/class/net && '
+                      f'mkdir -p /run/wirescale/control /sys/class/net/{INTERFACE} && touch /run/wirescale/{INTERFACE}.conf && '
+                      f'cp {shlex.quote(str(exit_node))} /run/wirescale/control/exit-node && exec "$0" "$@"')
+
+    def measure(self, argv) -> tuple[float, set[str]]:
+        self.state.write_text(json.dumps({INTERFACE: self.interface}))  # `down` takes it away
+        command = ['unshare', '--map-root-user', '--mount', 'sh', '-c', self.setup, sys.executable, '-X', 'importtime', '-m', 'wirescale', *argv]
+        process = subprocess.run(command, cwd=REPO, env=self.env, stdin=subprocess.DEVNULL, capture_output=True, text=True)
+        total, modules = 0, set()
+        for line in process.stderr.splitlines():
+            if match := LINE.match(line):
+                modules.add(match.group(4))
+                if not match.group(3):
+                    total += int(match.group(2))
+        if not modules:
+            raise RuntimeError(f"'{shlex.join(argv)}' did not report its imports: {process.stderr.strip()}")
+        return total / 1000, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time budget of every wirescale subcommand')
+    parser.add_argument('--runs', type=int, default=5, help='interpreter launches per command; the median is compared against the budget')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply every budget by this factor on slow machines')
+    args = parser.parse_args()
+    failures = 0
+    print(f"{'command':<28}{'import (ms)':>13}{'budget (ms)':>13}  forbidden modules")
+    with tempfile.TemporaryDirectory(prefix='wirescale-import-') as directory:
+        environment = Environment(Path(directory))
+        for argv, budget, forbidden in COMMANDS:
+            results = [environment.measure(argv) for _ in range(args.runs)]
+            elapsed = median(total for total, _ in results)
+            loaded = sorted(name for name in forbidden if any(name in modules for _, modules in results))
+            over = elapsed > budget * args.scale
+            failures += over or bool(loaded)
+            print(f"{' '.join(argv):<28}{elapsed:>13.1f}{budget * args.scale:>13.1f}  {', '.join(loaded) or '-'}{'  OVER BUDGET' if over else ''}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+"""
+Load generator for a fake tailnet: many wirescale daemons on one machine, hammered with concurrent upgrades and recovers.
+
+Every node is a real daemon started like in control_plane.py: its own mount namespace, a loopback address as Tailscale IP and the
+stubbed binaries from fakebin.py. A pool of workers sends requests through the UNIX socket of each initiator, following a
+configurable mix. Recovers target tunnels set up earlier in the run. --hotspot sends a share of the upgrades to the first node, so
+its SERVER and EXCLUSIVE semaphores fill up. --crossed issues a share of them in both directions at once (A to B and B to A), the
+case that ActiveSockets has to untangle. The deadlock switch polls every 15 seconds, which --watch-interval can change. Beware that
+with an interval shorter than a switched session, the lower IP of a crossed pair also switches on its second poll and both sessions
+hang until --timeout; the report shows them as failures.
+
+The report shows throughput, failure rates and CLI latency per kind of request, the queueing delay recorded by the daemons on each
+side and the deadlock detection and resolution times. Every stub starts a Python interpreter, so keep an eye on the CPU of the host
+when running large tailnets. Run it from the repository root:
+
+    python -m benchmarks.tailnet --peers 50 --requests 500 --concurrency 25 --mix upgrade=3 recover=1 --crossed 0.2 --hotspot 0.3
+"""
+
+import argparse
+import json
+import re
+import shutil
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import IPv4Address
+from pathlib import Path
+from random import Random
+from threading import Lock, Thread
+from time import monotonic
+from typing import Dict, List, Set, Tuple
+
+from benchmarks.control_plane import Daemon, keypair, parse_latency, percentile, prepare, upgrade_message
+
+
+def tailnet(count: int) -> Dict[str, str]:
+    return {f'node{index:02d}': str(IPv4Address('127.0.1.1') + index) for index in range(count)}
+
+
+class Load:
+
+    def __init__(self, daemons: Dict[str, Daemon], mix: Dict[str, float], crossed: float, hotspot: float, requests: int, timeout: float, seed: int):
+        self.daemons = daemons
+        self.timeout = timeout
+        self.names = list(daemons)
+        self.mix = mix
+        self.crossed = crossed
+        self.hotspot = hotspot
+        self.pending = requests
+        self.random = Random(seed)
+        self.tunnels: Set[Tuple[str, str]] = set()
+        self.results: List[Dict] = []
+        self.lock = Lock()
+
+    def pick(self) -> List[Tuple[str, str, str]]:
+        with self.lock:
+            if self.pending <= 0:
+                return []
+            kind = self.random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+            if kind == 'recover' and self.tunnels:
+                self.pending -= 1
+                return [('recover', *self.random.choice(sorted(self.tunnels)))]
+            target = self.names[0] if self.random.random() < self.hotspot else self.random.choice(self.names)
+            initiator = self.random.choice([name for name in self.names if name != target])
+            if self.pending > 1 and self.random.random() < self.crossed:
+                self.pending -= 2
+                return [('upgrade', initiator, target), ('upgrade', target, initiator)]
+            self.pending -= 1
+            return [('upgrade', initiator, target)]
+
+    def issue(self, kind: str, initiator: str, target: str):
+        daemon = self.daemons[initiator]
+        start = monotonic()
+        try:
+            message = upgrade_message(target) if kind == 'upgrade' else daemon.recover_message(target)
+            ok, seconds, text = daemon.request(message, timeout=self.timeout)
+        except Exception as error:
+            ok, seconds, text = False, monotonic() - start, f'{type(error).__name__}: {error}'
+        with self.lock:
+            if ok and kind == 'upgrade':
+                self.tunnels.update(((initiator, target), (target, initiator)))
+            self.results.append({'kind': kind, 'initiator': initiator, 'target': target, 'ok': ok, 'seconds': seconds, 'message': text})
+            print(f"{len(self.results):>5} {kind} {initiator} -> {target}: {'ok' if ok else 'failed'} in {seconds * 1000:.0f} ms", flush=True)
+
+    def worker(self):
+        while batch := self.pick():
+            threads = [Thread(target=self.issue, args=request) for request in batch]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+
+def report(load: Load, daemons: List[Daemon], seconds: float, workers: int) -> Dict:
+    results = load.results
+    succeeded = sum(result['ok'] for result in results)
+    print(f'{len(daemons)} daemons, {len(results)} requests in {seconds:.1f} s with {workers} workers: {succeeded / seconds:.2f} successful sessions per second')
+    print()
+    print(f"{'kind':<10}{'requests':>9}{'failed':>8}{'failed %':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    summary = {}
+    for kind in sorted({result['kind'] for result in results}):
+        group = [result for result in results if result['kind'] == kind]
+        times = sorted(result['seconds'] * 1000 for result in group if result['ok']) or [0]
+        failed = sum(not result['ok'] for result in group)
+        summary[kind] = {'requests': len(group), 'failed': failed, **{f'p{percent}_ms': percentile(times, percent) for percent in (50, 90, 99)}, 'max_ms': times[-1]}
+        print(f"{kind:<10}{len(group):>9}{failed:>8}{failed / len(group) * 100:>10.1f}" + ''.join(f"{summary[kind][f'p{percent}_ms']:>10.1f}" for percent in (50, 90, 99)) + f'{times[-1]:>10.1f}')
+    errors = Counter(re.sub(r'^\w{6} - ', '', result['message']) for result in results if not result['ok'])
+    if errors:
+        print()
+        print('Most common errors:')
+        for text, count in errors.most_common(5):
+            print(f'{count:>6}  {text}')
+    print()
+    queues: Dict[str, List[float]] = {}
+    for daemon in daemons:
+        for session in daemon.sessions():
+            queues.setdefault(session['side'], []).append(session['spans'].get('queue', 0) * 1000)
+    print('Queueing delay recorded by the daemons:')
+    print(f"{'side':<12}{'sessions':>9}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for side, values in sorted(queues.items()):
+        values.sort()
+        print(f'{side:<12}{len(values):>9}' + ''.join(f'{percentile(values, percent):>10.1f}' for percent in (50, 90, 99)) + f'{values[-1]:>10.1f}')
+    print()
+    deadlocks = [deadlock for daemon in daemons for deadlock in daemon.deadlocks]
+    if deadlocks:
+        detection, resolution = sorted(deadlock[0] for deadlock in deadlocks), sorted(deadlock[1] for deadlock in deadlocks)
+        print(f'Deadlocks resolved: {len(deadlocks)}. Detected after p50 {percentile(detection, 50):.1f} s (max {detection[-1]:.1f} s), '
+              f'semaphore back after p50 {percentile(resolution, 50):.1f} s (max {resolution[-1]:.1f} s)')
+    else:
+        print('Deadlocks resolved: 0')
+    return {'summary': summary, 'errors': dict(errors), 'queues': queues, 'deadlocks': deadlocks, 'requests': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run many local wirescale daemons with stubbed system binaries and load them with concurrent requests')
+    parser.add_argument('--peers', type=int, default=10, help='daemons in the fake tailnet')
+    parser.add_argument('--requests', type=int, default=100, help='requests to send in total')
+    parser.add_argument('--concurrency', type=int, default=5, help='requests in flight at the same time (crossed pairs count once)')
+    parser.add_argument('--mix', nargs='*', default=['upgrade=3', 'recover=1'], metavar='KIND=WEIGHT', help='relative weight of upgrades and recovers')
+    parser.add_argument('--crossed', type=float, default=0.1, help='share of upgrades sent in both directions at once')
+    parser.add_argument('--hotspot', type=float, default=0, help='share of upgrades aimed at the first node')
+    parser.add_argument('--watch-interval', type=float, help='seconds between deadlock checks in the daemons (15 in production)')
+    parser.add_argument('--latency', nargs='*', default=[], metavar="'COMMAND[ SUBCOMMAND]=SECONDS'", help='extra latency of a stub, as in control_plane.py')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds after which a request counts as failed')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the request mix')
+    parser.add_argument('--json', type=Path, help='write every request and measurement to this file')
+    parser.add_argument('--verbose', action='store_true', help='print the output of every daemon')
+    args = parser.parse_args()
+    mix = {kind: float(weight) for kind, weight in (value.split('=', 1) for value in args.mix)}
+    if args.peers < 2 or not set(mix) <= {'upgrade', 'recover'}:
+        parser.error('a tailnet needs at least two peers, and the mix can only contain upgrade and recover')
+    peers = tailnet(args.peers)
+    directory = Path(tempfile.mkdtemp(prefix='wirescale-tailnet-'))
+    bin_dir, world, log = prepare(directory, peers, parse_latency(args.latency))
+    keys = {name: keypair() for name in peers}
+    daemons = {name: Daemon(name, directory, peers, keys, args.verbose) for name in peers}
+    options = ('--watch-interval', str(args.watch_interval)) if args.watch_interval is not None else ()
+    try:
+        for daemon in daemons.values():
+            daemon.start(bin_dir, world, log, *options)
+        for daemon in daemons.values():
+            daemon.wait_ready(timeout=30 + args.peers)
+        load = Load(daemons, mix=mix, crossed=args.crossed, hotspot=args.hotspot, requests=args.requests, timeout=args.timeout, seed=args.seed)
+        start = monotonic()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            for _ in range(args.concurrency):
+                executor.submit(load.worker)
+        results = report(load, list(daemons.values()), monotonic() - start, args.concurrency)
+    finally:
+        for daemon in daemons.values():
+            daemon.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+
+import unittest
+from contextlib import nullcontext, suppress
+from ipaddress import IPv4Address
+from threading import get_ident, Thread
+from unittest.mock import patch
+
+from websockets import ConnectionClosed
+from websockets.sync.client import connect
+from websockets.sync.server import serve
+
+from wirescale.communications.common import CONNECTION_PAIRS
+from wirescale.communications.connection_pair import ConnectionPair
+
+
+class ConnectionPairIterationTest(unittest.TestCase):
+
+    @staticmethod
+    def handler(websocket):
+        websocket.send('first')
+        websocket.send('second')
+        with suppress(ConnectionClosed, TimeoutError):
+            websocket.recv(timeout=5)  # Closing right away could beat the first iteration, which is where the heartbeat starts
+        websocket.close()
+
+    def test_iterating_a_real_pair_watches_and_releases_its_heartbeat(self):
+        with serve(self.handler, '127.0.0.1', 0) as server:
+            Thread(target=server.serve_forever, daemon=True).start()
+            with patch('wirescale.communications.connection_pair.file_locker', nullcontext), patch.object(ConnectionPair, 'caller_name', 'local'), \
+                    patch.object(ConnectionPair, 'receiver_name', 'remote'):  # There is no tailscaled to resolve the names
+                pair = ConnectionPair(caller=IPv4Address('127.0.0.1'), receiver=None)
+            try:
+                pair.tcp_socket = connect(f'ws://127.0.0.1:{server.socket.getsockname()[1]}')
+                received = []
+                for message in pair:
+                    self.assertIn(pair, pair.heartbeat.pairs.values())
+                    received.append(message)
+                    if len(received) == 2:
+                        pair.tcp_socket.send('done')
+                pair.close_sockets()
+            finally:
+                server.shutdown()
+                CONNECTION_PAIRS.pop(get_ident(), None)
+        self.assertEqual(received, ['first', 'second'])
+        self.assertFalse(pair.heartbeat.pairs)
+        self.assertTrue(pair.heartbeat.stopped.is_set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from statistics import median
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.import_time import COMMANDS, Environment  # noqa: E402
+
+
+def namespaces() -> bool:
+    try:
+        return subprocess.run(['unshare', '--map-root-user', '--mount', 'true'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+    except OSError:
+        return False
+
+
+@unittest.skipUnless(namespaces(), 'needs unprivileged user namespaces to give every command its own /run')
+class ImportTimeTest(unittest.TestCase):
+    # The budgets of benchmarks/import_time.py, on the same code paths, including 'upgrade <peer>' up to the UNIX socket of the daemon
+    RUNS = 3
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory(prefix='wirescale-import-')
+        cls.environment = Environment(Path(cls.directory.name))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def test_every_command_stays_within_its_budget(self):
+        for argv, budget, forbidden in COMMANDS:
+            with self.subTest(command=' '.join(argv)):
+                results = [self.environment.measure(argv) for _ in range(self.RUNS)]
+                self.assertEqual(sorted(name for name in forbidden if any(name in modules for _, modules in results)), [])
+                self.assertLessEqual(median(total for total, _ in results), budget)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+
+import unittest
+from ipaddress import IPv4Address
+from types import SimpleNamespace
+
+from wirescale.communications.common import CONNECTION_PAIRS
+from wirescale.vpn.watch import ActiveSockets
+
+
+class CrossedUpgradeTest(unittest.TestCase):
+    # The scenario of 'benchmarks.tailnet --peers 2 --crossed 1': both nodes upgrade to each other at once, so each one holds the
+    # exclusive semaphore for its own client while the session of the other waits as server
+    NODES = {'alice': IPv4Address('127.0.0.2'), 'bob': IPv4Address('127.0.0.3')}
+
+    def setUp(self):
+        self.sockets = {}
+        for thread, (name, ip) in enumerate(self.NODES.items()):
+            peer_ip = next(other for other in self.NODES.values() if other != ip)
+            client, server = (SimpleNamespace(role=role, my_ip=ip, peer_ip=peer_ip) for role in ('client', 'server'))
+            CONNECTION_PAIRS[-2 * thread - 1], CONNECTION_PAIRS[-2 * thread - 2] = client, server
+            sockets = ActiveSockets()
+            sockets.client_thread, sockets.server_thread = -2 * thread - 1, -2 * thread - 2
+            sockets.exclusive_socket = client
+            self.sockets[name] = sockets
+
+    def tearDown(self):
+        for thread in range(-2 * len(self.NODES), 0):
+            CONNECTION_PAIRS.pop(thread, None)
+
+    def test_only_the_higher_ip_yields_while_the_switched_session_runs(self):
+        switched = []
+        for _ in range(5):  # Watcher intervals, with the switched session taking longer than any of them
+            for name, sockets in self.sockets.items():
+                if sockets.needs_switch():
+                    switched.append(name)
+                    sockets.exclusive_socket = sockets._server
+        self.assertEqual(switched, ['bob'])
+        self.assertTrue(self.sockets['alice'].client_is_running())
+        self.assertTrue(self.sockets['bob'].server_is_running())
+
+    def test_nothing_switches_once_the_crossed_session_is_gone(self):
+        CONNECTION_PAIRS.pop(self.sockets['bob'].server_thread)
+        self.assertFalse(self.sockets['bob'].needs_switch())
+        self.assertFalse(self.sockets['alice'].needs_switch())
+
+
+if __name__ == '__main__':
+    unittest.main()
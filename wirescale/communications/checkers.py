@@ -14,8 +14,10 @@ from typing import Tuple, TYPE_CHECKING
 
 from netifaces import AF_INET, ifaddresses, interfaces
 
+from wirescale.communications.commands import COMMANDS
 from wirescale.communications.common import check_with_timeout, CONNECTION_PAIRS
 from wirescale.communications.messages import ErrorCodes, ErrorMessages
+from wirescale.vpn.tsmanager import TSManager
 from wirescale.vpn.wgconfig import WGConfig
 
 if TYPE_CHECKING:
@@ -50,7 +52,7 @@ def check_interface(interface: str, allow_suffix: bool) -> Tuple[str, int]:
 
 def check_configfile() -> Path:
     pair = CONNECTION_PAIRS[get_ident()]
-    peer = Path(f'/etc/wirescale/{pair.peer_name}.conf')
+    peer = TSManager.config_file(pair.peer_name)
     if peer.is_file():
         return peer.resolve()
     error = ErrorMessages.CONFIG_PATH_ERROR.format(peer_name=pair.peer_name)
@@ -126,7 +128,7 @@ def test_wgconfig(wgconfig: WGConfig):
     test_config.set(peer, 'PresharedKey', wgconfig.psk) if wgconfig.has_psk else None
     test_config = WGConfig.write_config(test_config, wgconfig.suffix)
     wgconfig.new_config_path.write_text(test_config, encoding='utf-8')
-    wgquick = subprocess.run(['wg-quick', 'up', str(wgconfig.new_config_path)], capture_output=True, text=True)
+    wgquick = COMMANDS.run(['wg-quick', 'up', str(wgconfig.new_config_path)], capture_output=True, text=True)
     try:
         if wgquick.returncode != 0:
             pair = CONNECTION_PAIRS[get_ident()]
@@ -134,7 +136,7 @@ def test_wgconfig(wgconfig: WGConfig):
             remote_error = ErrorMessages.REMOTE_CONFIG_ERROR.format(my_name=pair.my_name, my_ip=pair.my_ip, peer_name=pair.peer_name)
             ErrorMessages.send_error_message(local_message=error, remote_message=remote_error, always_send_to_remote=False)
         else:
-            subprocess.run(['wg-quick', 'down', str(wgconfig.new_config_path)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            COMMANDS.run(['wg-quick', 'down', str(wgconfig.new_config_path)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     finally:
         wgconfig.new_config_path.unlink(missing_ok=False)
 
@@ -179,7 +181,7 @@ def match_interface_port(interface: str, port: int) -> bool:
     def match():
         pair = CONNECTION_PAIRS[get_ident()]
         try:
-            real_port = int(subprocess.run(['wg', 'show', interface, 'listen-port'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip())
+            real_port = int(COMMANDS.run(['wg', 'show', interface, 'listen-port'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip())
             return real_port == port
         except:
             error = ErrorMessages.WG_INTERFACE_MISSING.format(interface=interface)
@@ -192,7 +194,7 @@ def match_interface_port(interface: str, port: int) -> bool:
 def get_latest_handshake(interface: str) -> int:
     pair = CONNECTION_PAIRS.get(get_ident())
     try:
-        handshake = subprocess.run(['wg', 'show', interface, 'latest-handshakes'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip()
+        handshake = COMMANDS.run(['wg', 'show', interface, 'latest-handshakes'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip()
         return int(handshake.split('\n')[0].split('\t')[1])
     except:
         error = ErrorMessages.WG_INTERFACE_MISSING.format(interface=interface)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+
+import subprocess
+from pathlib import Path
+from threading import get_ident, Lock
+from time import monotonic
+from typing import Dict, List, Sequence, Tuple
+
+from wirescale.communications.common import CONNECTION_PAIRS
+
+
+class CommandRunner:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.totals: Dict[str, Tuple[int, float, int]] = {}
+
+    def run(self, args: Sequence[str], **kwargs) -> subprocess.CompletedProcess:
+        start, returncode = monotonic(), None
+        try:
+            result = subprocess.run(args, **kwargs)
+            returncode = result.returncode
+            return result
+        finally:
+            self.record(args, seconds=monotonic() - start, returncode=returncode)
+
+    def record(self, args: Sequence[str], seconds: float, returncode: int | None):
+        name = Path(args[0]).name
+        with self.lock:
+            count, total, failures = self.totals.get(name, (0, 0, 0))
+            self.totals[name] = (count + 1, total + seconds, failures + (returncode != 0))
+        if (pair := CONNECTION_PAIRS.get(get_ident())) is not None:
+            pair.commands.append({'argv': [str(arg) for arg in args], 'phase': pair.phase, 'seconds': seconds, 'returncode': returncode})
+
+    def snapshot(self) -> Dict[str, Tuple[int, float, int]]:
+        with self.lock:
+            return dict(self.totals)
+
+    @staticmethod
+    def forks(commands: List[Dict], phase: str = None) -> Tuple[int, float]:
+        commands = [command for command in commands if phase is None or command['phase'] == phase]
+        return len(commands), sum(command['seconds'] for command in commands)
+
+
+COMMANDS = CommandRunner()
@@ -9,20 +9,24 @@ from contextlib import contextmanager, ExitStack
 from enum import auto, IntEnum
 from pathlib import Path
 from tempfile import TemporaryFile
-from threading import Event
+from threading import Condition, Event, get_ident
 from time import sleep
 from typing import Dict, TYPE_CHECKING
 
 if TYPE_CHECKING:
     from wirescale.communications.connection_pair import ConnectionPair
 
+CANCEL_GRACE = 5  # Seconds the sessions cancelled by the drain get to unwind
 CONNECTION_PAIRS: Dict[int, 'ConnectionPair'] = {}
+SESSIONS_CHANGED = Condition()
 SHUTDOWN = Event()
 SOCKET_PATH = Path('/run/wirescale/wirescaled.sock').resolve()
+STOP_TIMEOUT = 50  # Seconds 'daemon stop' may take in total, below the TimeoutStopSec=60 of wirescaled.service
 TCP_PORT = 41642
 WIRESCALE_TABLE = 0xA08D037A  # 2693596026
 EXIT_NODE_MARK = WIRESCALE_TABLE + 1
 GLOB_MARK = EXIT_NODE_MARK + 1
+WIRESCALE_PROTOCOL = WIRESCALE_TABLE & 0xFF  # 122, tags the IP rules wirescale owns
 
 
 class Semaphores(IntEnum):
@@ -32,6 +36,18 @@ class Semaphores(IntEnum):
     WAIT_IF_SWITCHED = auto()
 
 
+class SessionStates(IntEnum):
+    QUEUED = auto()
+    RUNNING = auto()
+    APPLYING = auto()
+
+
+def end_session():
+    with SESSIONS_CHANGED:
+        CONNECTION_PAIRS.pop(get_ident(), None)
+        SESSIONS_CHANGED.notify_all()
+
+
 def check_with_timeout(func, timeout, sleep_time=0.5, *args, **kwargs) -> bool:
     while not (check := func(*args, **kwargs)) and timeout > 0:
         timeout -= sleep_time
@@ -40,13 +56,14 @@ def check_with_timeout(func, timeout, sleep_time=0.5, *args, **kwargs) -> bool:
 
 
 def subprocess_run_tmpfile(*args, **kwargs) -> subprocess.CompletedProcess[str]:
+    from wirescale.communications.commands import COMMANDS
     kwargs['encoding'] = kwargs.get('encoding', 'utf-8')
     collections.deque((kwargs.pop(field, None) for field in ('capture_output', 'text', 'universal_newlines')), maxlen=0)
     streams = ('stdout', 'stderr')
     streams_are_set = {stream: kwargs.get(stream, None) is not None for stream in streams}
     with ExitStack() as stack:
         kwargs.update({stream: kwargs[stream] if streams_are_set[stream] else stack.enter_context(TemporaryFile(mode='w+', encoding=kwargs['encoding'])) for stream in streams})
-        p = subprocess.run(*args, **kwargs)
+        p = COMMANDS.run(*args, **kwargs)
         p.stdout, p.stderr = ((kwargs[stream].flush(), kwargs[stream].seek(0), kwargs[stream].read())[2] if not streams_are_set[stream] else getattr(p, stream) for stream in streams)
     return p
 
@@ -8,7 +8,8 @@ from contextlib import suppress
 from functools import cached_property
 from ipaddress import IPv4Address
 from threading import get_ident
-from typing import Iterator
+from time import monotonic
+from typing import Dict, Iterator, List
 
 from parallel_utils.thread import create_thread
 from websockets import ConnectionClosed, ConnectionClosedError, ConnectionClosedOK, Data
@@ -16,22 +17,31 @@ from websockets.sync.client import ClientConnection
 from websockets.sync.connection import Connection
 from websockets.sync.server import ServerConnection
 
-from wirescale.communications.common import CONNECTION_PAIRS, file_locker
+from wirescale.communications.common import CONNECTION_PAIRS, file_locker, SessionStates
+from wirescale.communications.heartbeat import Heartbeat
 from wirescale.communications.messages import ErrorCodes, ErrorMessages, Messages
+from wirescale.communications.multiplex import MuxStream
 from wirescale.vpn.tsmanager import TSManager
 
 
 class ConnectionPair:
-    def __init__(self, caller: IPv4Address, receiver: IPv4Address):
+    def __init__(self, caller: IPv4Address = None, receiver: IPv4Address = None):
         self.caller = caller
         self.receiver = receiver
-        with file_locker():
-            self.caller_name, self.receiver_name
-        self.check_running = False
+        if receiver is not None:  # The CLI leaves the peer unresolved and lets the daemon validate it
+            with file_locker():
+                self.caller_name, self.receiver_name
         self.closing = False
-        self.tcp_socket: ClientConnection | ServerConnection = None
+        self.state = SessionStates.QUEUED
+        self.tcp_socket: ClientConnection | ServerConnection | MuxStream = None
         self.unix_socket: ServerConnection = None
         self.token: str = None
+        self.kind: str = None
+        self.phase: str = None
+        self.spans: Dict[str, float] = {}
+        self.cpu: Dict[str, float] = {}
+        self.commands: List[Dict] = []
+        self.started = monotonic()
         CONNECTION_PAIRS[get_ident()] = self
 
     def __eq__(self, other):
@@ -49,46 +59,43 @@ class ConnectionPair:
             return False
         return True
 
+    def __hash__(self):
+        return id(self)
+
     def __iter__(self) -> Iterator[Data]:
+        self.heartbeat.watch(self)
         while True:
             try:
-                yield self.remote_socket.recv(15)
-            except TimeoutError:
-                create_thread(self.check_broken_connection)
+                yield self.remote_socket.recv()
             except ConnectionClosedError:
                 error = ErrorMessages.CONNECTION_LOST.format(peer_name=self.peer_name, peer_ip=self.peer_ip)
                 ErrorMessages.send_error_message(local_message=error, error_code=ErrorCodes.TS_UNREACHABLE)
             except ConnectionClosedOK:
                 return
 
-    def check_broken_connection(self):
-        if self.closing or self.check_running:
-            return
-        try:
-            self.check_running = True
-            with file_locker():
-                checking_message = Messages.CHECKING_CONNECTION.format(peer_name=self.peer_name, peer_ip=self.peer_ip)
-                checking_message = Messages.add_id(self.id, checking_message)
-                Messages.send_info_message(local_message=checking_message, send_to_local=False)
-                is_online = TSManager.wait_until_peer_is_online(ip=self.peer_ip, timeout=30)
-            if not is_online:
-                self.closing = True
-                closing_message = Messages.add_id(self.id, ErrorMessages.CLOSING_SOCKET)
-                ErrorMessages.send_error_message(local_message=closing_message, send_to_local=False, exit_code=None)
-                create_thread(self.close_socket, self.remote_socket)
-            else:
-                message_ok = Messages.CONNECTION_OK.format(peer_name=self.peer_name, peer_ip=self.peer_ip)
-                message_ok = Messages.add_id(self.id, message_ok)
-                Messages.send_info_message(local_message=message_ok, send_to_local=False)
-        finally:
-            self.check_running = False
+    @cached_property
+    def heartbeat(self) -> Heartbeat:
+        if isinstance(self.remote_socket, MuxStream):
+            return self.remote_socket.heartbeat
+        return Heartbeat(self.remote_socket)
 
     def close_sockets(self):
+        if 'heartbeat' in self.__dict__:
+            self.heartbeat.release(self)
         if self.local_socket is not None:
             create_thread(self.close_socket, self.local_socket)
         if self.remote_socket is not None:
             create_thread(self.close_socket, self.remote_socket)
 
+    def cancel(self, local_message: str, remote_message: str, error_code: ErrorCodes):
+        for socket, message in ((self.local_socket, local_message), (self.remote_socket, remote_message)):
+            if socket is not None and message is not None:
+                message = Messages.add_id(self.id, message) if self.token is not None else message
+                error_message = ErrorMessages.build_error_message(message, error_code)
+                with suppress(ConnectionClosed):
+                    socket.send(json.dumps(error_message))
+        self.close_sockets()
+
     @staticmethod
     def close_socket(socket: Connection):
         with suppress(BaseException):
@@ -126,7 +133,7 @@ class ConnectionPair:
 
     @cached_property
     def running_in_remote(self) -> bool:
-        return self.receiver == self.my_ip
+        return self.receiver is not None and self.receiver == self.my_ip
 
     def send_to_local(self, message):
         try:
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+
+import os
+import socket
+import struct
+from time import monotonic
+from typing import Any, Dict, List, Tuple
+
+
+class DBusError(Exception):
+    pass
+
+
+class DBusUnavailable(DBusError):
+    pass
+
+
+class Variant:
+    def __init__(self, signature: str, value: Any):
+        self.signature = signature
+        self.value = value
+
+
+class Marshaller:
+    ALIGNMENT = {'y': 1, 'b': 4, 'n': 2, 'q': 2, 'i': 4, 'u': 4, 'x': 8, 't': 8, 'd': 8, 'h': 4, 's': 4, 'o': 4, 'g': 1, 'a': 4, '(': 8, '{': 8, 'v': 1}
+    FORMATS = {'y': 'B', 'b': 'I', 'n': 'h', 'q': 'H', 'i': 'i', 'u': 'I', 'x': 'q', 't': 'Q', 'd': 'd', 'h': 'I'}
+
+    @staticmethod
+    def type_end(signature: str, start: int) -> int:
+        if signature[start] == 'a':
+            return Marshaller.type_end(signature, start + 1)
+        if signature[start] in '({':
+            depth, i = 0, start
+            while True:
+                depth += 1 if signature[i] in '({' else -1 if signature[i] in ')}' else 0
+                i += 1
+                if depth == 0:
+                    return i
+        return start + 1
+
+    @classmethod
+    def split(cls, signature: str) -> List[str]:
+        res, i = [], 0
+        while i < len(signature):
+            end = cls.type_end(signature, i)
+            res.append(signature[i:end])
+            i = end
+        return res
+
+    @classmethod
+    def marshal(cls, buffer: bytearray, signature: str, value: Any):
+        code = signature[0]
+        buffer += bytes(-len(buffer) % cls.ALIGNMENT[code])
+        if code in cls.FORMATS:
+            buffer += struct.pack('<' + cls.FORMATS[code], value)
+        elif code in 'so':
+            data = value.encode()
+            buffer += struct.pack('<I', len(data)) + data + b'\0'
+        elif code == 'g':
+            data = value.encode()
+            buffer += bytes((len(data),)) + data + b'\0'
+        elif code == 'v':
+            cls.marshal(buffer, 'g', value.signature)
+            cls.marshal(buffer, value.signature, value.value)
+        elif code == 'a':
+            length_offset = len(buffer)
+            buffer += bytes(4)
+            buffer += bytes(-len(buffer) % cls.ALIGNMENT[signature[1]])
+            start = len(buffer)
+            for item in (value.items() if signature[1] == '{' else value):
+                cls.marshal(buffer, signature[1:], item)
+            struct.pack_into('<I', buffer, length_offset, len(buffer) - start)
+        else:
+            for member, item in zip(cls.split(signature[1:-1]), value):
+                cls.marshal(buffer, member, item)
+
+    @classmethod
+    def unmarshal(cls, data: bytes, offset: int, signature: str, order: str = '<') -> Tuple[Any, int]:
+        code = signature[0]
+        offset += -offset % cls.ALIGNMENT[code]
+        if code in cls.FORMATS:
+            value = struct.unpack_from(order + cls.FORMATS[code], data, offset)[0]
+            return bool(value) if code == 'b' else value, offset + struct.calcsize(cls.FORMATS[code])
+        if code in 'so':
+            length = struct.unpack_from(order + 'I', data, offset)[0]
+            return data[offset + 4:offset + 4 + length].decode(), offset + 5 + length
+        if code == 'g':
+            length = data[offset]
+            return data[offset + 1:offset + 1 + length].decode(), offset + 2 + length
+        if code == 'v':
+            inner, offset = cls.unmarshal(data, offset, 'g', order)
+            return cls.unmarshal(data, offset, inner, order)
+        if code == 'a':
+            length = struct.unpack_from(order + 'I', data, offset)[0]
+            offset += 4
+            offset += -offset % cls.ALIGNMENT[signature[1]]
+            end, items = offset + length, []
+            while offset < end:
+                item, offset = cls.unmarshal(data, offset, signature[1:], order)
+                items.append(item)
+            return dict(items) if signature[1] == '{' else items, offset
+        items = []
+        for member in cls.split(signature[1:-1]):
+            item, offset = cls.unmarshal(data, offset, member, order)
+            items.append(item)
+        return tuple(items), offset
+
+
+class DBusMessage:
+    METHOD_CALL, METHOD_RETURN, ERROR, SIGNAL = 1, 2, 3, 4
+    PATH, INTERFACE, MEMBER, ERROR_NAME, REPLY_SERIAL, DESTINATION, SENDER, SIGNATURE = range(1, 9)
+    FIELD_TYPES = {PATH: 'o', INTERFACE: 's', MEMBER: 's', ERROR_NAME: 's', REPLY_SERIAL: 'u', DESTINATION: 's', SENDER: 's', SIGNATURE: 'g'}
+
+    def __init__(self, message_type: int, serial: int, fields: Dict[int, Any], body: List[Any]):
+        self.type = message_type
+        self.serial = serial
+        self.fields = fields
+        self.body = body
+
+    @property
+    def member(self) -> str:
+        return self.fields.get(self.MEMBER)
+
+    @property
+    def path(self) -> str:
+        return self.fields.get(self.PATH)
+
+    @property
+    def reply_serial(self) -> int:
+        return self.fields.get(self.REPLY_SERIAL)
+
+    def encode(self) -> bytes:
+        signature = self.fields.get(self.SIGNATURE, '')
+        body = bytearray()
+        for member, value in zip(Marshaller.split(signature), self.body):
+            Marshaller.marshal(body, member, value)
+        fields = [(code, Variant(self.FIELD_TYPES[code], value)) for code, value in self.fields.items() if value]
+        header = bytearray(b'l' + bytes((self.type, 0, 1)))
+        header += struct.pack('<II', len(body), self.serial)
+        Marshaller.marshal(header, 'a(yv)', fields)
+        header += bytes(-len(header) % 8)
+        return bytes(header + body)
+
+    @classmethod
+    def decode(cls, data: bytes) -> 'DBusMessage':
+        order = '<' if data[0:1] == b'l' else '>'
+        body_length, serial = struct.unpack_from(order + 'II', data, 4)
+        fields, offset = Marshaller.unmarshal(data, 12, 'a(yv)', order)
+        fields = dict(fields)
+        offset += -offset % 8
+        body, signature = [], fields.get(cls.SIGNATURE, '')
+        for member in Marshaller.split(signature):
+            value, offset = Marshaller.unmarshal(data, offset, member, order)
+            body.append(value)
+        return cls(data[1], serial, fields, body)
+
+
+class SystemdBus:
+    ADDRESSES = ('/run/systemd/private', '/run/dbus/system_bus_socket')
+    DESTINATION = 'org.freedesktop.systemd1'
+    MANAGER = 'org.freedesktop.systemd1.Manager'
+    MANAGER_PATH = '/org/freedesktop/systemd1'
+    PROPERTIES = 'org.freedesktop.DBus.Properties'
+    SERVICE = 'org.freedesktop.systemd1.Service'
+    UNIT = 'org.freedesktop.systemd1.Unit'
+    ACTIVE_STATES = ('active', 'reloading', 'refreshing')
+    INACTIVE_STATES = ('inactive', 'failed')
+    NO_SUCH_UNIT = 'org.freedesktop.systemd1.NoSuchUnit'
+    UNIT_SUFFIXES = ('.service', '.socket', '.slice', '.scope', '.target', '.timer', '.mount', '.path', '.device', '.swap', '.automount')
+
+    def __init__(self, address: str = None):
+        self.socket: socket.socket = None
+        self.serial = 0
+        self.buffer = b''
+        self.signals: List[DBusMessage] = []
+        self.subscribed = False
+        for address in (address,) if address is not None else self.ADDRESSES:
+            with_bus_daemon = not address.endswith('/private')  # systemd's private socket talks to us directly
+            try:
+                self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
+                self.socket.connect(address)
+                self.authenticate()
+                if with_bus_daemon:
+                    self.call('Hello', destination='org.freedesktop.DBus', path='/org/freedesktop/DBus', interface='org.freedesktop.DBus')
+                self.with_bus_daemon = with_bus_daemon
+                return
+            except (OSError, DBusError):
+                self.close()
+        raise DBusUnavailable('No D-Bus connection to systemd is available')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def authenticate(self):
+        self.socket.sendall(b'\0AUTH EXTERNAL ' + str(os.getuid()).encode().hex().encode() + b'\r\n')
+        reply = b''
+        while not reply.endswith(b'\r\n'):
+            if not (chunk := self.socket.recv(256)):
+                raise DBusError('Connection closed during authentication')
+            reply += chunk
+        if not reply.startswith(b'OK'):
+            raise DBusError(reply.decode().strip())
+        self.socket.sendall(b'BEGIN\r\n')
+
+    @staticmethod
+    def unit_name(unit: str) -> str:
+        return unit if unit.endswith(SystemdBus.UNIT_SUFFIXES) else f'{unit}.service'
+
+    def send(self, message: DBusMessage):
+        self.socket.sendall(message.encode())
+
+    def receive(self, timeout: float = None) -> DBusMessage:
+        self.socket.settimeout(timeout)
+        while True:
+            if len(self.buffer) >= 16:
+                order = '<' if self.buffer[0:1] == b'l' else '>'
+                body_length, _, fields_length = struct.unpack_from(order + 'III', self.buffer, 4)
+                length = 16 + fields_length + (-(16 + fields_length) % 8) + body_length
+                if len(self.buffer) >= length:
+                    message, self.buffer = DBusMessage.decode(self.buffer[:length]), self.buffer[length:]
+                    return message
+            if not (chunk := self.socket.recv(65536)):
+                raise DBusError('Connection closed by systemd')
+            self.buffer += chunk
+
+    def call(self, member: str, signature: str = '', *args, path: str = MANAGER_PATH, interface: str = MANAGER, destination: str = DESTINATION) -> List[Any]:
+        self.serial += 1
+        fields = {DBusMessage.PATH: path, DBusMessage.INTERFACE: interface, DBusMessage.MEMBER: member, DBusMessage.DESTINATION: destination, DBusMessage.SIGNATURE: signature}
+        self.send(DBusMessage(DBusMessage.METHOD_CALL, self.serial, fields, list(args)))
+        while True:
+            reply = self.receive()
+            if reply.type == DBusMessage.SIGNAL:
+                self.signals.append(reply)
+            elif reply.reply_serial == self.serial:
+                if reply.type == DBusMessage.ERROR:
+                    raise DBusError(reply.fields.get(DBusMessage.ERROR_NAME), *reply.body)
+                return reply.body
+
+    def subscribe(self):
+        if self.subscribed:
+            return
+        if self.with_bus_daemon:
+            for rule in (f"type='signal',interface='{self.MANAGER}',member='JobRemoved'", f"type='signal',interface='{self.PROPERTIES}',member='PropertiesChanged'"):
+                self.call('AddMatch', 's', rule, destination='org.freedesktop.DBus', path='/org/freedesktop/DBus', interface='org.freedesktop.DBus')
+        self.call('Subscribe')
+        self.subscribed = True
+
+    def next_signal(self, deadline: float) -> DBusMessage | None:
+        if self.signals:
+            return self.signals.pop(0)
+        if (timeout := deadline - monotonic()) <= 0:
+            return None
+        try:
+            message = self.receive(timeout)
+        except TimeoutError:
+            return None
+        return message if message.type == DBusMessage.SIGNAL else self.next_signal(deadline)
+
+    def wait_job(self, job: str, timeout: float = 90) -> str:
+        deadline = monotonic() + timeout
+        while (signal := self.next_signal(deadline)) is not None:
+            if signal.member == 'JobRemoved' and signal.body[1] == job:
+                return signal.body[3]
+        raise DBusError(f'Timed out waiting for job {job}')
+
+    def run_job(self, member: str, signature: str, *args) -> bool:
+        self.subscribe()
+        try:
+            job = self.call(member, signature, *args)[0]
+        except DBusError as e:
+            if e.args[0] == self.NO_SUCH_UNIT:
+                return False
+            raise
+        return self.wait_job(job) == 'done'
+
+    def unit_path(self, unit: str) -> str:
+        return self.call('LoadUnit', 's', self.unit_name(unit))[0]
+
+    def properties(self, unit: str, interface: str = UNIT) -> Dict[str, Any]:
+        return self.call('GetAll', 's', interface, path=self.unit_path(unit), interface=self.PROPERTIES)[0]
+
+    def is_active(self, unit: str) -> bool:
+        return self.properties(unit)['ActiveState'] in self.ACTIVE_STATES
+
+    def start(self, unit: str) -> bool:
+        return self.run_job('StartUnit', 'ss', self.unit_name(unit), 'replace')
+
+    def stop(self, unit: str) -> bool:
+        return self.run_job('StopUnit', 'ss', self.unit_name(unit), 'replace')
+
+    def restart(self, unit: str) -> bool:
+        return self.run_job('RestartUnit', 'ss', self.unit_name(unit), 'replace')
+
+    def reset_failed(self, unit: str) -> bool:
+        try:
+            self.call('ResetFailedUnit', 's', self.unit_name(unit))
+        except DBusError:  # Units that are not loaded have nothing to reset
+            return False
+        return True
+
+    def start_transient(self, unit: str, argv: List[str], description: str = None) -> bool:
+        properties = [('Description', Variant('s', description or ' '.join(argv))), ('ExecStart', Variant('a(sasb)', [(argv[0], argv, False)]))]
+        return self.run_job('StartTransientUnit', 'ssa(sv)a(sa(sv))', self.unit_name(unit), 'fail', properties, [])
+
+    def wait_inactive(self, unit: str, timeout: float) -> bool:
+        self.subscribe()
+        path, deadline = self.unit_path(unit), monotonic() + timeout
+        while self.call('Get', 'ss', self.UNIT, 'ActiveState', path=path, interface=self.PROPERTIES)[0] not in self.INACTIVE_STATES:
+            while (signal := self.next_signal(deadline)) is not None and signal.path != path:
+                pass
+            if signal is None:
+                return False
+        return True
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+
+from contextlib import suppress
+from ipaddress import IPv4Address
+from threading import Event, Lock
+from time import monotonic
+from typing import Dict, TYPE_CHECKING
+
+from parallel_utils.thread import create_thread
+from websockets import ConnectionClosed
+from websockets.sync.connection import Connection
+
+from wirescale.communications.common import file_locker
+from wirescale.communications.messages import ErrorMessages, Messages
+from wirescale.vpn.tsmanager import TSManager
+
+if TYPE_CHECKING:
+    from wirescale.communications.connection_pair import ConnectionPair
+
+
+class Heartbeat:
+    INTERVAL = 5
+    MISSES = 3
+    PROBE_TIMEOUT = 30
+    FALSE_ALARMS = 0
+    FAILURES = 0
+
+    def __init__(self, websocket: Connection, shared: bool = False):
+        from wirescale.parsers.args import ARGS
+        self.websocket = websocket
+        self.shared = shared
+        self.peer_ip = IPv4Address(websocket.remote_address[0])
+        self.interval: float = ARGS.HEARTBEAT_INTERVAL if ARGS.HEARTBEAT_INTERVAL is not None else self.INTERVAL
+        self.max_misses: int = ARGS.HEARTBEAT_MISSES if ARGS.HEARTBEAT_MISSES is not None else self.MISSES
+        self.misses = 0
+        self.false_alarms = 0
+        self.last_pong = monotonic()
+        self.pairs: Dict[int, 'ConnectionPair'] = {}  # Keyed by identity, as pairs only compare equal to themselves
+        self.lock = Lock()
+        self.stopped = Event()
+        create_thread(self.run)
+
+    def healthy(self) -> bool:
+        return not self.stopped.is_set() and self.misses == 0
+
+    def watch(self, pair: 'ConnectionPair'):
+        with self.lock:
+            self.pairs[id(pair)] = pair
+
+    def release(self, pair: 'ConnectionPair'):
+        with self.lock:
+            self.pairs.pop(id(pair), None)
+        if not self.shared:
+            self.stop()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(timeout=self.interval):
+            try:
+                pong = self.websocket.ping()
+            except ConnectionClosed:
+                return self.stop()
+            if pong.wait(timeout=self.interval):
+                self.misses, self.last_pong = 0, monotonic()
+                continue
+            self.misses += 1
+            if self.misses >= self.max_misses:
+                self.probe()
+
+    def probe(self):
+        Heartbeat.FAILURES += 1
+        with self.lock:
+            pairs = tuple(self.pairs.values())
+        if not pairs:  # Nobody is waiting on this connection, so there is no point in bothering tailscale
+            return self.close()
+        for pair in pairs:
+            checking_message = Messages.CHECKING_CONNECTION.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
+            print(Messages.add_id(pair.id, checking_message), flush=True)
+        with file_locker():
+            is_online = TSManager.wait_until_peer_is_online(ip=self.peer_ip, timeout=self.PROBE_TIMEOUT)
+        if not is_online:
+            for pair in pairs:
+                pair.closing = True
+                print(Messages.add_id(pair.id, ErrorMessages.CLOSING_SOCKET), flush=True)
+            return self.close()
+        Heartbeat.FALSE_ALARMS += 1
+        self.false_alarms += 1
+        self.misses = 0
+        for pair in pairs:
+            message_ok = Messages.CONNECTION_OK.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
+            print(Messages.add_id(pair.id, message_ok), flush=True)
+        print(Messages.HEARTBEAT_FALSE_ALARM.format(peer_ip=self.peer_ip, false_alarms=Heartbeat.FALSE_ALARMS), flush=True)
+
+    def close(self):
+        self.stop()
+        with suppress(BaseException):
+            self.websocket.close()
@@ -24,6 +24,8 @@ class MessageFields(StrEnum):
     ADDRESSES = auto()
     ALLOW_SUFFIX = auto()
     CODE = auto()
+    COUNT = auto()
+    DURATION = auto()
     ENCRYPTED = auto()
     ERROR_CODE = auto()
     ERROR_MESSAGE = auto()
@@ -38,9 +40,12 @@ class MessageFields(StrEnum):
     MESSAGE = auto()
     NAT = auto()
     NONCE = auto()
+    PAYLOAD = auto()
+    PEER = auto()
     PEER_IP = auto()
     PUBLIC_IP = auto()
     PORT = auto()
+    PORTS = auto()
     PSK = auto()
     PUBKEY = auto()
     RECOVER_TRIES = auto()
@@ -48,7 +53,10 @@ class MessageFields(StrEnum):
     REMOTE_INTERFACE = auto()
     REMOTE_PORT = auto()
     REMOTE_PUBKEY = auto()
+    RESULTS = auto()
+    SESSIONS = auto()
     START_TIME = auto()
+    STREAM = auto()
     SUFFIX_NUMBER = auto()
     TOKEN = auto()
     VERSION = auto()
@@ -58,11 +66,14 @@ class MessageFields(StrEnum):
 @unique
 class ActionCodes(StrEnum):
     ACK = auto()
+    BENCH = auto()
+    FAST_UPGRADE = auto()
     GO = auto()
     HELLO = auto()
     INFO = auto()
     RECOVER = auto()
     RECOVER_RESPONSE = auto()
+    STATS = auto()
     STOP = auto()
     SUCCESS = auto()
     TOKEN = auto()
@@ -77,12 +88,26 @@ class ErrorCodes(StrEnum):
     GENERIC = auto()
     HANDSHAKE_MISMATCH = auto()
     INTERFACE_EXISTS = auto()
+    INVALID_PEER = auto()
     TS_UNREACHABLE = auto()
 
 
 class UnixMessages:
+    STATS_MESSAGE = {MessageFields.CODE: ActionCodes.STATS, MessageFields.ERROR_CODE: None}
     STOP_MESSAGE = {MessageFields.CODE: ActionCodes.STOP, MessageFields.ERROR_CODE: None}
 
+    @staticmethod
+    def build_bench() -> dict:
+        from wirescale.parsers.args import ARGS
+        res = {
+            MessageFields.CODE: ActionCodes.BENCH,
+            MessageFields.ERROR_CODE: None,
+            MessageFields.COUNT: ARGS.COUNT,
+            MessageFields.DURATION: ARGS.DURATION,
+            MessageFields.INTERFACE: ARGS.INTERFACE,
+        }
+        return res
+
     @staticmethod
     def send_upgrade_option():
         from wirescale.parsers.args import ARGS
@@ -95,7 +120,7 @@ class UnixMessages:
             MessageFields.IPTABLES_ACCEPT: ARGS.IPTABLES_ACCEPT,
             MessageFields.IPTABLES_FORWARD: ARGS.IPTABLES_FORWARD,
             MessageFields.IPTABLES_MASQUERADE: ARGS.IPTABLES_MASQUERADE,
-            MessageFields.PEER_IP: str(ARGS.PAIR.peer_ip),
+            MessageFields.PEER: ARGS.PEER,
             MessageFields.RECOVER_TRIES: ARGS.RECOVER_TRIES,
             MessageFields.RECREATE_TRIES: ARGS.RECREATE_TRIES,
             MessageFields.SUFFIX_NUMBER: ARGS.SUFFIX_NUMBER,
@@ -126,6 +151,28 @@ class TCPMessages:
         }
         pair.send_to_remote(json.dumps(res))
 
+    @staticmethod
+    def send_bench(interface: str):
+        pair = CONNECTION_PAIRS[get_ident()]
+        res = {
+            MessageFields.CODE: ActionCodes.BENCH,
+            MessageFields.ERROR_CODE: None,
+            MessageFields.INTERFACE: interface,
+            MessageFields.TOKEN: pair.token,
+            MessageFields.VERSION: VERSION,
+        }
+        pair.send_to_remote(json.dumps(res))
+
+    @staticmethod
+    def send_bench_response(ports: dict):
+        pair = CONNECTION_PAIRS[get_ident()]
+        res = {
+            MessageFields.CODE: ActionCodes.BENCH,
+            MessageFields.ERROR_CODE: None,
+            MessageFields.PORTS: ports,
+        }
+        pair.send_to_remote(json.dumps(res))
+
     @staticmethod
     def send_hello():
         pair = CONNECTION_PAIRS[get_ident()]
@@ -147,10 +194,9 @@ class TCPMessages:
         pair.send_to_remote(json.dumps(res))
 
     @staticmethod
-    def send_upgrade(wgconfig: 'WGConfig'):
-        pair = CONNECTION_PAIRS[get_ident()]
+    def build_upgrade(wgconfig: 'WGConfig', code: ActionCodes = ActionCodes.UPGRADE) -> dict:
         res = {
-            MessageFields.CODE: ActionCodes.UPGRADE,
+            MessageFields.CODE: code,
             MessageFields.ERROR_CODE: None,
             MessageFields.ADDRESSES: [str(ip) for ip in wgconfig.addresses],
             MessageFields.EXPECTED_INTERFACE: wgconfig.expected_interface,
@@ -163,6 +209,20 @@ class TCPMessages:
             MessageFields.PUBKEY: wgconfig.public_key,
             MessageFields.REMOTE_PUBKEY: wgconfig.remote_pubkey,
         }
+        return res
+
+    @classmethod
+    def send_upgrade(cls, wgconfig: 'WGConfig'):
+        pair = CONNECTION_PAIRS[get_ident()]
+        res = cls.build_upgrade(wgconfig)
+        pair.send_to_remote(json.dumps(res))
+
+    @classmethod
+    def send_fast_upgrade(cls, wgconfig: 'WGConfig'):
+        pair = CONNECTION_PAIRS[get_ident()]
+        res = cls.build_upgrade(wgconfig, code=ActionCodes.FAST_UPGRADE)  # Older servers just read it as a TOKEN message
+        res[MessageFields.TOKEN] = pair.token
+        res[MessageFields.VERSION] = VERSION
         pair.send_to_remote(json.dumps(res))
 
     @staticmethod
@@ -278,12 +338,24 @@ class TCPMessages:
 
 
 class Messages:
+    BENCH_COMPARISON = 'wirescale vs {baseline}: {throughput:.2f}x the throughput, {latency:.2f}x the median RTT'
+    BENCH_RUNNING = "Measuring throughput, latency and jitter to peer '{peer_name}' ({peer_ip}) through interface '{interface}' and through Tailscale..."
+    BENCH_SELF_TEST = 'Self-test through a veth pair and a WireGuard tunnel on top of it, in a network namespace of this machine'
+    BENCH_SERVING = "Serving a data plane benchmark to peer '{peer_name}' ({peer_ip}) through interface '{interface}'"
+    BENCH_TITLE = "Data plane benchmark to peer '{peer_name}' ({peer_ip}) through interface '{interface}'"
+    CACHED_ENDPOINT = "Using endpoint {endpoint} for peer '{peer_name}' ({peer_ip}), probed {age:.0f} seconds ago with an RTT of {rtt}"
     CHECKING_CONNECTION = "Checking whether the connection with peer '{peer_name}' ({peer_ip}) is broken..."
     CHECKING_ENDPOINT = "Checking that an endpoint is available for peer '{peer_name}' ({peer_ip})..."
+    COMMANDS_SUMMARY = 'commands count={count} ms={milliseconds:.1f}'
     CONNECTED_UNIX = 'Connection to local UNIX socket established'
     CONNECTING_UNIX = 'Connecting to local UNIX socket...'
     CONNECTION_OK = "Connection with peer '{peer_name}' ({peer_ip}) is fine"
     DEADLOCK = 'Potential deadlock situation identified. Taking actions to avoid it'
+    DEADLOCK_RESOLVED = 'Deadlock resolved: detected {detection:.1f} s after both sessions met, the switched session got the semaphore back {resolution:.1f} s later'
+    DRAIN_ABANDONED = "{sessions} sessions had not finished when the daemon had to stop and were left behind: {ids}"
+    DRAIN_APPLYING = "Waiting up to {timeout:.0f} more seconds for {sessions} sessions that are applying changes"
+    DRAIN_CANCELLING = "Drain deadline of {timeout:g} seconds expired. Cancelling {sessions} sessions that were not applying changes"
+    DRAIN_COMPLETE = "Drain completed in {seconds:.2f} seconds: {rejected} queued sessions rejected, {finished} finished, {cancelled} cancelled and {abandoned} abandoned"
     END_SESSION = "Session finished"
     ENQUEUEING_FROM = "Enqueueing request coming from peer '{peer_name}' ({peer_ip})..."
     ENQUEUEING_REMOTE = "Remote peer '{sender_name}' ({sender_ip}) has enqueued our request"
@@ -292,10 +364,36 @@ class Messages:
     EXCLUSIVE_SEMAPHORE_RECOVER = "The recover request to peer '{peer_name}' ({peer_ip}) for interface '{interface}' has acquired the exclusive semaphore"
     EXCLUSIVE_SEMAPHORE_REMOTE = "Request coming from peer '{peer_name}' ({peer_ip}) has acquired the exclusive semaphore"
     EXCLUSIVE_SEMAPHORE_UPGRADE = "The upgrade request for the peer '{peer_name}' ({peer_ip}) has acquired the exclusive semaphore"
+    FAILOVER_FAILED = "'{interface}' stopped answering"
+    FAILOVER_FASTER = "'{interface}' has been {milliseconds:.0f} ms faster for at least {seconds} seconds"
+    FAILOVER_PREFERRED = "'{interface}' comes first in the candidate list and has been healthy for {seconds} seconds"
+    FAILOVER_STALLED = "Exit node '{interface}' is not answering, but no other failover candidate is healthy either. Keeping it"
+    FAILOVER_SWITCH = "Moving the exit node from '{previous}' to '{interface}': {reason}"
+    FAST_PATH = "Processing the fast path upgrade request coming from peer '{peer_name}' ({peer_ip}) without further round trips"
+    FAST_PATH_FALLBACK = "Request coming from peer '{peer_name}' ({peer_ip}) had to be queued. Falling back to the regular upgrade handshake"
+    FAST_PATH_REMOTE_FALLBACK = "Remote peer '{peer_name}' ({peer_ip}) could not take the fast path. Refreshing the upgrade parameters"
+    FAST_PATH_STALE = "Tailscale was restarted while the fast path upgrade to peer '{peer_name}' ({peer_ip}) was in flight. Refreshing the upgrade parameters"
+    HEARTBEAT_FALSE_ALARM = "Heartbeats with peer {peer_ip} were missed, but the peer is still online. False alarms so far: {false_alarms}"
+    KEEPALIVE_FAILED = "the NAT binding did not survive {seconds} seconds, keeping {margin:.0%} of the last working {good} seconds"
+    KEEPALIVE_NETWORK_CHANGED = 'the uplink changed, so the NAT binding lifetime will be measured again'
+    KEEPALIVE_PROBING = "the NAT binding survived {seconds} seconds, probing a longer lifetime"
+    KEEPALIVE_SET = "Keepalive of interface '{interface}' set to {interval} seconds: {reason}"
+    MONITOR_BROKEN = "Connection through interface '{interface}' appears to be broken: nothing received for {seconds:.0f} seconds"
+    MONITOR_HANDSHAKE_UPDATED = "The latest handshake of interface '{interface}' has been updated, so the connection is not dead"
+    MONITOR_RECHECK_BROKEN = "Nothing was received through interface '{interface}' within {seconds} seconds after the network changed. Recovering it right away"
+    MONITOR_RECOVERING = "Trying to force a new endpoint for interface '{interface}'..."
+    MONITOR_RECREATING = "Creating a new tunnel with the same settings as interface '{interface}'..."
+    MONITOR_REMOVED = "Interface '{interface}' no longer exists. Stopping its monitoring"
+    MONITOR_REMOVING = "Removing interface '{interface}'"
+    MONITOR_WATCHING = "Monitoring the health of interface '{interface}' inside the daemon"
+    NETWORK_CHANGED = "Network changes detected ({changes}). Checking the affected tunnels right away"
     NEW_UNIX_INCOMING = 'New local UNIX connection incoming'
     NEXT_INCOMING = "Request coming from peer '{peer_name}' ({peer_ip}) is the next one in the processing queue"
     NEXT_RECOVER = "The recover request to peer '{peer_name}' ({peer_ip}) for interface '{interface}' is the next one in the processing queue"
     NEXT_UPGRADE = "The upgrade request for the peer '{peer_name}' ({peer_ip}) is the next one in the processing queue"
+    PORT_41641_FREE = 'Port 41641 was free. Tailscale does not need to be restarted'
+    PORT_41641_HELD = 'Port 41641 is already held by a socket kept by systemd. Tailscale does not need to be restarted'
+    PORT_41641_RESTART = 'Port 41641 is in use by Tailscale. Restarting it to release the port'
     REACHABLE = "Peer '{peer_name}' ({peer_ip}) is reachable"
     RECOVER_SUCCES = "Success! WireGuard connection through interface '{interface}' is working again"
     SHUTDOWN_SET = 'The server has been set to shut down'
@@ -304,7 +402,12 @@ class Messages:
     START_PROCESSING_REMOTE = "Remote peer '{sender_name}' ({sender_ip}) has started to process our {{action}} request"
     START_PROCESSING_TO = "Starting to process the upgrade request for the peer '{peer_name}' ({peer_ip})"
     START_PROCESSING_RECOVER = "Starting to process the recover request for the peer '{peer_name}' ({peer_ip}) for interface '{interface}'"
+    STARTUP_TIMING = 'Daemon ready in {total:.3f} s (port 41641: {port:.3f} s, UNIX socket: {unix:.3f} s, TCP server: {tcp:.3f} s)'
+    STATS_EMPTY = 'No upgrade or recover session has finished since the daemon started'
+    STATS_GROUP = '{kind} sessions as {side}: {sessions} recent, {failed} failed'
     SUCCESS = "Success! Now you have a new working P2P connection through interface '{interface}'"
+    TIMING_SPAN = 'span phase={phase} ms={milliseconds:.1f} cpu_ms={cpu:.1f}'
+    TS_OUTAGE = "Tailscale is starting again after being stopped for {milliseconds:.0f} ms to {action} interface '{interface}'"
     VERSION_MISMATCH = "Warning: Your wirescale version doesn't match the remote peer's one ({local_version} ≠ {remote_version}). Errors may occur"
 
     @staticmethod
@@ -353,11 +456,21 @@ class ErrorMessages:
     BAD_FORMAT_PSK = "Error: The pre-shared key has not the correct length or format in file '{config_file}'"
     BAD_FORMAT_PUBKEY = "Error: The public key has not the correct length or format in file '{config_file}'"
     BAD_WS_CONFIG = "Error: Invalid value for the '{field}' field in the 'Wirescale' section of file '{config_file}'"
+    BENCH_NO_TUNNEL = "Error: Interface '{interface}' is not a tunnel set up by wirescale"
+    BENCH_REMOTE_NO_TUNNEL = "Error: Peer '{peer_name}' ({peer_ip}) asked for a benchmark through interface '{interface}', which is not a tunnel with them"
+    BENCH_SELF_TEST = "Error: The self-test could not set up its network: '{command}' failed: {error}"
     CANT_DECRYPT = "Error: Couldn't decrypt the recover message sent by remote peer '{peer_name}' ({peer_ip})"
     CLOSED = 'Error: Wirescale is shutting down and is no longer accepting new requests'
     CLOSING_SOCKET = "Error: Connection is broken. Closing socket"
     CONFIG_PATH_ERROR = "Error: Cannot locate a configuration file for peer '{peer_name}' in '/etc/wirescale/'"
     CONNECTION_LOST = "Error: Connection with remote peer '{peer_name}' ({peer_ip}) has been lost. Aborting pending operations"
+    DRAIN_CANCELLED = "Error: Wirescale is shutting down and this request did not finish before the drain deadline"
+    ENDPOINT_NOT_APPLIED = "Error: WireGuard interface '{interface}' could not take over port {port} and endpoint {endpoint}"
+    ENDPOINT_REFRESH = "Error: Refreshing the cached endpoints failed, trying again in {interval:g} seconds: {error}"
+    EXIT_CODES = {ErrorCodes.CONFIG_PATH_ERROR: 3, ErrorCodes.HANDSHAKE_MISMATCH: 5, ErrorCodes.INTERFACE_EXISTS: 2, ErrorCodes.INVALID_PEER: 2, ErrorCodes.TS_UNREACHABLE: 4}
+    EXIT_NODE_BAD_PREFIX = "Error: '{prefix}' in file '{file}' is not a valid IPv4 prefix"
+    EXIT_NODE_NO_PRIORITY = "Error: There are no free rule priorities left to route the traffic of interface '{interface}' around the exit node"
+    EXIT_NODE_ROLLBACK = "Error: The routing rules for exit node '{interface}' could not be applied, so every change has been rolled back"
     FINAL_ERROR = 'Something went wrong and, finally, it was not possible to establish the P2P connection'
     HANDSHAKE_FAILED = "Error: Handshake with interface '{interface}' failed"
     HANDSHAKE_FAILED_RECOVER = "Error: Handshake with interface '{interface}' failed after changing its endpoint"
@@ -366,10 +479,15 @@ class ErrorMessages:
     INTERFACE_NOT_FOUND = "Error: Interface '{interface}' not found"
     IP_MISMATCH = "Error: Remote peer '{peer_name}' ({peer_ip}) IP address mismatch with the 'autoremove-{interface}' systemd unit's registered IP ({autoremove_ip})"
     LATEST_HANDSHAKE_MISMATCH = "Error: The latest handshake of interface '{interface}' has been updated since the recover request was made. Discarding request"
+    METRICS_PORT = 'Error: The metrics endpoint cannot listen on 127.0.0.1:{port}: {error}'
     MISSING_ADDRESS = "Error: 'Address' option missing in 'Interface' section of file '{config_file}'"
     MISSING_ALLOWEDIPS = "Error: 'AllowedIPs' option missing in 'Peer' section of file '{config_file}'"
     MISSING_UNIT = "Error: systemd unit '{unit}' is not active"
+    MONITOR_RECOVER_FAILED = "Error: It was impossible to recover the connection through interface '{interface}'"
+    MONITOR_UNREACHABLE = "Error: The peer at the other end of interface '{interface}' is currently unreachable. Will try again in {seconds} seconds..."
     MTU_NOT_CHANGED = "Error: Could not assign the new MTU of '{mtu}' to the interface '{interface}'"
+    NETLINK_FAILED = "Error: Listening for network changes failed: {error}. Checking every tunnel and listening again in {seconds} seconds..."
+    OWN_PEER = "Error: '{peer}' is this very machine. You should not connect to your own machine"
     PORT_MISMATCH = "Error: WireGuard interface '{interface}' is not listening on port {port}"
     PSK_MISMATCH = ("Error: Peer '{name_without_psk}' ({ip_without_psk}) does not have a pre-shared key for '{name_with_psk}' ({ip_with_psk}), but '{name_with_psk}' has one configured for "
                     "'{name_without_psk}'. Ensure key consistency.")
@@ -379,10 +497,12 @@ class ErrorMessages:
     REMOTE_BAD_FORMAT_PSK = "Error: The pre-shared key has not the correct length or format in remote peer '{my_name}' ({my_ip}) configuration file for '{peer_name}'"
     REMOTE_BAD_FORMAT_PUBKEY = "Error: The public key has not the correct length or format in remote peer '{my_name}' ({my_ip}) configuration file for '{peer_name}'"
     REMOTE_BAD_WS_CONFIG = "Error: Invalid value for the '{field}' field in the 'Wirescale' section in remote peer '{my_name}' ({my_ip}) configuration file for '{peer_name}'"
+    REMOTE_BENCH_NO_TUNNEL = "Error: Remote peer '{my_name}' ({my_ip}) does not have a tunnel named '{interface}' with us"
     REMOTE_CANT_DECRYPT = "Error: Remote peer '{my_name}' ({my_ip}) couldn't decrypt our recover message"
     REMOTE_CLOSED = "Error: Wirescale instance at '{my_name}' ({my_ip}) has been set to stop receiving requests"
     REMOTE_CONFIG_ERROR = "Error: Remote peer '{my_name}' ({my_ip}) has a syntax error in its configuration file for '{peer_name}'"
     REMOTE_CONFIG_PATH_ERROR = "Error: Remote peer '{my_name}' ({my_ip}) cannot locate a configuration file for peer '{peer_name}'"
+    REMOTE_DRAIN_CANCELLED = "Error: Wirescale instance at '{my_name}' ({my_ip}) is shutting down and cancelled this request"
     REMOTE_INTERFACE_EXISTS = "Error: A network interface '{interface}' already exists in remote peer '{my_name}' ({my_ip})"
     REMOTE_INTERFACE_MISMATCH = "Error: Remote peer '{my_name}' ({my_ip}) is not assigning the expected name '{interface}' to its network interface"
     REMOTE_IP_MISMATCH = "Error: Remote peer '{my_name}' ({my_ip}) has registered a different IP address in its 'autoremove-{interface}' systemd unit than ours ({peer_ip})"
@@ -399,6 +519,7 @@ class ErrorMessages:
     SOCKET_REMOTE_ERROR = "Error: Remote peer '{peer_name}' ({peer_ip}) has closed the connection. Aborting pending operations"
     SOCKET_ERROR = "Error: The program has been closed. Aborting pending operations"
     SUDO = 'Error: This program must be run as a superuser'
+    SYSTEMD_BUS = "Error: systemd did not complete the request over D-Bus: {error}"
     TS_COORD_OFFLINE = "Error: Tailscale has no state; the coordination server may not be reachable"
     TS_PEER_OFFLINE = "Error: Peer '{peer_name}' ({peer_ip}) is offline"
     TS_SYSTEMD_STOPPED = "Error: 'tailscaled.service' is stopped. Start the service with systemd"
@@ -411,6 +532,7 @@ class ErrorMessages:
     TS_NOT_RECOVERED = "Error: Either this tailscale instance or '{peer_name}' ({peer_ip}) one has not fully recovered and cannot reestablish the connection"
     TS_NOT_RUNNING = 'Error: Tailscale is not running'
     UNIX_SOCKET = "Error: Couldn't connect to the local UNIX socket"
+    UNKNOWN_PEER = "Error: No peer in the tailnet matches '{peer}'"
     WG_INTERFACE_MISSING = "Error: WireGuard interface '{interface}' does not exist"
 
     @staticmethod
@@ -424,7 +546,7 @@ class ErrorMessages:
 
     @classmethod
     def process_error_message(cls, message: dict):
-        from wirescale.parsers.parsers import interface_argument, upgrade_subparser
+        from wirescale.parsers.parsers import interface_argument, peer_argument, upgrade_subparser
         pair = CONNECTION_PAIRS[get_ident()]
         if error_code := message[MessageFields.ERROR_CODE]:
             text = message[MessageFields.ERROR_MESSAGE]
@@ -435,14 +557,10 @@ class ErrorMessages:
                 match error_code:
                     case ErrorCodes.INTERFACE_EXISTS:
                         upgrade_subparser.error(str(ArgumentError(interface_argument, text[16:])))  # exit code 2
-                    case ErrorCodes.CONFIG_PATH_ERROR:
-                        cls.send_error_message(local_message=text, send_to_local=False, exit_code=3)
-                    case ErrorCodes.TS_UNREACHABLE:
-                        cls.send_error_message(local_message=text, send_to_local=False, exit_code=4)
-                    case ErrorCodes.HANDSHAKE_MISMATCH:
-                        cls.send_error_message(local_message=text, send_to_local=False, exit_code=5)
+                    case ErrorCodes.INVALID_PEER:
+                        upgrade_subparser.error(str(ArgumentError(peer_argument, text.removeprefix('Error: '))))  # exit code 2
                     case _:
-                        cls.send_error_message(local_message=text, send_to_local=False, exit_code=1)
+                        cls.send_error_message(local_message=text, send_to_local=False, exit_code=cls.EXIT_CODES.get(error_code, 1))
 
     @classmethod
     def send_error_message(cls, local_message: str = None, remote_message: str = None, error_code: ErrorCodes = ErrorCodes.GENERIC, remote_code: ErrorCodes = ErrorCodes.GENERIC,
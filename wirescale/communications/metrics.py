@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+
+import sys
+from bisect import bisect_left
+from contextlib import contextmanager, suppress
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from time import time
+from typing import Dict, List, Tuple
+
+from parallel_utils.thread import create_thread
+
+from wirescale.communications.commands import COMMANDS
+from wirescale.communications.common import CONNECTION_PAIRS, Semaphores, SessionStates, SESSIONS_CHANGED
+from wirescale.communications.messages import ErrorMessages
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', DaemonMetrics.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DaemonMetrics:
+    BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+    CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+    def __init__(self):
+        self.lock = Lock()
+        self.waiting: Dict[Semaphores, int] = dict.fromkeys(Semaphores, 0)
+        self.outcomes: Dict[Tuple[str, str, str], int] = {}
+        self.durations: Dict[Tuple[str, str], Tuple[List[int], float]] = {}
+        self.server: ThreadingHTTPServer = None
+
+    def serve(self, port: int):
+        try:
+            self.server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+        except (OSError, OverflowError) as error:
+            print(ErrorMessages.METRICS_PORT.format(port=port, error=error), file=sys.stderr, flush=True)
+            sys.exit(1)
+        self.server.daemon_threads = True
+        create_thread(self.server.serve_forever)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    @contextmanager
+    def queued(self, semaphore: Semaphores):
+        with self.lock:
+            self.waiting[semaphore] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.waiting[semaphore] -= 1
+
+    def session_finished(self, kind: str, side: str, ok: bool, seconds: float):
+        with self.lock:
+            outcome = (kind, side, 'success' if ok else 'failure')
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            buckets, total = self.durations.get((kind, side), ([0] * (len(self.BUCKETS) + 1), 0))
+            buckets[bisect_left(self.BUCKETS, seconds)] += 1
+            self.durations[(kind, side)] = (buckets, total + seconds)
+
+    @staticmethod
+    def family(lines: List[str], name: str, kind: str, text: str, samples: List[Tuple[str, Dict[str, str], float]]):
+        lines.append(f'# TYPE {name} {kind}')
+        lines.append(f'# HELP {name} {text}')
+        for suffix, labels, value in samples:
+            labels = ','.join(f'{key}="{label}"' for key, label in labels.items())
+            lines.append(f'{name}{suffix}{{{labels}}} {value}' if labels else f'{name}{suffix} {value}')
+
+    def render(self) -> str:
+        from wirescale.vpn.monitor import TUNNEL_MONITOR
+        from wirescale.vpn.tsmanager import TSManager
+        from wirescale.vpn.watch import ACTIVE_SOCKETS
+        with self.lock:
+            waiting, outcomes = dict(self.waiting), dict(self.outcomes)
+            durations = {key: (list(buckets), total) for key, (buckets, total) in self.durations.items()}
+        with SESSIONS_CHANGED:
+            states = [pair.state for pair in CONNECTION_PAIRS.values()]
+        with TUNNEL_MONITOR.lock:
+            tunnels = {interface: (tunnel.config.remote_pubkey, TUNNEL_MONITOR.recovers.get(interface, 0)) for interface, tunnel in TUNNEL_MONITOR.tunnels.items()}
+            peers = TUNNEL_MONITOR.peers
+        lines = []
+        self.family(lines, 'wirescale_semaphore_waiting', 'gauge', 'Sessions waiting to acquire each semaphore',
+                    [('', {'semaphore': semaphore.name.lower()}, count) for semaphore, count in waiting.items()])
+        self.family(lines, 'wirescale_sessions_active', 'gauge', 'Upgrade and recover sessions currently handled by the daemon',
+                    [('', {'state': state.name.lower()}, states.count(state)) for state in SessionStates])
+        self.family(lines, 'wirescale_sessions', 'counter', 'Finished upgrade and recover sessions',
+                    [('_total', {'kind': kind, 'side': side, 'outcome': outcome}, count) for (kind, side, outcome), count in sorted(outcomes.items())])
+        samples = []
+        for (kind, side), (buckets, total) in sorted(durations.items()):
+            cumulative = 0
+            for bound, count in zip((*self.BUCKETS, '+Inf'), buckets):
+                cumulative += count
+                samples.append(('_bucket', {'kind': kind, 'side': side, 'le': str(bound)}, cumulative))
+            samples.append(('_count', {'kind': kind, 'side': side}, cumulative))
+            samples.append(('_sum', {'kind': kind, 'side': side}, round(total, 6)))
+        self.family(lines, 'wirescale_session_duration_seconds', 'histogram', 'Duration of the finished upgrade and recover sessions', samples)
+        commands = COMMANDS.snapshot()
+        self.family(lines, 'wirescale_commands', 'counter', 'External commands run by the daemon',
+                    [('_total', {'command': command}, count) for command, (count, _, _) in sorted(commands.items())])
+        self.family(lines, 'wirescale_command_seconds', 'counter', 'Time spent waiting for external commands',
+                    [('_total', {'command': command}, round(seconds, 6)) for command, (_, seconds, _) in sorted(commands.items())])
+        self.family(lines, 'wirescale_command_failures', 'counter', 'External commands that exited with a non-zero code',
+                    [('_total', {'command': command}, failures) for command, (_, _, failures) in sorted(commands.items())])
+        self.family(lines, 'wirescale_deadlocks', 'counter', 'Deadlocks between a local and a remote session solved by switching the exclusive semaphore',
+                    [('_total', {}, ACTIVE_SOCKETS.deadlocks)])
+        self.family(lines, 'wirescale_deadlock_detection_seconds', 'counter', 'Time deadlocked sessions waited before the switch',
+                    [('_total', {}, round(ACTIVE_SOCKETS.detection_seconds, 6))])
+        self.family(lines, 'wirescale_deadlock_resolution_seconds', 'counter', 'Time switched sessions waited to get the exclusive semaphore back',
+                    [('_total', {}, round(ACTIVE_SOCKETS.resolution_seconds, 6))])
+        self.family(lines, 'wirescale_tailscaled_restarts', 'counter', 'Times tailscaled has been stopped to set up or recover a tunnel',
+                    [('_total', {}, TSManager.STOPS)])
+        self.family(lines, 'wirescale_tailscaled_downtime_seconds', 'counter', 'Time tailscaled has spent stopped to set up or recover a tunnel',
+                    [('_total', {}, round(TSManager.DOWNTIME, 6))])
+        handshakes, received, sent, recovers = [], [], [], []
+        for interface, (pubkey, attempts) in sorted(tunnels.items()):
+            recovers.append(('_total', {'interface': interface}, attempts))
+            with suppress(KeyError):
+                latest_handshake, rx, tx = peers[interface][pubkey]
+                received.append(('_total', {'interface': interface}, rx))
+                sent.append(('_total', {'interface': interface}, tx))
+                if latest_handshake:
+                    handshakes.append(('', {'interface': interface}, round(time() - latest_handshake)))
+        self.family(lines, 'wirescale_tunnel_handshake_age_seconds', 'gauge', 'Seconds since the latest handshake of each monitored tunnel', handshakes)
+        self.family(lines, 'wirescale_tunnel_receive_bytes', 'counter', 'Bytes received through each monitored tunnel', received)
+        self.family(lines, 'wirescale_tunnel_transmit_bytes', 'counter', 'Bytes sent through each monitored tunnel', sent)
+        self.family(lines, 'wirescale_tunnel_recover_attempts', 'counter', 'Recover attempts started by the daemon for each monitored tunnel', recovers)
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = DaemonMetrics()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+
+import json
+from contextlib import suppress
+from ipaddress import IPv4Address
+from queue import Empty, Queue
+from threading import Event, Lock
+from time import monotonic, sleep
+from typing import Callable, Dict, Iterator
+from uuid import uuid4
+
+from parallel_utils.thread import create_thread
+from websockets import ConnectionClosed, ConnectionClosedError, ConnectionClosedOK, Data
+from websockets.sync.client import ClientConnection, connect
+from websockets.sync.connection import Connection
+
+from wirescale.communications.common import SHUTDOWN, TCP_PORT
+from wirescale.communications.heartbeat import Heartbeat
+from wirescale.communications.messages import MessageFields
+from wirescale.vpn.tsmanager import TSManager
+
+MUX_SUBPROTOCOL = 'wirescale-mux'
+
+
+class MuxStream:
+    def __init__(self, connection: 'MuxConnection', stream_id: str):
+        self.connection = connection
+        self.id = stream_id
+        self.messages: Queue = Queue()
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self) -> Iterator[Data]:
+        while True:
+            try:
+                yield self.recv()
+            except ConnectionClosedOK:
+                return
+
+    @property
+    def heartbeat(self) -> Heartbeat:
+        return self.connection.heartbeat
+
+    @property
+    def remote_address(self):
+        return self.connection.websocket.remote_address
+
+    def recv(self, timeout: float = None) -> Data:
+        try:
+            message = self.messages.get(timeout=timeout)
+        except Empty:
+            raise TimeoutError
+        if isinstance(message, ConnectionClosed):
+            self.messages.put(message)
+            raise message
+        return message
+
+    def send(self, message: Data):
+        if self.closed or not self.connection.is_alive():
+            raise ConnectionClosedError(None, None)
+        self.connection.send_frame(self.id, message)
+
+    def ping(self) -> Event:
+        return self.connection.websocket.ping()
+
+    def terminate(self, reason: ConnectionClosed):
+        self.closed = True
+        self.messages.put(reason)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            with suppress(ConnectionClosed):
+                self.connection.send_frame(self.id, None)
+        self.connection.release(self)
+
+
+class MuxConnection:
+    def __init__(self, websocket: Connection, handler: Callable[[MuxStream], None] = None):
+        self.websocket = websocket
+        self.handler = handler
+        self.streams: Dict[str, MuxStream] = {}
+        self.lock = Lock()
+        self.closed = Event()
+        self.close_when_idle = False
+        self.last_used = monotonic()
+        self.heartbeat = Heartbeat(websocket, shared=True)
+
+    def is_alive(self) -> bool:
+        return not self.closed.is_set()
+
+    def is_healthy(self) -> bool:
+        return self.is_alive() and self.heartbeat.healthy()
+
+    def is_idle(self) -> bool:
+        with self.lock:
+            return not self.streams
+
+    def add_stream(self, stream_id: str) -> MuxStream:
+        stream = MuxStream(self, stream_id)
+        with self.lock:
+            self.streams[stream_id] = stream
+            self.last_used = monotonic()
+        return stream
+
+    def open_stream(self) -> MuxStream:
+        return self.add_stream(uuid4().hex)
+
+    def release(self, stream: MuxStream):
+        with self.lock:
+            self.streams.pop(stream.id, None)
+            self.last_used = monotonic()
+            idle = not self.streams
+        if idle and self.close_when_idle:
+            self.close()
+
+    def send_frame(self, stream_id: str, payload: Data | None):
+        frame = {MessageFields.STREAM: stream_id, MessageFields.PAYLOAD: payload}
+        self.websocket.send(json.dumps(frame))
+
+    def read(self):
+        try:
+            for frame in self.websocket:
+                frame = json.loads(frame)
+                stream_id, payload = frame[MessageFields.STREAM], frame[MessageFields.PAYLOAD]
+                with self.lock:
+                    stream = self.streams.get(stream_id)
+                if stream is None:
+                    if payload is None or self.handler is None:
+                        continue
+                    stream = self.add_stream(stream_id)
+                    create_thread(self.handler, stream)
+                if payload is None:
+                    stream.terminate(ConnectionClosedOK(None, None))
+                else:
+                    stream.messages.put(payload)
+        except ConnectionClosed:
+            pass
+        finally:
+            self.closed.set()
+            self.heartbeat.stop()
+            with self.lock:
+                streams = tuple(self.streams.values())
+            for stream in streams:
+                stream.terminate(ConnectionClosedError(None, None))
+
+    def close(self):
+        with suppress(BaseException):
+            self.websocket.close()
+
+    def close_after_sessions(self):
+        self.close_when_idle = True
+        if self.is_idle():
+            self.close()
+
+
+class ConnectionPool:
+    CONNECT_TRIES = 4
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 30
+    HEALTH_INTERVAL = 30
+    IDLE_TIMEOUT = 15 * 60
+
+    def __init__(self):
+        self.connections: Dict[IPv4Address, MuxConnection] = {}
+        self.failures: Dict[IPv4Address, int] = {}
+        self.locks: Dict[IPv4Address, Lock] = {}
+        self.lock = Lock()
+        self.health_thread = None
+
+    def peer_lock(self, peer_ip: IPv4Address) -> Lock:
+        with self.lock:
+            return self.locks.setdefault(peer_ip, Lock())
+
+    def backoff(self, peer_ip: IPv4Address) -> float:
+        with self.lock:
+            return min(self.BACKOFF_BASE * 2 ** self.failures.get(peer_ip, 0), self.BACKOFF_MAX)
+
+    def failed(self, peer_ip: IPv4Address):
+        with self.lock:
+            self.failures[peer_ip] = self.failures.get(peer_ip, 0) + 1
+
+    def succeeded(self, peer_ip: IPv4Address):
+        with self.lock:
+            self.failures.pop(peer_ip, None)
+
+    def connect(self, peer_ip: IPv4Address) -> MuxConnection | ClientConnection | None:
+        for i in range(self.CONNECT_TRIES):
+            try:
+                # The peer identifies us by the source address, so it must be our Tailscale IP even when the routes would pick another one
+                websocket = connect(uri=f'ws://{peer_ip}:{TCP_PORT}', subprotocols=[MUX_SUBPROTOCOL], source_address=(str(TSManager.my_ip()), 0))
+            except (TimeoutError, ConnectionResetError):
+                if i == self.CONNECT_TRIES - 1:
+                    return None
+                sleep(self.backoff(peer_ip))
+                self.failed(peer_ip)
+                continue
+            self.succeeded(peer_ip)
+            if websocket.subprotocol != MUX_SUBPROTOCOL:  # The remote daemon predates multiplexing
+                return websocket
+            connection = MuxConnection(websocket)
+            create_thread(connection.read)
+            return connection
+
+    def stream(self, peer_ip: IPv4Address) -> MuxStream | ClientConnection | None:
+        with self.peer_lock(peer_ip):
+            connection = self.connections.get(peer_ip)
+            if connection is not None and connection.is_alive() and not connection.is_healthy():
+                connection.close_after_sessions()  # A late pong must not kill the sessions still running on it, so it is only retired
+                connection = None
+            if connection is None or not connection.is_alive():
+                connection = self.connect(peer_ip)
+                if not isinstance(connection, MuxConnection):
+                    return connection
+                self.connections[peer_ip] = connection
+                self.start_health_checks()
+            return connection.open_stream()
+
+    def start_health_checks(self):
+        with self.lock:
+            if self.health_thread is None:
+                self.health_thread = create_thread(self.health_checks)
+
+    def health_checks(self):
+        while not SHUTDOWN.wait(timeout=self.HEALTH_INTERVAL):
+            for peer_ip, connection in tuple(self.connections.items()):
+                if not connection.is_idle():
+                    continue
+                expired = monotonic() - connection.last_used > self.IDLE_TIMEOUT
+                if expired or not connection.is_healthy():
+                    with self.peer_lock(peer_ip):  # Streams are only opened under this lock, so the connection cannot get busy meanwhile
+                        if not connection.is_idle():
+                            continue
+                        if self.connections.get(peer_ip) is connection:
+                            del self.connections[peer_ip]
+                        connection.close()
+
+    def close(self):
+        for connection in tuple(self.connections.values()):
+            connection.close_after_sessions()
+        self.connections.clear()
+
+
+CONNECTION_POOL = ConnectionPool()
@@ -3,14 +3,20 @@
 
 
 import functools
+import os
 import re
+import socket
 import subprocess
+import sys
+from array import array
 from ipaddress import IPv4Address
 from threading import get_ident
 from time import sleep
-from typing import Tuple, TYPE_CHECKING, Union
+from typing import Any, Callable, Dict, List, Tuple, TYPE_CHECKING, Union
 
+from wirescale.communications.commands import COMMANDS
 from wirescale.communications.common import CONNECTION_PAIRS
+from wirescale.communications.dbus import DBusError, DBusUnavailable, SystemdBus
 
 if TYPE_CHECKING:
     from wirescale.communications.connection_pair import ConnectionPair
@@ -19,6 +25,8 @@ if TYPE_CHECKING:
 
 
 class Systemd:
+    LISTEN_FDS_START = 3
+
     def __init__(self):
         self.interface: str = None
         self.suffix: int = None
@@ -40,31 +48,51 @@ class Systemd:
 
     @classmethod
     def create_from_autoremove(cls, unit: str) -> 'Systemd':
-        args = cls.parse_args(unit)
+        if (tunnel := cls.stored(unit)) is not None:
+            return tunnel
+        return cls.create_from_args(cls.parse_args(unit))
+
+    @classmethod
+    def create_from_record(cls, record: Dict[str, Any]) -> 'Systemd':
         res = cls()
-        res.interface = args[1]
-        res.suffix = int(args[2])
-        res.ts_ip = IPv4Address(args[3])
-        res.remote_pubkey = args[4]
-        res.wg_ip = IPv4Address(args[5])
-        res.running_in_remote = bool(int(args[6]))
-        res.start_time = int(args[7])
-        res.local_port = int(args[8])
-        res.local_ext_port = int(args[9])
-        res.nat = bool(int(args[10]))
-        res.remote_interface = args[11]
-        res.remote_local_port = int(args[12])
-        res.iptables_accept = bool(int(args[13]))
-        res.iptables_forward = bool(int(args[14]))
-        res.iptables_masquerade = bool(int(args[15]))
-        res.recover_tries = int(args[16])
-        res.recreate_tries = int(args[17])
+        res.__dict__.update(record)
+        res.ts_ip, res.wg_ip = IPv4Address(record['ts_ip']), IPv4Address(record['wg_ip'])
+        return res
+
+    def record(self) -> Dict[str, Any]:
+        return {**vars(self), 'ts_ip': str(self.ts_ip), 'wg_ip': str(self.wg_ip)}
+
+    @staticmethod
+    def stored(unit: str) -> Union['Systemd', None]:
+        from wirescale.vpn.tunnels import TUNNELS
+        return TUNNELS.get(unit.removeprefix('autoremove-').removesuffix('.service'))
+
+    @classmethod
+    def create_from_args(cls, args: Tuple[str, ...]) -> 'Systemd':
+        res = cls()
+        res.interface = args[0]
+        res.suffix = int(args[1])
+        res.ts_ip = IPv4Address(args[2])
+        res.remote_pubkey = args[3]
+        res.wg_ip = IPv4Address(args[4])
+        res.running_in_remote = bool(int(args[5]))
+        res.start_time = int(args[6])
+        res.local_port = int(args[7])
+        res.local_ext_port = int(args[8])
+        res.nat = bool(int(args[9]))
+        res.remote_interface = args[10]
+        res.remote_local_port = int(args[11])
+        res.iptables_accept = bool(int(args[12]))
+        res.iptables_forward = bool(int(args[13]))
+        res.iptables_masquerade = bool(int(args[14]))
+        res.recover_tries = int(args[15])
+        res.recreate_tries = int(args[16])
         return res
 
     @classmethod
     def check_active(cls, unit: str):
         from wirescale.communications.messages import ErrorMessages
-        if not cls.is_active(unit):
+        if cls.stored(unit) is None and not cls.is_active(unit):
             pair = CONNECTION_PAIRS.get(get_ident())
             error = ErrorMessages.MISSING_UNIT.format(unit=unit)
             error_remote = None
@@ -73,43 +101,89 @@ class Systemd:
             ErrorMessages.send_error_message(local_message=error, remote_message=error_remote)
 
     @staticmethod
+    def over_bus(action: Callable[[SystemdBus], Any], failed: Any = None) -> Any:
+        try:
+            bus = SystemdBus()
+        except DBusUnavailable:  # Only then is systemctl run instead: once systemd got the request, running it again could restart or stop a unit twice
+            return None
+        with bus:
+            try:
+                return action(bus)
+            except (OSError, DBusError) as error:
+                from wirescale.communications.messages import ErrorMessages
+                print(ErrorMessages.SYSTEMD_BUS.format(error=' '.join(str(arg) for arg in error.args) or repr(error)), file=sys.stderr, flush=True)
+                return failed
+
+    @classmethod
     @functools.cache
-    def get_slice(unit: str) -> str:
+    def get_slice(cls, unit: str) -> str:
+        if (control_group := cls.over_bus(lambda bus: bus.properties(f'{unit}.service', SystemdBus.SERVICE)['ControlGroup'], failed='')) is not None:
+            return control_group
         command = ['systemctl', 'show', '-p', 'ControlGroup', '--value', f'{unit}.service']
-        return subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8').stdout.strip()
+        return COMMANDS.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8').stdout.strip()
 
-    @staticmethod
-    def is_active(unit: str) -> bool:
-        is_active = subprocess.run(['systemctl', 'is-active', unit], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+    @classmethod
+    def is_active(cls, unit: str) -> bool:
+        if (is_active := cls.over_bus(lambda bus: bus.is_active(unit), failed=False)) is not None:
+            return is_active
+        is_active = COMMANDS.run(['systemctl', 'is-active', unit], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
         return is_active == 0
 
+    @classmethod
+    @functools.cache
+    def listen_fds(cls) -> Dict[int, Tuple[str, socket.socket]]:
+        if os.environ.get('LISTEN_PID') != str(os.getpid()):
+            return {}
+        names = os.environ.get('LISTEN_FDNAMES', '').split(':')
+        fds = range(cls.LISTEN_FDS_START, cls.LISTEN_FDS_START + int(os.environ.get('LISTEN_FDS', 0)))
+        return {fd: (names[i] if i < len(names) else 'unknown', socket.socket(fileno=fd)) for i, fd in enumerate(fds)}
+
     @staticmethod
-    def restart(unit: str) -> bool:
-        restart = subprocess.run(['systemctl', 'restart', unit], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+    def notify(*states: str, fds: List[int] = None) -> bool:
+        address = os.environ.get('NOTIFY_SOCKET')
+        if not address:
+            return False
+        if address.startswith('@'):
+            address = '\0' + address[1:]
+        ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array('i', fds))] if fds else []
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC) as notify_socket:
+            notify_socket.sendmsg(['\n'.join(states).encode()], ancillary, 0, address)
+        return True
+
+    @classmethod
+    def main_pid(cls, unit: str) -> int:
+        if (main_pid := cls.over_bus(lambda bus: bus.properties(unit, SystemdBus.SERVICE)['MainPID'], failed=0)) is not None:
+            return main_pid
+        main_pid = COMMANDS.run(['systemctl', 'show', '-p', 'MainPID', unit], capture_output=True, text=True).stdout.strip()
+        return int(main_pid.replace('MainPID=', '') or 0)
+
+    @classmethod
+    def restart(cls, unit: str) -> bool:
+        if (restart := cls.over_bus(lambda bus: bus.restart(unit), failed=False)) is not None:
+            return restart
+        restart = COMMANDS.run(['systemctl', 'restart', unit], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
         return restart == 0
 
-    @staticmethod
-    def start(unit: str) -> bool:
-        start = subprocess.run(['systemctl', 'start', unit], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+    @classmethod
+    def start(cls, unit: str) -> bool:
+        if (start := cls.over_bus(lambda bus: bus.start(unit), failed=False)) is not None:
+            return start
+        start = COMMANDS.run(['systemctl', 'start', unit], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
         return start == 0
 
-    @staticmethod
-    def stop(unit: str) -> bool:
-        stop = subprocess.run(['systemctl', 'stop', unit], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+    @classmethod
+    def stop(cls, unit: str) -> bool:
+        if (stop := cls.over_bus(lambda bus: bus.stop(unit), failed=False)) is not None:
+            return stop
+        stop = COMMANDS.run(['systemctl', 'stop', unit], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
         return stop == 0
 
     @classmethod
     def launch_autoremove(cls, config: Union['WGConfig', 'RecoverConfig'], pair: 'ConnectionPair'):
         from wirescale.communications.messages import Messages
+        from wirescale.parsers.args import ARGS
+        from wirescale.vpn.tunnels import TUNNELS
         unit = f'autoremove-{config.interface}.service'
-        tries, is_active = 20, True
-        while is_active and tries > 0:
-            is_active = cls.is_active(unit)
-            tries -= 1
-            sleep(1)
-        subprocess.run(['systemctl', 'stop', unit], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        subprocess.run(['systemctl', 'reset-failed', unit], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
         remote_pubkey: str = config.remote_pubkey_str if hasattr(config, 'remote_pubkey_str') else config.remote_pubkey
         wg_ip: IPv4Address = config.wg_ip if hasattr(config, 'wg_ip') else next(ip for ip in config.remote_addresses)
         running_in_remote: bool = config.running_in_remote if hasattr(config, 'running_in_remote') else pair.running_in_remote
@@ -117,15 +191,53 @@ class Systemd:
         args = [config.interface, str(config.suffix), str(pair.peer_ip), remote_pubkey, str(wg_ip), str(int(running_in_remote)), str(config.start_time), str(listen_port),
                 str(config.listen_ext_port), str(int(config.nat)), config.remote_interface, str(config.remote_local_port), str(int(config.iptables_accept)),
                 str(int(config.iptables_forward)), str(int(config.iptables_masquerade)), str(config.recover_tries), str(config.recreate_tries)]
+        tunnel = cls.create_from_args(tuple(args))
+        TUNNELS.put(tunnel)
+        if not ARGS.AUTOREMOVE_UNITS:
+            from wirescale.vpn.monitor import TUNNEL_MONITOR
+            TUNNEL_MONITOR.register(tunnel)
+            Messages.send_info_message(local_message=Messages.MONITOR_WATCHING.format(interface=config.interface))
+            return
+
+        argv = ['/bin/sh', '/run/wirescale/wirescale-autoremove', 'start', *args]
+        if (launched := cls.over_bus(lambda bus: cls.launch_unit(bus, unit, argv), failed=False)) is not None:
+            output = f'Running as unit: {unit}' if launched else f'Failed to start transient service unit {unit}'
+        else:
+            tries, is_active = 20, True
+            while is_active and tries > 0:
+                is_active = cls.is_active(unit)
+                tries -= 1
+                sleep(1)
+            COMMANDS.run(['systemctl', 'stop', unit], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            COMMANDS.run(['systemctl', 'reset-failed', unit], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            output = COMMANDS.run(['systemd-run', '-u', unit, *argv], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True).stdout.strip()
+        Messages.send_info_message(local_message=f'Launching autoremove subprocess. {output}')
 
-        systemd = subprocess.run(['systemd-run', '-u', unit, '/bin/sh', '/run/wirescale/wirescale-autoremove', 'start', *args],
-                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-        Messages.send_info_message(local_message=f'Launching autoremove subprocess. {systemd.stdout.strip()}')
+    @staticmethod
+    def launch_unit(bus: SystemdBus, unit: str, argv: List[str]) -> bool:
+        bus.wait_inactive(unit, timeout=20)
+        bus.stop(unit)
+        bus.reset_failed(unit)
+        return bus.start_transient(unit, argv)
+
+    @classmethod
+    def stop_autoremove(cls, interface: str):
+        from wirescale.parsers.args import ARGS
+        if ARGS.AUTOREMOVE_UNITS:
+            cls.stop(f'autoremove-{interface}.service')
+        else:
+            from wirescale.vpn.monitor import TUNNEL_MONITOR
+            TUNNEL_MONITOR.unregister(interface)
 
     @classmethod
     def parse_args(cls, unit: str) -> Tuple[str, ...]:
-        exec_start = subprocess.run(['systemctl', 'show', '-p', 'ExecStart', unit], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip()
+        if (exec_start := cls.over_bus(lambda bus: bus.properties(unit, SystemdBus.SERVICE)['ExecStart'], failed=[])) is not None:
+            argv = exec_start[0][1] if exec_start else []
+            if 'start' not in argv:
+                cls.check_active(unit)
+            return tuple(argv[argv.index('start') + 1:])
+        exec_start = COMMANDS.run(['systemctl', 'show', '-p', 'ExecStart', unit], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip()
         if not exec_start:
             cls.check_active(unit)
-        args = re.search(r'(\sstart.*?);', exec_start).group(1).strip().split()
+        args = re.search(r'\sstart(.*?);', exec_start).group(1).strip().split()
         return tuple(args)
@@ -8,18 +8,23 @@ import sys
 from contextlib import ExitStack
 from ipaddress import ip_address, IPv4Address
 from threading import get_ident
+from time import monotonic
 from typing import TYPE_CHECKING
 
 from parallel_utils.thread import StaticMonitor
-from websockets.sync.client import ClientConnection, connect
+from websockets.sync.client import ClientConnection
 
 from wirescale.communications.checkers import check_addresses_in_allowedips, check_behind_nat, check_interface, match_pubkeys
-from wirescale.communications.common import CONNECTION_PAIRS, file_locker, Semaphores, TCP_PORT
+from wirescale.communications.common import CONNECTION_PAIRS, file_locker, Semaphores, SessionStates
 from wirescale.communications.messages import ActionCodes, ErrorCodes, ErrorMessages, MessageFields, Messages, TCPMessages
+from wirescale.communications.metrics import METRICS
+from wirescale.communications.multiplex import CONNECTION_POOL, MuxStream
+from wirescale.communications.timing import TIMINGS
 from wirescale.vpn.tsmanager import TSManager
 from wirescale.vpn.watch import ACTIVE_SOCKETS
 
 if TYPE_CHECKING:
+    from wirescale.communications.systemd import Systemd
     from wirescale.vpn.recover import RecoverConfig
     from wirescale.vpn.wgconfig import WGConfig
 
@@ -27,16 +32,12 @@ if TYPE_CHECKING:
 class TCPClient:
 
     @staticmethod
-    def connect(uri: IPv4Address) -> ClientConnection:
-        for i in range(3):
-            try:
-                return connect(uri=f'ws://{uri}:{TCP_PORT}')
-            except TimeoutError:
-                if i == 2:
-                    return None
+    def connect(uri: IPv4Address) -> MuxStream | ClientConnection:
+        return CONNECTION_POOL.stream(uri)
 
     @classmethod
-    def upgrade(cls, wgconfig: 'WGConfig', interface: str, suffix_number: int, stack: ExitStack):
+    def bench(cls, tunnel: 'Systemd', seconds: float, count: int):
+        from wirescale.vpn.bench import DataPlaneBench
         pair = CONNECTION_PAIRS[get_ident()]
         try:
             pair.tcp_socket = cls.connect(uri=pair.peer_ip)
@@ -47,8 +48,41 @@ class TCPClient:
             error = ErrorMessages.REMOTE_MISSING_WIRESCALE.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
             ErrorMessages.send_error_message(local_message=error)
         with pair.remote_socket:
-            TCPMessages.send_token()
+            TCPMessages.send_bench(tunnel.remote_interface)
+            for message in pair:
+                message = json.loads(message)
+                if error_code := message[MessageFields.ERROR_CODE]:
+                    ErrorMessages.send_error_message(local_message=message[MessageFields.ERROR_MESSAGE], error_code=error_code)
+                match message[MessageFields.CODE]:
+                    case ActionCodes.INFO:
+                        Messages.send_info_message(local_message=message[MessageFields.MESSAGE])
+                    case ActionCodes.BENCH:
+                        Messages.send_info_message(local_message=Messages.BENCH_RUNNING.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip, interface=tunnel.interface))
+                        ports = message[MessageFields.PORTS]
+                        paths = {'tailscale': (pair.peer_ip, *ports[str(pair.peer_ip)], pair.my_ip), 'wirescale': (tunnel.wg_ip, *ports[str(tunnel.wg_ip)], None)}
+                        results = DataPlaneBench.run(paths, seconds=seconds, count=count)
+                        title = Messages.BENCH_TITLE.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip, interface=tunnel.interface)
+                        pair.send_to_local(json.dumps({MessageFields.CODE: ActionCodes.BENCH, MessageFields.ERROR_CODE: None, MessageFields.MESSAGE: title, MessageFields.RESULTS: results}))
+                        sys.exit(0)
+
+    @classmethod
+    def upgrade(cls, wgconfig: 'WGConfig', interface: str, suffix_number: int, stack: ExitStack):
+        pair = CONNECTION_PAIRS[get_ident()]
+        try:
+            with TIMINGS.span('connect'):
+                pair.tcp_socket = cls.connect(uri=pair.peer_ip)
+            if pair.tcp_socket is None:
+                peer_is_offline = ErrorMessages.TS_PEER_OFFLINE.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
+                ErrorMessages.send_error_message(local_message=peer_is_offline, error_code=ErrorCodes.TS_UNREACHABLE)
+        except ConnectionRefusedError:
+            error = ErrorMessages.REMOTE_MISSING_WIRESCALE.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
+            ErrorMessages.send_error_message(local_message=error)
+        with pair.remote_socket:
+            ts_stops, fast_path = TSManager.STOPS, True
+            cls.prepare_upgrade(wgconfig, interface=interface, suffix_number=suffix_number)
+            TCPMessages.send_fast_upgrade(wgconfig)
             TCPMessages.send_hello()
+            waiting = monotonic()
             for message in pair:
                 message = json.loads(message)
                 if error_code := message[MessageFields.ERROR_CODE]:
@@ -58,19 +92,26 @@ class TCPClient:
                 elif code := message[MessageFields.CODE]:
                     match code:
                         case ActionCodes.ACK:
-                            stack.enter_context(StaticMonitor.synchronized(uid=Semaphores.WAIT_IF_SWITCHED))
-                            ACTIVE_SOCKETS.client_thread = None
-                            ACTIVE_SOCKETS.exclusive_socket = pair
-                            with file_locker():
-                                wgconfig.endpoint = TSManager.peer_endpoint(pair.peer_ip)
-                            wgconfig.interface, wgconfig.suffix = check_interface(interface=interface, allow_suffix=wgconfig.allow_suffix)
-                            if suffix_number is not None:
-                                wgconfig.suffix = suffix_number
-                            wgconfig.listen_port = TSManager.local_port()
+                            fast_path = False
+                            TIMINGS.add('remote', monotonic() - waiting)
+                            Messages.send_info_message(local_message=Messages.FAST_PATH_REMOTE_FALLBACK.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip))
+                            cls.wait_if_switched(stack)
+                            cls.prepare_upgrade(wgconfig, interface=interface, suffix_number=suffix_number)  # Either tailscaled may have been restarted while we were queued
                             TCPMessages.send_upgrade(wgconfig)
+                            waiting = monotonic()
                         case ActionCodes.INFO:
                             Messages.send_info_message(local_message=message[MessageFields.MESSAGE])
                         case ActionCodes.UPGRADE_RESPONSE:
+                            TIMINGS.add('remote', monotonic() - waiting)
+                            if fast_path:
+                                fast_path = False
+                                cls.wait_if_switched(stack)
+                                if TSManager.STOPS != ts_stops:  # The peer answered with our old port and endpoint, so it has to take fresh ones
+                                    Messages.send_info_message(local_message=Messages.FAST_PATH_STALE.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip))
+                                    cls.prepare_upgrade(wgconfig, interface=interface, suffix_number=suffix_number)
+                                    TCPMessages.send_upgrade(wgconfig)
+                                    waiting = monotonic()
+                                    continue
                             match_pubkeys(wgconfig, remote_pubkey=message[MessageFields.PUBKEY], my_pubkey=None)
                             wgconfig.remote_addresses = frozenset(ip_address(ip) for ip in message[MessageFields.ADDRESSES])
                             check_addresses_in_allowedips(wgconfig)
@@ -78,8 +119,11 @@ class TCPClient:
                             wgconfig.start_time = message[MessageFields.START_TIME]
                             wgconfig.remote_local_port = message[MessageFields.PORT]
                             wgconfig.remote_interface = message[MessageFields.INTERFACE]
-                            wgconfig.generate_new_config()
-                            wgconfig.nat = message[MessageFields.NAT] and check_behind_nat(IPv4Address(message[MessageFields.PUBLIC_IP]))
+                            with TIMINGS.span('generate_config'):
+                                wgconfig.generate_new_config()
+                            with TIMINGS.span('check_behind_nat'):
+                                wgconfig.nat = message[MessageFields.NAT] and check_behind_nat(IPv4Address(message[MessageFields.PUBLIC_IP]))
+                            pair.state = SessionStates.APPLYING
                             sent = TCPMessages.send_go(wgconfig)
                             if not sent:
                                 error = ErrorMessages.CONNECTION_LOST.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
@@ -87,17 +131,37 @@ class TCPClient:
                             wgconfig.upgrade()
                             sys.exit(0)
 
+    @staticmethod
+    def wait_if_switched(stack: ExitStack):
+        pair = CONNECTION_PAIRS[get_ident()]
+        with TIMINGS.span('queue'), METRICS.queued(Semaphores.WAIT_IF_SWITCHED):
+            stack.enter_context(StaticMonitor.synchronized(uid=Semaphores.WAIT_IF_SWITCHED))
+        ACTIVE_SOCKETS.client_thread = None
+        ACTIVE_SOCKETS.exclusive_socket = pair
+
+    @staticmethod
+    def prepare_upgrade(wgconfig: 'WGConfig', interface: str, suffix_number: int):
+        pair = CONNECTION_PAIRS[get_ident()]
+        with TIMINGS.span('peer_endpoint'), file_locker():
+            wgconfig.endpoint = TSManager.peer_endpoint(pair.peer_ip)
+        wgconfig.listen_port = TSManager.local_port()
+        wgconfig.interface, wgconfig.suffix = check_interface(interface=interface, allow_suffix=wgconfig.allow_suffix)  # A switched session may have taken the name
+        if suffix_number is not None:
+            wgconfig.suffix = suffix_number
+
     @classmethod
     def recover(cls, recover: 'RecoverConfig', stack: ExitStack):
         pair = CONNECTION_PAIRS[get_ident()]
         try:
-            pair.tcp_socket = cls.connect(uri=pair.peer_ip)
+            with TIMINGS.span('connect'):
+                pair.tcp_socket = cls.connect(uri=pair.peer_ip)
         except ConnectionRefusedError:
             error = ErrorMessages.REMOTE_MISSING_WIRESCALE.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
             ErrorMessages.send_error_message(local_message=error)
         with pair.remote_socket:
             TCPMessages.send_token()
             TCPMessages.send_hello()
+            waiting = monotonic()
             for message in pair:
                 message = json.loads(message)
                 if error_code := message[MessageFields.ERROR_CODE]:
@@ -110,17 +174,19 @@ class TCPClient:
                 elif code := message[MessageFields.CODE]:
                     match code:
                         case ActionCodes.ACK:
-                            stack.enter_context(StaticMonitor.synchronized(uid=Semaphores.WAIT_IF_SWITCHED))
-                            ACTIVE_SOCKETS.client_thread = None
-                            ACTIVE_SOCKETS.exclusive_socket = pair
-                            with file_locker():
+                            TIMINGS.add('remote', monotonic() - waiting)
+                            cls.wait_if_switched(stack)
+                            with TIMINGS.span('peer_endpoint'), file_locker():
                                 recover.endpoint = TSManager.peer_endpoint(pair.peer_ip)
                             recover.new_port = TSManager.local_port()
                             TCPMessages.send_recover(recover)
+                            waiting = monotonic()
                         case ActionCodes.INFO:
                             Messages.send_info_message(local_message=message[MessageFields.MESSAGE])
                         case ActionCodes.RECOVER_RESPONSE:
+                            TIMINGS.add('remote', monotonic() - waiting)
                             TCPMessages.process_recover_response(message, recover)
+                            pair.state = SessionStates.APPLYING
                             sent = TCPMessages.send_go(recover)
                             if not sent:
                                 error = ErrorMessages.CONNECTION_LOST.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
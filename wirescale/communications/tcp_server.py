@@ -4,29 +4,38 @@
 
 import json
 import sys
-from contextlib import ExitStack
+from contextlib import ExitStack, suppress
 from ipaddress import ip_address, IPv4Address
-from threading import get_ident
+from threading import get_ident, Lock
+from time import monotonic
+from typing import Set
 
 from parallel_utils.thread import StaticMonitor
+from websockets import ConnectionClosed
 from websockets.sync.server import serve, ServerConnection, WebSocketServer
 
 from wirescale.communications.checkers import check_addresses_in_allowedips, check_behind_nat, check_configfile, check_interface, check_wgconfig, match_psk, match_pubkeys, test_wgconfig
-from wirescale.communications.common import CONNECTION_PAIRS, file_locker, Semaphores, SHUTDOWN, TCP_PORT
+from wirescale.communications.common import CONNECTION_PAIRS, end_session, file_locker, Semaphores, SessionStates, SHUTDOWN, TCP_PORT
 from wirescale.communications.connection_pair import ConnectionPair
 from wirescale.communications.messages import ActionCodes, ErrorMessages, MessageFields, Messages, TCPMessages
+from wirescale.communications.metrics import METRICS
+from wirescale.communications.multiplex import MUX_SUBPROTOCOL, MuxConnection, MuxStream
+from wirescale.communications.timing import SessionTimings, TIMINGS
 from wirescale.parsers.args import ARGS
 from wirescale.vpn.tsmanager import TSManager
 from wirescale.vpn.watch import ACTIVE_SOCKETS
 
 
 class TCPServer:
+    FAST_PATH_MAX_QUEUE = 5
+    MUX_CONNECTIONS: Set[MuxConnection] = set()
+    MUX_LOCK = Lock()
     SERVER: WebSocketServer = None
 
     @classmethod
     def set_server(cls):
         if cls.SERVER is None:
-            cls.SERVER = serve(cls.handler, str(TSManager.my_ip()), TCP_PORT)
+            cls.SERVER = serve(cls.handler, str(TSManager.my_ip()), TCP_PORT, select_subprotocol=cls.select_subprotocol)
 
     @classmethod
     def run_server(cls):
@@ -34,8 +43,32 @@ class TCPServer:
         with cls.SERVER:
             cls.SERVER.serve_forever()
 
+    @staticmethod
+    def select_subprotocol(connection: ServerConnection, subprotocols):
+        return MUX_SUBPROTOCOL if MUX_SUBPROTOCOL in subprotocols else None
+
     @classmethod
     def handler(cls, websocket: ServerConnection):
+        if websocket.subprotocol != MUX_SUBPROTOCOL:
+            return cls.session(websocket)
+        connection = MuxConnection(websocket, handler=cls.session)
+        with cls.MUX_LOCK:
+            cls.MUX_CONNECTIONS.add(connection)
+        try:
+            connection.read()
+        finally:
+            with cls.MUX_LOCK:
+                cls.MUX_CONNECTIONS.discard(connection)
+
+    @classmethod
+    def close_multiplexed(cls):
+        with cls.MUX_LOCK:
+            connections = tuple(cls.MUX_CONNECTIONS)
+        for connection in connections:
+            connection.close_after_sessions()
+
+    @classmethod
+    def session(cls, websocket: ServerConnection | MuxStream):
         with websocket:
             pair = ConnectionPair(caller=IPv4Address(websocket.remote_address[0]), receiver=TSManager.my_ip())
             pair.tcp_socket = websocket
@@ -43,29 +76,45 @@ class TCPServer:
                 message_token = json.loads(pair.tcp_socket.recv())
                 pair.token = message_token[MessageFields.TOKEN]
                 cls.discard_connections()
+                if message_token[MessageFields.CODE] == ActionCodes.BENCH:  # Changes nothing, so it skips the semaphores
+                    cls.bench(message_token)
+                    return
                 enqueueing = Messages.ENQUEUEING_FROM.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
                 enqueueing_remote = Messages.ENQUEUEING_REMOTE.format(sender_name=pair.my_name, sender_ip=pair.my_ip)
                 Messages.send_info_message(local_message=enqueueing, remote_message=enqueueing_remote)
                 Messages.process_version(message_token)
                 with ExitStack() as stack:
-                    stack.enter_context(StaticMonitor.synchronized(uid=Semaphores.SERVER))
+                    queue_start, ts_stops = monotonic(), TSManager.STOPS
+                    with METRICS.queued(Semaphores.SERVER):
+                        stack.enter_context(StaticMonitor.synchronized(uid=Semaphores.SERVER))
                     cls.discard_connections()
                     next_message = Messages.NEXT_INCOMING.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
                     Messages.send_info_message(local_message=next_message)
                     ACTIVE_SOCKETS.server_thread = get_ident()
                     ACTIVE_SOCKETS.waiter_switched.wait()
-                    stack.enter_context(StaticMonitor.synchronized(uid=Semaphores.EXCLUSIVE))
+                    with METRICS.queued(Semaphores.EXCLUSIVE):
+                        stack.enter_context(StaticMonitor.synchronized(uid=Semaphores.EXCLUSIVE))
                     cls.discard_connections()
                     ACTIVE_SOCKETS.exclusive_socket = pair
                     ACTIVE_SOCKETS.waiter_server_switched.set()
                     exclusive_message = Messages.EXCLUSIVE_SEMAPHORE_REMOTE.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
                     Messages.send_info_message(local_message=exclusive_message)
-                    stack.enter_context(StaticMonitor.synchronized(uid=Semaphores.WAIT_IF_SWITCHED))
+                    with METRICS.queued(Semaphores.WAIT_IF_SWITCHED):
+                        stack.enter_context(StaticMonitor.synchronized(uid=Semaphores.WAIT_IF_SWITCHED))
                     ACTIVE_SOCKETS.server_thread = None
+                    TIMINGS.add('queue', monotonic() - queue_start)
                     cls.discard_connections()
                     ACTIVE_SOCKETS.exclusive_socket = pair
+                    pair.state = SessionStates.RUNNING
                     start_processing = Messages.START_PROCESSING_FROM.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
                     start_processing_remote = Messages.START_PROCESSING_REMOTE.format(sender_name=pair.my_name, sender_ip=pair.my_ip)
+                    if message_token[MessageFields.CODE] == ActionCodes.FAST_UPGRADE:
+                        if cls.fast_path_allowed(queue_start, ts_stops):
+                            Messages.send_info_message(local_message=Messages.FAST_PATH.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip))
+                            Messages.send_info_message(local_message=start_processing.format(action='upgrade'), remote_message=start_processing_remote.format(action='upgrade'))
+                            cls.upgrade(message_token)
+                            return
+                        Messages.send_info_message(local_message=Messages.FAST_PATH_FALLBACK.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip))
                     for message in pair:
                         message = json.loads(message)
                         match message[MessageFields.CODE]:
@@ -83,8 +132,32 @@ class TCPServer:
 
             finally:
                 pair.close_sockets()
+                TIMINGS.finish(pair, side=SessionTimings.RESPONDER)
                 Messages.send_info_message(local_message=Messages.END_SESSION)
-                CONNECTION_PAIRS.pop(get_ident(), None)
+                end_session()
+
+    @staticmethod
+    def bench(message: dict):
+        from netifaces import AF_INET, ifaddresses
+        from wirescale.vpn.bench import BenchServer
+        from wirescale.vpn.tunnels import TUNNELS
+        pair = CONNECTION_PAIRS[get_ident()]
+        interface = message[MessageFields.INTERFACE]
+        if (tunnel := TUNNELS.get(interface)) is None or tunnel.ts_ip != pair.peer_ip:
+            error = ErrorMessages.BENCH_REMOTE_NO_TUNNEL.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip, interface=interface)
+            error_remote = ErrorMessages.REMOTE_BENCH_NO_TUNNEL.format(my_name=pair.my_name, my_ip=pair.my_ip, interface=interface)
+            ErrorMessages.send_error_message(local_message=error, remote_message=error_remote)
+        wg_ip = IPv4Address(ifaddresses(interface)[AF_INET][0]['addr'])
+        with BenchServer(addresses=(pair.my_ip, wg_ip), allowed=(pair.peer_ip, tunnel.wg_ip)) as server:
+            Messages.send_info_message(local_message=Messages.BENCH_SERVING.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip, interface=interface))
+            TCPMessages.send_bench_response(server.ports)
+            with suppress(ConnectionClosed, TimeoutError):
+                pair.remote_socket.recv(timeout=BenchServer.LIFETIME)  # The peer hangs up when it is done
+
+    @classmethod
+    def fast_path_allowed(cls, queue_start: float, ts_stops: int) -> bool:
+        # The endpoint the client sent us goes stale if our tailscaled was restarted while the request was waiting
+        return TSManager.STOPS == ts_stops and monotonic() - queue_start <= cls.FAST_PATH_MAX_QUEUE
 
     @staticmethod
     def discard_connections():
@@ -96,21 +169,24 @@ class TCPServer:
     @classmethod
     def upgrade(cls, message: dict):
         pair = CONNECTION_PAIRS[get_ident()]
-        config = check_configfile()
-        wgconfig = check_wgconfig(config)
-        wgconfig.interface = wgconfig.interface or pair.peer_name
-        wgconfig.allow_suffix = wgconfig.allow_suffix if wgconfig.allow_suffix is not None else ARGS.ALLOW_SUFFIX if ARGS.ALLOW_SUFFIX is not None else False
-        wgconfig.interface, wgconfig.suffix = check_interface(interface=wgconfig.interface, allow_suffix=wgconfig.allow_suffix)
+        pair.kind = ActionCodes.UPGRADE
+        with TIMINGS.span('check_config'):
+            config = check_configfile()
+            wgconfig = check_wgconfig(config)
+            wgconfig.interface = wgconfig.interface or pair.peer_name
+            wgconfig.allow_suffix = wgconfig.allow_suffix if wgconfig.allow_suffix is not None else ARGS.ALLOW_SUFFIX if ARGS.ALLOW_SUFFIX is not None else False
+            wgconfig.interface, wgconfig.suffix = check_interface(interface=wgconfig.interface, allow_suffix=wgconfig.allow_suffix)
         expected_interface = message[MessageFields.EXPECTED_INTERFACE]
         if expected_interface is not None and wgconfig.interface != expected_interface:
             error = ErrorMessages.INTERFACE_MISMATCH.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
             remote_error = ErrorMessages.REMOTE_INTERFACE_MISMATCH.format(my_name=pair.my_name, my_ip=pair.my_ip, interface=expected_interface)
             ErrorMessages.send_error_message(local_message=error, remote_message=remote_error)
-        test_wgconfig(wgconfig)
+        with TIMINGS.span('test_wgconfig'):
+            test_wgconfig(wgconfig)
         wgconfig.iptables_accept = wgconfig.iptables_accept if wgconfig.iptables_accept is not None else ARGS.IPTABLES_ACCEPT if ARGS.IPTABLES_ACCEPT is not None else False
         wgconfig.iptables_forward = wgconfig.iptables_forward if wgconfig.iptables_forward is not None else ARGS.IPTABLES_FORWARD if ARGS.IPTABLES_FORWARD is not None else False
         wgconfig.iptables_masquerade = wgconfig.iptables_masquerade if wgconfig.iptables_masquerade is not None else ARGS.IPTABLES_MASQUERADE if ARGS.IPTABLES_MASQUERADE is not None else False
-        with file_locker():
+        with TIMINGS.span('peer_endpoint'), file_locker():
             wgconfig.endpoint = TSManager.peer_endpoint(pair.peer_ip)
         wgconfig.listen_ext_port = message[MessageFields.EXPOSED_PORT]
         wgconfig.remote_addresses = frozenset(ip_address(ip) for ip in message[MessageFields.ADDRESSES])
@@ -119,18 +195,26 @@ class TCPServer:
         match_pubkeys(wgconfig, remote_pubkey=message[MessageFields.PUBKEY], my_pubkey=message[MessageFields.REMOTE_PUBKEY])
         match_psk(wgconfig, remote_has_psk=message[MessageFields.HAS_PSK], remote_psk=message[MessageFields.PSK])
         check_addresses_in_allowedips(wgconfig)
-        wgconfig.generate_new_config()
-        wgconfig.nat = check_behind_nat(IPv4Address(message[MessageFields.PUBLIC_IP]))
+        with TIMINGS.span('generate_config'):
+            wgconfig.generate_new_config()
+        with TIMINGS.span('check_behind_nat'):
+            wgconfig.nat = check_behind_nat(IPv4Address(message[MessageFields.PUBLIC_IP]))
         wgconfig.recover_tries = wgconfig.recover_tries if wgconfig.recover_tries is not None else ARGS.RECOVER_TRIES if ARGS.RECOVER_TRIES is not None else 3
         wgconfig.recreate_tries = wgconfig.recreate_tries if wgconfig.recreate_tries is not None else ARGS.RECREATE_TRIES if ARGS.RECREATE_TRIES is not None else 0
         TCPMessages.send_upgrade_response(wgconfig)
+        waiting = monotonic()
         for message in pair:
             message = json.loads(message)
             ErrorMessages.process_error_message(message)
             match message[MessageFields.CODE]:
                 case ActionCodes.INFO:
                     print(message[MessageFields.MESSAGE], flush=True)
+                case ActionCodes.UPGRADE:  # Tailscale was restarted on the other side while its fast path request was in flight
+                    TIMINGS.add('remote', monotonic() - waiting)
+                    cls.upgrade(message)
                 case ActionCodes.GO:
+                    TIMINGS.add('remote', monotonic() - waiting)
+                    pair.state = SessionStates.APPLYING
                     wgconfig.nat = message[MessageFields.NAT]
                     wgconfig.upgrade()
                     sys.exit(0)
@@ -138,8 +222,11 @@ class TCPServer:
     @classmethod
     def recover(cls, message: dict):
         pair = CONNECTION_PAIRS[get_ident()]
-        recover = TCPMessages.process_recover(message)
+        pair.kind = ActionCodes.RECOVER
+        with TIMINGS.span('process_recover'):
+            recover = TCPMessages.process_recover(message)
         TCPMessages.send_recover_response(recover)
+        waiting = monotonic()
         for message in pair:
             message = json.loads(message)
             ErrorMessages.process_error_message(message)
@@ -147,6 +234,8 @@ class TCPServer:
                 case ActionCodes.INFO:
                     print(message[MessageFields.MESSAGE], flush=True)
                 case ActionCodes.GO:
+                    TIMINGS.add('remote', monotonic() - waiting)
+                    pair.state = SessionStates.APPLYING
                     recover.nat = message[MessageFields.NAT]
                     recover.recover()
                     sys.exit(0)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+
+import sys
+from collections import deque
+from contextlib import contextmanager
+from threading import get_ident, Lock
+from time import monotonic, thread_time, time
+from typing import Deque, Dict, List, TYPE_CHECKING
+
+from wirescale.communications.commands import COMMANDS
+from wirescale.communications.common import CONNECTION_PAIRS
+from wirescale.communications.messages import Messages
+from wirescale.communications.metrics import METRICS
+
+if TYPE_CHECKING:
+    from wirescale.communications.connection_pair import ConnectionPair
+
+
+class SessionTimings:
+    INITIATOR = 'initiator'
+    RESPONDER = 'responder'
+    LIMIT = 500
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self):
+        self.sessions: Deque[Dict] = deque(maxlen=self.LIMIT)
+        self.lock = Lock()
+
+    @contextmanager
+    def span(self, phase: str):
+        pair = CONNECTION_PAIRS.get(get_ident())
+        outer = pair.phase if pair is not None else None
+        if pair is not None:
+            pair.phase = phase
+        start, cpu = monotonic(), thread_time()
+        try:
+            yield
+        finally:
+            if pair is not None:
+                pair.phase = outer
+            self.add(phase, monotonic() - start, cpu=thread_time() - cpu)
+
+    @staticmethod
+    def add(phase: str, seconds: float, cpu: float = 0):
+        if (pair := CONNECTION_PAIRS.get(get_ident())) is None:
+            return
+        pair.spans[phase] = pair.spans.get(phase, 0) + seconds
+        pair.cpu[phase] = pair.cpu.get(phase, 0) + cpu
+        Messages.send_info_message(local_message=Messages.TIMING_SPAN.format(phase=phase, milliseconds=seconds * 1000, cpu=cpu * 1000), send_to_local=False)
+
+    def finish(self, pair: 'ConnectionPair', side: str):
+        if pair is None or pair.kind is None or pair.token is None:
+            return
+        exception = sys.exc_info()[1]
+        session = {
+            'id': pair.id,
+            'kind': str(pair.kind),
+            'side': side,
+            'time': time(),
+            'ok': isinstance(exception, SystemExit) and exception.code in (0, None),
+            'spans': {**pair.spans, 'total': monotonic() - pair.started},
+            'cpu': pair.cpu,
+            'commands': pair.commands,
+        }
+        forks, seconds = COMMANDS.forks(pair.commands)
+        Messages.send_info_message(local_message=Messages.COMMANDS_SUMMARY.format(count=forks, milliseconds=seconds * 1000), send_to_local=False)
+        with self.lock:
+            self.sessions.append(session)
+        METRICS.session_finished(session['kind'], side, session['ok'], session['spans']['total'])
+
+    def recent(self) -> List[Dict]:
+        with self.lock:
+            return list(self.sessions)
+
+    @staticmethod
+    def percentile(values: List[float], percent: int) -> float:
+        # Nearest rank, so every figure is one that was actually measured
+        return values[max(0, -(-len(values) * percent // 100) - 1)]
+
+    @classmethod
+    def report(cls, sessions: List[Dict]) -> List[str]:
+        groups: Dict[tuple, List[Dict]] = {}
+        for session in sessions:
+            groups.setdefault((session['kind'], session['side']), []).append(session)
+        lines = []
+        for (kind, side), group in sorted(groups.items()):
+            failed = sum(not session['ok'] for session in group)
+            lines.append(Messages.STATS_GROUP.format(kind=kind.capitalize(), side=side, sessions=len(group), failed=failed))
+            lines.append(f"{'phase':<24}{'count':>7}" + ''.join(f'{f"p{percent} ms":>12}' for percent in cls.PERCENTILES) + f"{'max ms':>12}{'forks':>8}")
+            phases = dict.fromkeys(phase for session in group for phase in session['spans'] if phase != 'total')
+            for phase in (*phases, 'total'):
+                values = sorted(session['spans'][phase] * 1000 for session in group if phase in session['spans'])
+                forks = sum(COMMANDS.forks(session['commands'], phase=None if phase == 'total' else phase)[0] for session in group) / len(group)
+                lines.append(f'{phase:<24}{len(values):>7}' + ''.join(f'{cls.percentile(values, percent):>12.1f}' for percent in cls.PERCENTILES) + f'{values[-1]:>12.1f}{forks:>8.1f}')
+            lines.append('')
+        return lines[:-1]
+
+
+TIMINGS = SessionTimings()
@@ -6,20 +6,47 @@ import sys
 from socket import AF_INET, SOCK_DGRAM, socket
 from time import sleep
 
+from wirescale.communications.commands import COMMANDS
+from wirescale.communications.messages import Messages
+from wirescale.communications.systemd import Systemd
 from wirescale.vpn.tsmanager import TSManager
 
 
 class UDPServer:
+    FDNAME = 'udp41641'
     UDPDummy: socket = None
 
     @classmethod
     def occupy_port_41641(cls):
-        TSManager.stop()
+        for name, fd_socket in Systemd.listen_fds().values():
+            if name == cls.FDNAME or (fd_socket.family == AF_INET and fd_socket.type == SOCK_DGRAM and fd_socket.getsockname()[1] == 41641):
+                cls.UDPDummy = fd_socket
+                print(Messages.PORT_41641_HELD, flush=True)
+                return
+        cls.UDPDummy = socket(AF_INET, SOCK_DGRAM)
         try:
-            cls.UDPDummy = socket(AF_INET, SOCK_DGRAM)
             cls.UDPDummy.bind(('localhost', 41641))
-        except:
-            print("Couldn't occupy port 41641", file=sys.stderr, flush=True)
-        TSManager.start()
-        while not TSManager.is_running():
-            sleep(0.5)
+            bound = True
+        except OSError:
+            bound = False
+        if bound and not cls.tailscale_on_41641():
+            print(Messages.PORT_41641_FREE, flush=True)
+        else:
+            print(Messages.PORT_41641_RESTART, flush=True)
+            TSManager.stop()
+            try:
+                if not bound:
+                    cls.UDPDummy.bind(('localhost', 41641))
+                    bound = True
+            except:
+                print("Couldn't occupy port 41641", file=sys.stderr, flush=True)
+            TSManager.start()
+            while not TSManager.is_running():
+                sleep(0.5)
+        if bound:  # systemd keeps a copy across restarts, so the next start does not need to touch tailscaled
+            Systemd.notify('FDSTORE=1', f'FDNAME={cls.FDNAME}', fds=[cls.UDPDummy.fileno()])
+
+    @staticmethod
+    def tailscale_on_41641() -> bool:
+        ss = COMMANDS.run(['ss', '-lunpH4', 'sport', '=', ':41641'], capture_output=True, text=True)
+        return 'tailscale' in ss.stdout
@@ -9,7 +9,7 @@ from threading import get_ident
 from websockets import ConnectionClosedOK
 from websockets.sync.client import unix_connect
 
-from wirescale.communications.common import CONNECTION_PAIRS, SOCKET_PATH
+from wirescale.communications.common import CONNECTION_PAIRS, SOCKET_PATH, STOP_TIMEOUT
 from wirescale.communications.messages import ActionCodes, ErrorCodes, ErrorMessages, MessageFields, Messages, UnixMessages
 from wirescale.parsers.args import ARGS
 from wirescale.vpn.recover import RecoverConfig
@@ -18,11 +18,13 @@ from wirescale.vpn.recover import RecoverConfig
 class UnixClient:
 
     @classmethod
-    def connect(cls):
+    def connect(cls, verbose: bool = True):
         try:
-            print(Messages.CONNECTING_UNIX, flush=True)
+            if verbose:
+                print(Messages.CONNECTING_UNIX, flush=True)
             connect = unix_connect(path=str(SOCKET_PATH))
-            print(Messages.CONNECTED_UNIX, flush=True)
+            if verbose:
+                print(Messages.CONNECTED_UNIX, flush=True)
             return connect
         except:
             print(ErrorMessages.UNIX_SOCKET, file=sys.stderr, flush=True)
@@ -34,7 +36,7 @@ class UnixClient:
         with unix_socket:
             unix_socket.send(json.dumps(UnixMessages.STOP_MESSAGE))
             try:
-                message: dict = json.loads(unix_socket.recv(timeout=40))
+                message: dict = json.loads(unix_socket.recv(timeout=STOP_TIMEOUT + 5))
                 if message[MessageFields.ERROR_CODE] == ErrorCodes.CLOSED:
                     print(message[MessageFields.ERROR_MESSAGE], file=sys.stderr, flush=True)
                     sys.exit(1)
@@ -44,6 +46,43 @@ class UnixClient:
             except ConnectionClosedOK:
                 print('Connection has been successfully closed', flush=True)
 
+    @classmethod
+    def stats(cls):
+        from wirescale.communications.timing import SessionTimings
+        unix_socket = cls.connect(verbose=False)
+        with unix_socket:
+            unix_socket.send(json.dumps(UnixMessages.STATS_MESSAGE))
+            message: dict = json.loads(unix_socket.recv())
+        if message[MessageFields.ERROR_CODE] is not None:
+            print(message[MessageFields.ERROR_MESSAGE], file=sys.stderr, flush=True)
+            sys.exit(1)
+        sessions = message[MessageFields.SESSIONS]
+        if not sessions:
+            print(Messages.STATS_EMPTY, flush=True)
+            return
+        print('\n'.join(SessionTimings.report(sessions)), flush=True)
+
+    @classmethod
+    def bench(cls):
+        from wirescale.vpn.bench import DataPlaneBench
+        unix_socket = cls.connect(verbose=False)
+        with unix_socket:
+            unix_socket.send(json.dumps(UnixMessages.build_bench()))
+            for message in unix_socket:
+                message = json.loads(message)
+                if error_code := message[MessageFields.ERROR_CODE]:
+                    print(message[MessageFields.ERROR_MESSAGE], file=sys.stderr, flush=True)
+                    sys.exit(ErrorMessages.EXIT_CODES.get(error_code, 1))
+                match message[MessageFields.CODE]:
+                    case ActionCodes.INFO:
+                        print(message[MessageFields.MESSAGE], flush=True)
+                    case ActionCodes.BENCH:
+                        results = message[MessageFields.RESULTS]
+                        print('\n'.join(DataPlaneBench.report(results, title=message[MessageFields.MESSAGE])), flush=True)
+                        sys.exit(int(any('error' in result for result in results.values())))
+        print(ErrorMessages.SOCKET_ERROR, file=sys.stderr, flush=True)
+        sys.exit(1)
+
     @classmethod
     def upgrade(cls):
         pair = ARGS.PAIR
@@ -8,26 +8,52 @@ import sys
 from contextlib import ExitStack, suppress
 from ipaddress import IPv4Address
 from pathlib import Path
-from threading import active_count, get_ident
-from time import sleep
+from typing import Tuple
+from threading import get_ident
+from time import monotonic
+from uuid import uuid4
 
 from parallel_utils.thread import StaticMonitor
 from websockets import ConnectionClosed
 from websockets.sync.server import ServerConnection, unix_serve, WebSocketServer
 
 from wirescale.communications.checkers import check_configfile, check_interface, check_recover_config, check_wgconfig, test_wgconfig
-from wirescale.communications.common import CONNECTION_PAIRS, Semaphores, SHUTDOWN, SOCKET_PATH
+from wirescale.communications.common import CANCEL_GRACE, CONNECTION_PAIRS, end_session, file_locker, Semaphores, SessionStates, SESSIONS_CHANGED, SHUTDOWN, SOCKET_PATH, STOP_TIMEOUT
 from wirescale.communications.connection_pair import ConnectionPair
 from wirescale.communications.messages import ActionCodes, ErrorCodes, ErrorMessages, MessageFields, Messages
+from wirescale.communications.metrics import METRICS
+from wirescale.communications.multiplex import CONNECTION_POOL
+from wirescale.communications.systemd import Systemd
 from wirescale.communications.tcp_client import TCPClient
 from wirescale.communications.tcp_server import TCPServer
+from wirescale.communications.timing import SessionTimings, TIMINGS
 from wirescale.communications.udp_server import UDPServer
+from wirescale.parsers.args import ARGS
 from wirescale.vpn.recover import RecoverConfig
 from wirescale.vpn.tsmanager import TSManager
 from wirescale.vpn.watch import ACTIVE_SOCKETS
 
 
+class LocalSession:
+    def __init__(self):
+        self.id = uuid4()
+        self.exit_code: int = None
+
+    def send(self, message: str):
+        if self.exit_code is not None:
+            return
+        message = json.loads(message)
+        if error_code := message.get(MessageFields.ERROR_CODE):
+            self.exit_code = ErrorMessages.EXIT_CODES.get(error_code, 1)
+        elif message[MessageFields.CODE] == ActionCodes.SUCCESS:
+            self.exit_code = 0
+
+    def close(self):
+        pass
+
+
 class UnixServer:
+    DRAIN_TIMEOUT = 30
     SYSTEMD_SOCKET_FD: int = None
     SOCKET: socket.socket = None
     SERVER: WebSocketServer = None
@@ -36,6 +62,11 @@ class UnixServer:
     def set_socket(cls):
         if cls.SOCKET is not None:
             return
+        for fd, (name, fd_socket) in Systemd.listen_fds().items():
+            if fd_socket.family == socket.AF_UNIX and fd_socket.getsockname() == str(SOCKET_PATH):
+                cls.SYSTEMD_SOCKET_FD = fd
+                cls.SOCKET = fd_socket
+                return
         fd_dir = Path('/proc/self/fd')
         fd_dir = [int(fd.name) for fd in fd_dir.iterdir() if fd.is_socket() and int(fd.name) not in (0, 1, 2)]
         for fd in fd_dir:
@@ -49,10 +80,15 @@ class UnixServer:
         print(f"Error: No file descriptor found for the UNIX socket located at '{SOCKET_PATH}'", file=sys.stderr, flush=True)
         sys.exit(1)
 
+    @classmethod
+    def set_server(cls):
+        if cls.SERVER is None:
+            cls.set_socket()
+            cls.SERVER = unix_serve(sock=cls.SOCKET, handler=cls.handler)
+
     @classmethod
     def run_server(cls):
-        cls.set_socket()
-        cls.SERVER = unix_serve(sock=cls.SOCKET, handler=cls.handler)
+        cls.set_server()
         with cls.SERVER:
             cls.SERVER.serve_forever()
 
@@ -61,48 +97,101 @@ class UnixServer:
         with websocket:
             cls.discard_connections(websocket)
             message: dict = json.loads(websocket.recv())
-            if code := message[MessageFields.CODE]:
-                try:
-                    match code:
-                        case ActionCodes.STOP:
-                            cls.stop()
-                        case ActionCodes.UPGRADE | ActionCodes.RECOVER:
-                            pair = ConnectionPair(caller=TSManager.my_ip(), receiver=IPv4Address(message[MessageFields.PEER_IP]))
-                            pair.unix_socket = websocket
-                            pair.id  # Sets the token property
-                            if code == ActionCodes.UPGRADE:
-                                enqueueing = Messages.ENQUEUEING_TO.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
-                                start_processing = Messages.START_PROCESSING_TO.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
-                                next_message = Messages.NEXT_UPGRADE.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
-                                exclusive_message = Messages.EXCLUSIVE_SEMAPHORE_UPGRADE.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
-                                action = lambda: cls.upgrade(message, stack)
-                            elif code == ActionCodes.RECOVER:
-                                interface = message[MessageFields.INTERFACE]
-                                enqueueing = Messages.ENQUEUEING_RECOVER.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip, interface=interface)
-                                start_processing = Messages.START_PROCESSING_RECOVER.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip, interface=interface)
-                                next_message = Messages.NEXT_RECOVER.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip, interface=interface)
-                                exclusive_message = Messages.EXCLUSIVE_SEMAPHORE_RECOVER.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip, interface=interface)
-                                action = lambda: cls.recover(message, stack)
-                            Messages.send_info_message(local_message=enqueueing)
-                            with ExitStack() as stack:
-                                stack.enter_context(StaticMonitor.synchronized(uid=Semaphores.CLIENT))
+            cls.session(websocket, message)
+
+    @classmethod
+    def run_local(cls, message: dict) -> int:
+        local_session = LocalSession()
+        with suppress(SystemExit):
+            cls.session(local_session, message)
+        return local_session.exit_code if local_session.exit_code is not None else 1
+
+    @classmethod
+    def session(cls, websocket: ServerConnection | LocalSession, message: dict):
+        if code := message[MessageFields.CODE]:
+            try:
+                match code:
+                    case ActionCodes.BENCH:
+                        cls.bench(websocket, message)
+                    case ActionCodes.STATS:
+                        websocket.send(json.dumps({MessageFields.CODE: ActionCodes.STATS, MessageFields.ERROR_CODE: None, MessageFields.SESSIONS: TIMINGS.recent()}))
+                    case ActionCodes.STOP:
+                        cls.stop()
+                    case ActionCodes.UPGRADE | ActionCodes.RECOVER:
+                        pair = ConnectionPair(caller=TSManager.my_ip(), receiver=cls.resolve_peer(websocket, message))
+                        pair.unix_socket = websocket
+                        pair.id  # Sets the token property
+                        pair.kind = code
+                        if code == ActionCodes.UPGRADE:
+                            enqueueing = Messages.ENQUEUEING_TO.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
+                            start_processing = Messages.START_PROCESSING_TO.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
+                            next_message = Messages.NEXT_UPGRADE.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
+                            exclusive_message = Messages.EXCLUSIVE_SEMAPHORE_UPGRADE.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip)
+                            action = lambda: cls.upgrade(message, stack)
+                        elif code == ActionCodes.RECOVER:
+                            interface = message[MessageFields.INTERFACE]
+                            enqueueing = Messages.ENQUEUEING_RECOVER.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip, interface=interface)
+                            start_processing = Messages.START_PROCESSING_RECOVER.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip, interface=interface)
+                            next_message = Messages.NEXT_RECOVER.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip, interface=interface)
+                            exclusive_message = Messages.EXCLUSIVE_SEMAPHORE_RECOVER.format(peer_name=pair.peer_name, peer_ip=pair.peer_ip, interface=interface)
+                            action = lambda: cls.recover(message, stack)
+                        Messages.send_info_message(local_message=enqueueing)
+                        with ExitStack() as stack:
+                            with TIMINGS.span('queue'):
+                                with METRICS.queued(Semaphores.CLIENT):
+                                    stack.enter_context(StaticMonitor.synchronized(uid=Semaphores.CLIENT))
                                 cls.discard_connections(websocket)
                                 Messages.send_info_message(local_message=next_message)
                                 ACTIVE_SOCKETS.client_thread = get_ident()
                                 ACTIVE_SOCKETS.waiter_switched.wait()
-                                stack.enter_context(StaticMonitor.synchronized(uid=Semaphores.EXCLUSIVE))
-                                cls.discard_connections(websocket)
-                                ACTIVE_SOCKETS.exclusive_socket = pair
-                                Messages.send_info_message(local_message=exclusive_message)
-                                Messages.send_info_message(local_message=start_processing)
-                                action()
-
-                finally:
-                    pair = CONNECTION_PAIRS.get(get_ident())
-                    if pair is not None:
-                        pair.close_sockets()
-                    Messages.send_info_message(local_message=Messages.END_SESSION, send_to_local=False)
-                    CONNECTION_PAIRS.pop(get_ident(), None)
+                                with METRICS.queued(Semaphores.EXCLUSIVE):
+                                    stack.enter_context(StaticMonitor.synchronized(uid=Semaphores.EXCLUSIVE))
+                            cls.discard_connections(websocket)
+                            ACTIVE_SOCKETS.exclusive_socket = pair
+                            pair.state = SessionStates.RUNNING
+                            Messages.send_info_message(local_message=exclusive_message)
+                            Messages.send_info_message(local_message=start_processing)
+                            action()
+
+            finally:
+                pair = CONNECTION_PAIRS.get(get_ident())
+                if pair is not None:
+                    pair.close_sockets()
+                TIMINGS.finish(pair, side=SessionTimings.INITIATOR)
+                Messages.send_info_message(local_message=Messages.END_SESSION, send_to_local=False)
+                end_session()
+
+    @staticmethod
+    def bench(websocket: ServerConnection, message: dict):
+        from wirescale.vpn.tunnels import TUNNELS
+        interface = message[MessageFields.INTERFACE]
+        if (tunnel := TUNNELS.get(interface)) is None:
+            error = ErrorMessages.BENCH_NO_TUNNEL.format(interface=interface)
+            print(error, file=sys.stderr, flush=True)
+            with suppress(ConnectionClosed):
+                websocket.send(json.dumps(ErrorMessages.build_error_message(error)))
+            ConnectionPair.close_socket(websocket)
+            sys.exit(1)
+        pair = ConnectionPair(caller=TSManager.my_ip(), receiver=tunnel.ts_ip)
+        pair.unix_socket = websocket
+        pair.id  # Sets the token property
+        pair.state = SessionStates.RUNNING  # Not queued, so a stop waits for it instead of rejecting it
+        TCPClient.bench(tunnel, seconds=message[MessageFields.DURATION], count=message[MessageFields.COUNT])
+
+    @staticmethod
+    def resolve_peer(websocket: ServerConnection, message: dict) -> IPv4Address:
+        if (peer := message.get(MessageFields.PEER)) is None:
+            return IPv4Address(message[MessageFields.PEER_IP])
+        with file_locker():
+            peer_ip, my_ip = TSManager.resolve_peer(peer), TSManager.my_ip()
+        if peer_ip is None or peer_ip == my_ip:
+            error = ErrorMessages.UNKNOWN_PEER.format(peer=peer) if peer_ip is None else ErrorMessages.OWN_PEER.format(peer=peer)
+            print(error, file=sys.stderr, flush=True)
+            with suppress(ConnectionClosed):
+                websocket.send(json.dumps(ErrorMessages.build_error_message(error, ErrorCodes.INVALID_PEER)))
+            ConnectionPair.close_socket(websocket)
+            sys.exit(1)
+        return peer_ip
 
     @staticmethod
     def discard_connections(websocket: ServerConnection):
@@ -117,13 +206,48 @@ class UnixServer:
 
     @classmethod
     def stop(cls):
+        start = monotonic()
+        Systemd.notify('STOPPING=1')
         SHUTDOWN.set()
         TCPServer.SERVER.shutdown()
         cls.SERVER.shutdown()
+        METRICS.stop()
         print(Messages.SHUTDOWN_SET, flush=True)
-        while active_count() > 3:
-            sleep(0.5)
+        rejected, finished, cancelled, abandoned = cls.drain(timeout=ARGS.DRAIN_TIMEOUT if ARGS.DRAIN_TIMEOUT is not None else cls.DRAIN_TIMEOUT, deadline=start + STOP_TIMEOUT)
+        TCPServer.close_multiplexed()
+        CONNECTION_POOL.close()
         UDPServer.UDPDummy.close()
+        print(Messages.DRAIN_COMPLETE.format(seconds=monotonic() - start, rejected=rejected, finished=finished, cancelled=cancelled, abandoned=abandoned), flush=True)
+
+    @staticmethod
+    def sessions(*states: SessionStates):
+        with SESSIONS_CHANGED:
+            return [pair for pair in CONNECTION_PAIRS.values() if pair.state in states]
+
+    @classmethod
+    def drain(cls, timeout: float, deadline: float) -> Tuple[int, int, int, int]:
+        queued = cls.sessions(SessionStates.QUEUED)
+        for pair in queued:
+            remote_error = ErrorMessages.REMOTE_CLOSED.format(my_name=pair.my_name, my_ip=pair.my_ip)
+            pair.cancel(local_message=ErrorMessages.CLOSED, remote_message=remote_error, error_code=ErrorCodes.CLOSED)
+        in_flight = len(cls.sessions(SessionStates.RUNNING, SessionStates.APPLYING))
+        with SESSIONS_CHANGED:
+            SESSIONS_CHANGED.wait_for(lambda: not cls.sessions(SessionStates.RUNNING, SessionStates.APPLYING), timeout=timeout)
+        running = cls.sessions(SessionStates.RUNNING)
+        if running:
+            print(Messages.DRAIN_CANCELLING.format(timeout=timeout, sessions=len(running)), flush=True)
+        for pair in running:
+            remote_error = ErrorMessages.REMOTE_DRAIN_CANCELLED.format(my_name=pair.my_name, my_ip=pair.my_ip)
+            pair.cancel(local_message=ErrorMessages.DRAIN_CANCELLED, remote_message=remote_error, error_code=ErrorCodes.CLOSED)
+        with SESSIONS_CHANGED:
+            SESSIONS_CHANGED.wait_for(lambda: not CONNECTION_PAIRS, timeout=CANCEL_GRACE)  # A session stuck in a command or a lock must not hold the shutdown forever
+            if applying := cls.sessions(SessionStates.APPLYING):  # They may have tailscaled stopped, and KillMode=process would kill them with the daemon
+                print(Messages.DRAIN_APPLYING.format(timeout=max(0.0, deadline - monotonic()), sessions=len(applying)), flush=True)
+                SESSIONS_CHANGED.wait_for(lambda: not cls.sessions(SessionStates.APPLYING), timeout=max(0.0, deadline - monotonic()))
+            abandoned = [f'{pair.id if pair.token is not None else "-"} ({pair.state.name.lower()})' for pair in CONNECTION_PAIRS.values()]
+        if abandoned:
+            print(Messages.DRAIN_ABANDONED.format(sessions=len(abandoned), ids=', '.join(abandoned)), file=sys.stderr, flush=True)
+        return len(queued), in_flight - len(running), len(running), len(abandoned)
 
     @staticmethod
     def upgrade(message: dict, stack: ExitStack):
@@ -131,16 +255,18 @@ class UnixServer:
         allow_suffix, interface = message[MessageFields.ALLOW_SUFFIX], message[MessageFields.INTERFACE]
         iptables_accept, iptables_forward, iptables_masquerade = message[MessageFields.IPTABLES_ACCEPT], message[MessageFields.IPTABLES_FORWARD], message[MessageFields.IPTABLES_MASQUERADE]
         recover_tries, recreate_tries, suffix_number = message[MessageFields.RECOVER_TRIES], message[MessageFields.RECREATE_TRIES], message[MessageFields.SUFFIX_NUMBER]
-        config = check_configfile()
-        wgconfig = check_wgconfig(config)
-        interface = interface or wgconfig.interface or pair.peer_name
-        if suffix_number is not None:
-            interface = interface + str(suffix_number)
-        wgconfig.allow_suffix = allow_suffix if allow_suffix is not None else wgconfig.allow_suffix if wgconfig.allow_suffix is not None else False
-        wgconfig.interface, wgconfig.suffix = check_interface(interface=interface, allow_suffix=wgconfig.allow_suffix)
-        if suffix_number is not None:
-            wgconfig.suffix = suffix_number
-        test_wgconfig(wgconfig)
+        with TIMINGS.span('check_config'):
+            config = check_configfile()
+            wgconfig = check_wgconfig(config)
+            interface = interface or wgconfig.interface or pair.peer_name
+            if suffix_number is not None:
+                interface = interface + str(suffix_number)
+            wgconfig.allow_suffix = allow_suffix if allow_suffix is not None else wgconfig.allow_suffix if wgconfig.allow_suffix is not None else False
+            wgconfig.interface, wgconfig.suffix = check_interface(interface=interface, allow_suffix=wgconfig.allow_suffix)
+            if suffix_number is not None:
+                wgconfig.suffix = suffix_number
+        with TIMINGS.span('test_wgconfig'):
+            test_wgconfig(wgconfig)
         wgconfig.iptables_accept = iptables_accept if iptables_accept is not None else wgconfig.iptables_accept if wgconfig.iptables_accept is not None else False
         wgconfig.iptables_forward = iptables_forward if iptables_forward is not None else wgconfig.iptables_forward if wgconfig.iptables_forward is not None else False
         wgconfig.iptables_masquerade = iptables_masquerade if iptables_masquerade is not None else wgconfig.iptables_masquerade if wgconfig.iptables_masquerade is not None else False
@@ -153,6 +279,7 @@ class UnixServer:
     def recover(message: dict, stack: ExitStack):
         interface = message[MessageFields.INTERFACE]
         latest_handshake = message[MessageFields.LATEST_HANDSHAKE]
-        recover = RecoverConfig.create_from_autoremove(interface=interface, latest_handshake=latest_handshake)
-        check_recover_config(recover)
+        with TIMINGS.span('check_config'):
+            recover = RecoverConfig.create_from_autoremove(interface=interface, latest_handshake=latest_handshake)
+            check_recover_config(recover)
         TCPClient.recover(recover=recover, stack=stack)
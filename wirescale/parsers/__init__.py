@@ -2,7 +2,7 @@
 # encoding:utf-8
 
 
-from wirescale.parsers.parsers import daemon_subparser, exit_node_subparser, recover_subparser, subparsers, top_parser, upgrade_subparser
+from wirescale.parsers.parsers import daemon_subparser, exit_node_subparser, recover_subparser, start_subparser, subparsers, top_parser, upgrade_subparser
 from wirescale.parsers.utils import sort_argparse_help
 
 sort_argparse_help(top_parser)
@@ -10,4 +10,5 @@ sort_argparse_help(subparsers)
 sort_argparse_help(daemon_subparser)
 sort_argparse_help(exit_node_subparser)
 sort_argparse_help(recover_subparser)
+sort_argparse_help(start_subparser)
 sort_argparse_help(upgrade_subparser)
@@ -3,43 +3,61 @@
 
 
 from pathlib import Path
+from typing import Dict, List, TYPE_CHECKING
 
-from wirescale.communications.checkers import get_latest_handshake
-from wirescale.communications.connection_pair import ConnectionPair
-from wirescale.parsers import top_parser
-from wirescale.vpn.tsmanager import TSManager
+from wirescale.parsers import exit_node_subparser, top_parser
+
+if TYPE_CHECKING:
+    from wirescale.communications.connection_pair import ConnectionPair
 
 
 class ARGS:
     ALLOW_SUFFIX: bool = None
+    AUTOREMOVE_UNITS: bool = None
+    BENCH: bool = None
     CONFIGFILE: str = None
+    COUNT: int = None
     DAEMON: bool = None
     DOWN: Path = None
+    DRAIN_TIMEOUT: float = None
+    DURATION: float = None
+    ENDPOINT_REFRESH: int = None
+    EXIT_MEMBERS: Dict[str, int] = None
     EXIT_NODE: bool = None
+    FAILOVER: str = None
+    HEARTBEAT_INTERVAL: float = None
+    HEARTBEAT_MISSES: int = None
     INTERFACE: str = None
     IPTABLES_ACCEPT: bool = None
     IPTABLES_FORWARD: bool = None
     IPTABLES_MASQUERADE: bool = None
     LATEST_HANDSHAKE: int = None
-    PAIR: ConnectionPair = None
+    METRICS_PORT: int = None
+    PAIR: 'ConnectionPair' = None
+    PEER: str = None
+    PREFIXES: List[Path] = None
     RECOVER: bool = None
     RECOVER_TRIES: int = None
     RECREATE_TRIES: int = None
     EXPECTED_INTERFACE: str = None
+    SELF_TEST: bool = None
     START: bool = None
+    STATS: bool = None
     STATUS: bool = None
     STOP: bool = None
-    SYNC: bool = None
+    SYNC: bool | str = None
     SUFFIX_NUMBER: int = None
     UPGRADE: bool = None
 
 
 def parse_args():
     args = vars(top_parser.parse_args())
+    ARGS.BENCH = args.get('opt') == 'bench'
     ARGS.DAEMON = args.get('opt') == 'daemon'
     ARGS.DOWN = args.get('opt') == 'down'
     ARGS.EXIT_NODE = args.get('opt') == 'exit-node'
     ARGS.RECOVER = args.get('opt') == 'recover'
+    ARGS.STATS = args.get('opt') == 'stats'
     ARGS.UPGRADE = args.get('opt') == 'upgrade'
     ARGS.START = args.get('command') == 'start'
     ARGS.STOP = args.get('command') == 'stop'
@@ -47,9 +65,16 @@ def parse_args():
     ARGS.IPTABLES_FORWARD = args.get('iptables_forward')
     ARGS.IPTABLES_MASQUERADE = args.get('iptables_masquerade')
     ARGS.ALLOW_SUFFIX = args.get('suffix')
+    ARGS.AUTOREMOVE_UNITS = args.get('autoremove_units')
+    ARGS.DRAIN_TIMEOUT = args.get('drain_timeout')
+    ARGS.ENDPOINT_REFRESH = args.get('endpoint_refresh')
+    ARGS.HEARTBEAT_INTERVAL = args.get('heartbeat_interval')
+    ARGS.HEARTBEAT_MISSES = args.get('heartbeat_misses')
+    ARGS.METRICS_PORT = args.get('metrics_port')
     if ARGS.UPGRADE:
-        peer_ip = args.get('peer')
-        ARGS.PAIR = ConnectionPair(caller=TSManager.my_ip(), receiver=peer_ip)
+        from wirescale.communications.connection_pair import ConnectionPair
+        ARGS.PEER = args.get('peer')
+        ARGS.PAIR = ConnectionPair()
         ARGS.INTERFACE = args.get('interface')
         ARGS.EXPECTED_INTERFACE = args.get('remote_interface')
         ARGS.RECOVER_TRIES = args.get('recover_tries')
@@ -58,14 +83,30 @@ def parse_args():
         if ARGS.SUFFIX_NUMBER is not None:
             ARGS.ALLOW_SUFFIX = False
     elif ARGS.RECOVER:
+        from wirescale.communications.checkers import get_latest_handshake
         ARGS.INTERFACE = args.get('interface')
         ARGS.LATEST_HANDSHAKE = get_latest_handshake(ARGS.INTERFACE)
+    elif ARGS.BENCH:
+        ARGS.INTERFACE = args['interface'].stem if args.get('interface') is not None else None
+        ARGS.SELF_TEST = args.get('self_test')
+        ARGS.DURATION = args.get('duration')
+        ARGS.COUNT = args.get('count')
     elif ARGS.EXIT_NODE:
-        ARGS.INTERFACE = args.get('interface')
-        if ARGS.INTERFACE is not None:
-            ARGS.INTERFACE = ARGS.INTERFACE.stem
+        members = args.get('interface')
+        ARGS.EXIT_MEMBERS = dict(members)
+        if len(ARGS.EXIT_MEMBERS) < len(members):
+            exit_node_subparser.error('argument INTERFACE[:WEIGHT]: an interface cannot be given more than once')
+        ARGS.INTERFACE = next(iter(ARGS.EXIT_MEMBERS), None)
         ARGS.STATUS = args.get('status')
         ARGS.STOP = args.get('stop')
         ARGS.SYNC = args.get('sync')
+        ARGS.PREFIXES = args.get('prefixes')
+        if ARGS.PREFIXES is not None and ARGS.INTERFACE is None:
+            exit_node_subparser.error('argument --prefixes: an interface is required')
+        ARGS.FAILOVER = args.get('failover')
+        if ARGS.FAILOVER is not None and ARGS.INTERFACE is None:
+            exit_node_subparser.error('argument --failover: at least one interface is required')
+        if ARGS.FAILOVER is not None and any(weight != 1 for weight in ARGS.EXIT_MEMBERS.values()):
+            exit_node_subparser.error('argument --failover: candidates cannot have weights')
     elif ARGS.DOWN:
         ARGS.CONFIGFILE = args.get('interface')
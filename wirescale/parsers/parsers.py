@@ -5,7 +5,7 @@
 from argparse import ArgumentParser, BooleanOptionalAction
 
 from wirescale.parsers.utils import CustomArgumentFormatter
-from wirescale.parsers.validators import check_existing_conf, check_existing_conf_and_systemd, check_peer, check_positive, interface_name_validator
+from wirescale.parsers.validators import check_existing_conf, check_existing_conf_and_systemd, check_drain_timeout, check_existing_file, check_exit_member, check_peer, check_positive, check_positive_float, interface_name_validator
 from wirescale.version import version_msg
 
 top_parser = ArgumentParser(prog='wirescale', description='Upgrade your existing Tailscale connection by transitioning to pure WireGuard', formatter_class=CustomArgumentFormatter)
@@ -14,8 +14,24 @@ subparsers = top_parser.add_subparsers(dest='opt')
 daemon_subparser = subparsers.add_parser('daemon', formatter_class=CustomArgumentFormatter, help='commands for systemd to manage the daemon',
                                          description='Commands for systemd to manage the daemon')
 order_subparser = daemon_subparser.add_subparsers(dest='command', required=True)
-order_subparser.add_parser('start', help="start the daemon. Must be run by systemd", add_help=False)
+start_subparser = order_subparser.add_parser('start', formatter_class=CustomArgumentFormatter, help="start the daemon. Must be run by systemd",
+                                             description='Start the daemon. Must be run by systemd')
 order_subparser.add_parser('stop', help="stop the daemon. Must be run with sudo", add_help=False)
+start_subparser.add_argument('--drain-timeout', type=check_drain_timeout, metavar='SECONDS',
+                             help='on shutdown, seconds to wait for in-flight requests to finish before cancelling those that are not applying changes. '
+                                  'Sessions that are applying changes are waited for until the daemon has to stop. At most 45.\nDefault is 30')
+daemon_subparser.add_argument('--autoremove-units', action=BooleanOptionalAction,
+                              help='monitor each tunnel with its own autoremove systemd unit instead of inside the daemon.\n'
+                                   'Disabled by default')
+daemon_subparser.add_argument('--endpoint-refresh', type=check_positive, metavar='SECONDS',
+                              help='seconds between background refreshes of the cached endpoints of peers configured in /etc/wirescale/. Use 0 to disable them.\n'
+                                   'Default is 60')
+daemon_subparser.add_argument('--heartbeat-interval', type=check_positive_float, metavar='SECONDS',
+                              help='seconds between the heartbeats sent over connections to other peers.\n'
+                                   'Default is 5')
+daemon_subparser.add_argument('--heartbeat-misses', type=check_positive, metavar='N',
+                              help='consecutive missed heartbeats before checking with Tailscale whether the peer is still reachable.\n'
+                                   'Default is 3')
 daemon_subparser.add_argument('--iptables-accept', action=BooleanOptionalAction,
                               help='add iptables rules that allow incoming traffic through new network interfaces. Use this only if the connection is unstable.\n'
                                    'Disabled by default')
@@ -24,6 +40,9 @@ daemon_subparser.add_argument('--iptables-forward', action=BooleanOptionalAction
 daemon_subparser.add_argument('--iptables-masquerade', action=BooleanOptionalAction,
                               help='add iptables rules to mark and masquerade traffic routed through new network interfaces. Use this to enable NAT for outgoing packets.\n'
                                    'Disabled by default')
+daemon_subparser.add_argument('--metrics-port', type=check_positive, metavar='PORT',
+                              help='serve OpenMetrics on http://127.0.0.1:PORT/metrics, built from what the daemon already keeps in memory.\n'
+                                   'Disabled by default')
 daemon_subparser.add_argument('--suffix', action=BooleanOptionalAction,
                               help='add numeric suffix to new interfaces with existing names.\n'
                                    'Disabled by default')
@@ -34,7 +53,7 @@ down_subparser.add_argument('interface', type=check_existing_conf, help="shortcu
 
 upgrade_subparser = subparsers.add_parser('upgrade', formatter_class=CustomArgumentFormatter, help='duplicates a Tailscale connection with pure WireGuard',
                                           description='Duplicates a Tailscale connection with pure WireGuard')
-upgrade_subparser.add_argument('peer', type=check_peer, help='either the Tailscale IP address or the name of the peer you want to connect to')
+peer_argument = upgrade_subparser.add_argument('peer', type=check_peer, help='either the Tailscale IP address or the name of the peer you want to connect to')
 upgrade_subparser.add_argument('--iptables-accept', action=BooleanOptionalAction,
                                help='add iptables rules that allow incoming traffic through the new network interface. Use this only if the connection is unstable.\n'
                                     'Disabled by default')
@@ -64,10 +83,37 @@ upgrade_subparser.add_argument('--recreate-tries', type=int, metavar='N',
 exit_node_subparser = subparsers.add_parser('exit-node', formatter_class=CustomArgumentFormatter, help='set up a peer as an exit node for all outgoing traffic',
                                             description='Configure a peer with an existing WireGuard connection as an exit node. This will route all outgoing traffic through the specified peer')
 mutex_group = exit_node_subparser.add_mutually_exclusive_group(required=True)
-mutex_group.add_argument('interface', nargs='?', default=None, type=check_existing_conf, help='interface to use as the exit node')
-mutex_group.add_argument('--status', action='store_true', help='print the current exit node interface, if any')
-mutex_group.add_argument('--sync', action='store_true', help='sync between actual peers and state file.\nIntended for internal use only')
+mutex_group.add_argument('interface', nargs='*', default=[], type=check_exit_member, metavar='INTERFACE[:WEIGHT]',
+                         help='interface to use as the exit node. Give several of them to share the outgoing traffic among their peers, '
+                              'balanced per flow in proportion to their weights (1 to 256).\nDefault weight is 1')
+mutex_group.add_argument('--status', action='store_true', help='print the current exit node interface, if any, or how the traffic is being shared among its members')
+mutex_group.add_argument('--sync', nargs='?', const=True, metavar='INTERFACE', help='sync between actual peers and state file, only for the given interface if any.\n'
+                                                                                 'Intended for internal use only')
 mutex_group.add_argument('--stop', action='store_true', help='disable exit node functionality and revert to normal routing')
+exit_node_subparser.add_argument('--failover', nargs='?', const='ordered', choices=('ordered', 'latency'), metavar='MODE',
+                                 help="treat the given interfaces as candidates instead of members: only one of them is the exit node, and the daemon moves it to another "
+                                      "when it stops answering or, in 'latency' mode, when another one has been clearly faster for a while. "
+                                      "In 'ordered' mode, the first healthy candidate is preferred.\nDefault mode is 'ordered'")
+exit_node_subparser.add_argument('--prefixes', nargs='+', type=check_existing_file, metavar='FILE',
+                                 help='route only the destinations listed in these files through the exit node, one IPv4 prefix per line. '
+                                      'Running it again on the current exit node installs only the differences, and leaving it out goes back to routing everything')
+
+stats_subparser = subparsers.add_parser('stats', formatter_class=CustomArgumentFormatter, help='show how long each phase of the recent upgrade and recover sessions took',
+                                        description='Show the 50th, 90th and 99th percentiles and the maximum time spent in each phase of the latest upgrade and '
+                                                    'recover sessions handled by the running daemon, split by whether this machine started them or answered them')
+
+bench_subparser = subparsers.add_parser('bench', formatter_class=CustomArgumentFormatter, help='compare the throughput, latency and jitter of a tunnel with those of the Tailscale path',
+                                        description='Measure TCP throughput and UDP round-trip time, jitter and loss to the peer at the other end of a tunnel, both through the '
+                                                    'tunnel and through its Tailscale IP, and compare them. The peer must be running wirescale too')
+bench_group = bench_subparser.add_mutually_exclusive_group(required=True)
+bench_group.add_argument('interface', nargs='?', type=check_existing_conf, help='local WireGuard interface set up by wirescale whose peer will be measured')
+bench_group.add_argument('--self-test', action='store_true',
+                         help='measure a WireGuard tunnel against the veth pair it runs on, both set up in a network namespace of this machine. '
+                              'Needs no peer and no Tailscale, but needs the wireguard kernel module')
+bench_subparser.add_argument('--duration', type=check_positive_float, default=5, metavar='SECONDS',
+                             help='seconds spent sending data to measure the throughput of each path.\nDefault is 5')
+bench_subparser.add_argument('--count', type=check_positive, default=100, metavar='N',
+                             help='UDP pings sent to measure the latency, jitter and loss of each path.\nDefault is 100')
 
 recover_subparser = subparsers.add_parser('recover', formatter_class=CustomArgumentFormatter, help='recover a dropped connection by forcing a new hole punching.\nIntended for internal use only',
                                           description='Recover a dropped connection by forcing a new hole punching')
@@ -7,13 +7,8 @@ import subprocess
 from argparse import ArgumentTypeError
 from contextlib import redirect_stderr
 from io import StringIO
-from ipaddress import IPv4Address
 from pathlib import Path
-
-from wirescale.communications.common import file_locker
-from wirescale.communications.messages import ErrorMessages
-from wirescale.communications.systemd import Systemd
-from wirescale.vpn.tsmanager import TSManager
+from typing import Tuple
 
 
 def check_positive(value):
@@ -23,22 +18,26 @@ def check_positive(value):
     return value
 
 
-def check_peer(value) -> IPv4Address:
+def check_positive_float(value):
+    value = float(value)
+    if value <= 0:
+        raise ArgumentTypeError(f'{value} is not a positive number')
+    return value
+
+
+def check_drain_timeout(value):
+    from wirescale.communications.common import CANCEL_GRACE, STOP_TIMEOUT
+    value = check_positive_float(value)
+    if value > STOP_TIMEOUT - CANCEL_GRACE:
+        raise ArgumentTypeError(f'{value:g} is over the {STOP_TIMEOUT - CANCEL_GRACE} seconds the daemon can wait before it has to stop')
+    return value
+
+
+def check_peer(value) -> str:
     value = value.strip()
     if not value:
         raise ArgumentTypeError('you provided an empty peer')
-    print(f"Checking peer '{value}' is correct. This might take some minutes...")
-    with file_locker():
-        print(f"Start checking peer '{value}'")
-        try:
-            ip = IPv4Address(value)
-        except Exception:
-            ip = TSManager.peer_ip(value)
-        if ip == TSManager.my_ip():
-            raise ArgumentTypeError('you should not connect to your own machine')
-        TSManager.peer(ip)  # Checks the IP belongs to somebody
-        TSManager.peer_endpoint(ip)  # Checks an endpoint is available
-    return ip
+    return value
 
 
 def check_existing_conf(value) -> Path:
@@ -48,9 +47,25 @@ def check_existing_conf(value) -> Path:
     return res.resolve()
 
 
+def check_exit_member(value) -> Tuple[str, int]:
+    interface, _, weight = value.partition(':')
+    check_existing_conf(interface)
+    if weight and not (weight.isdigit() and 1 <= int(weight) <= 256):
+        raise ArgumentTypeError(f"weight '{weight}' of interface '{interface}' is not an integer between 1 and 256")
+    return interface, int(weight or 1)
+
+
+def check_existing_file(value) -> Path:
+    res = Path(value)
+    if not res.is_file():
+        raise ArgumentTypeError(f"file '{res}' does not exist")
+    return res.resolve()
+
+
 def check_existing_wg_interface(value):
     res = subprocess.run(['wg', 'show', value, 'listen-port'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
     if res != 0:
+        from wirescale.communications.messages import ErrorMessages
         error = ErrorMessages.WG_INTERFACE_MISSING.format(interface=value)
         raise ArgumentTypeError(error[7:])
     return value
@@ -59,6 +74,7 @@ def check_existing_wg_interface(value):
 def check_existing_conf_and_systemd(value) -> str:
     check_existing_wg_interface(value)
     check_existing_conf(value)
+    from wirescale.communications.systemd import Systemd
     unit = f'autoremove-{value}'
     try:
         with redirect_stderr(StringIO()) as error:
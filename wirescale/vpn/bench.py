@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+
+import ctypes
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+from contextlib import suppress
+from ipaddress import IPv4Address
+from pathlib import Path
+from threading import Event, Thread, Timer
+from time import perf_counter, sleep
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from wirescale.communications.messages import ErrorMessages, Messages
+from wirescale.communications.timing import SessionTimings
+
+
+class BenchServer:
+    CHUNK = 1 << 16
+    LIFETIME = 300
+    POLL = 0.2
+
+    def __init__(self, addresses: Iterable[IPv4Address], allowed: Iterable[IPv4Address]):
+        self.allowed = {str(ip) for ip in allowed}
+        self.stopped = Event()
+        self.sockets: List[socket.socket] = []
+        self.ports: Dict[str, Tuple[int, int]] = {}
+        for address in addresses:
+            tcp = socket.create_server((str(address), 0))
+            udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp.bind((str(address), 0))
+            for listener in (tcp, udp):
+                listener.settimeout(self.POLL)
+                self.sockets.append(listener)
+            self.ports[str(address)] = (tcp.getsockname()[1], udp.getsockname()[1])
+
+    def __enter__(self):
+        for listener in self.sockets:
+            target = self.accept if listener.type == socket.SOCK_STREAM else self.echo
+            Thread(target=target, args=(listener,), daemon=True).start()
+        self.timer = Timer(self.LIFETIME, self.__exit__)  # Nothing outlives a client that never came back
+        self.timer.daemon = True
+        self.timer.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.timer.cancel()
+        for listener in self.sockets:
+            listener.close()
+
+    def accept(self, listener: socket.socket):
+        while not self.stopped.is_set():
+            try:
+                connection, (ip, port) = listener.accept()
+            except TimeoutError:
+                continue
+            except OSError:
+                return
+            if ip not in self.allowed:
+                connection.close()
+                continue
+            Thread(target=self.sink, args=(connection,), daemon=True).start()
+
+    def sink(self, connection: socket.socket):
+        received = 0
+        with connection, suppress(OSError):
+            connection.settimeout(self.LIFETIME)
+            while chunk := connection.recv(self.CHUNK):
+                received += len(chunk)
+            connection.sendall(struct.pack('!Q', received))
+
+    def echo(self, listener: socket.socket):
+        while not self.stopped.is_set():
+            try:
+                data, (ip, port) = listener.recvfrom(self.CHUNK)
+            except TimeoutError:
+                continue
+            except OSError:
+                return
+            if ip in self.allowed:
+                with suppress(OSError):
+                    listener.sendto(data, (ip, port))
+
+
+class DataPlaneBench:
+    CLONE_NEWNET = 0x40000000
+    CONNECT_TIMEOUT = 5
+    PING_INTERVAL = 0.01
+    PING_TIMEOUT = 1
+    SELF_TEST_NETNS = 'wirescale-bench'
+    SELF_TEST_UNDERLAY = (IPv4Address('198.18.0.1'), IPv4Address('198.18.0.2'))  # RFC 2544 benchmarking range
+    SELF_TEST_TUNNEL = (IPv4Address('198.19.0.1'), IPv4Address('198.19.0.2'))
+
+    @classmethod
+    def throughput(cls, address: IPv4Address, port: int, seconds: float, source: IPv4Address = None) -> float:
+        payload = bytes(BenchServer.CHUNK)
+        source_address = (str(source), 0) if source is not None else None
+        with socket.create_connection((str(address), port), timeout=cls.CONNECT_TIMEOUT, source_address=source_address) as connection:
+            start = perf_counter()
+            while perf_counter() - start < seconds:
+                connection.sendall(payload)
+            connection.shutdown(socket.SHUT_WR)
+            connection.settimeout(BenchServer.LIFETIME)
+            answer = b''
+            while len(answer) < 8 and (chunk := connection.recv(8 - len(answer))):
+                answer += chunk
+            elapsed = perf_counter() - start
+        if len(answer) < 8:
+            raise ConnectionResetError(f'{address}:{port} closed the connection before reporting the received bytes')
+        return struct.unpack('!Q', answer)[0] * 8 / elapsed / 1e6
+
+    @classmethod
+    def latency(cls, address: IPv4Address, port: int, count: int, source: IPv4Address = None) -> Dict[str, float]:
+        rtts, lost = [], 0
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+            if source is not None:
+                udp.bind((str(source), 0))
+            udp.connect((str(address), port))
+            for sequence in range(count):
+                sent = perf_counter()
+                try:
+                    udp.send(struct.pack('!Id', sequence, sent))
+                    while (remaining := sent + cls.PING_TIMEOUT - perf_counter()) > 0:
+                        udp.settimeout(remaining)
+                        if struct.unpack('!Id', udp.recv(64))[0] == sequence:  # Late answers to earlier pings are dropped
+                            rtts.append((perf_counter() - sent) * 1000)
+                            break
+                    else:
+                        lost += 1
+                except OSError:  # Timeouts and ICMP errors alike
+                    lost += 1
+                sleep(cls.PING_INTERVAL)
+        if not rtts:
+            raise TimeoutError(f'no answer from {address}:{port} to {count} UDP pings')
+        jitter = sum(abs(current - previous) for previous, current in zip(rtts, rtts[1:])) / max(len(rtts) - 1, 1)  # Mean packet delay variation, as in RFC 3550
+        ordered = sorted(rtts)
+        return {'rtt_min_ms': ordered[0], 'rtt_p50_ms': SessionTimings.percentile(ordered, 50), 'rtt_p90_ms': SessionTimings.percentile(ordered, 90),
+                'jitter_ms': jitter, 'lost': lost, 'sent': count}
+
+    @classmethod
+    def run(cls, paths: Dict[str, Tuple[IPv4Address, int, int, IPv4Address | None]], seconds: float, count: int) -> Dict[str, Dict]:
+        results = {}
+        for name, (address, tcp_port, udp_port, source) in paths.items():
+            result = results[name] = {'address': str(address)}
+            try:
+                result.update(cls.latency(address, udp_port, count=count, source=source))
+                result['mbps'] = cls.throughput(address, tcp_port, seconds=seconds, source=source)
+            except OSError as error:
+                result['error'] = str(error) or type(error).__name__
+        return results
+
+    @staticmethod
+    def report(results: Dict[str, Dict], title: str) -> List[str]:
+        lines = [title, f"{'path':<12}{'address':<18}{'Mbit/s':>10}{'min ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'jitter ms':>11}{'lost':>10}"]
+        for name, result in results.items():
+            if 'error' in result and 'rtt_p50_ms' not in result:
+                lines.append(f"{name:<12}{result['address']:<18}  {result['error']}")
+                continue
+            mbps, lost = f"{result['mbps']:.1f}" if 'mbps' in result else '-', f"{result['lost']}/{result['sent']}"
+            lines.append(f"{name:<12}{result['address']:<18}{mbps:>10}{result['rtt_min_ms']:>10.2f}{result['rtt_p50_ms']:>10.2f}{result['rtt_p90_ms']:>10.2f}{result['jitter_ms']:>11.2f}{lost:>10}")
+            if 'error' in result:
+                lines.append(f"{'':<12}{'':<18}  throughput: {result['error']}")
+        tunnel, baseline = results.get('wirescale', {}), next((name for name in results if name != 'wirescale'), None)
+        if 'mbps' in tunnel and 'mbps' in results.get(baseline, {}):
+            throughput, latency = tunnel['mbps'] / results[baseline]['mbps'], tunnel['rtt_p50_ms'] / results[baseline]['rtt_p50_ms']
+            lines.append(Messages.BENCH_COMPARISON.format(baseline=baseline, throughput=throughput, latency=latency))
+        return lines
+
+    @classmethod
+    def in_netns(cls, netns: str, function: Callable):
+        # setns() only moves the calling thread, and the sockets it opens stay in the namespace for good
+        result = {}
+
+        def target():
+            try:
+                with open(Path('/run/netns', netns)) as f:
+                    if ctypes.CDLL(None, use_errno=True).setns(f.fileno(), cls.CLONE_NEWNET) != 0:
+                        raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+                result['value'] = function()
+            except BaseException as error:
+                result['error'] = error
+
+        thread = Thread(target=target)
+        thread.start()
+        thread.join()
+        if 'error' in result:
+            raise result['error']
+        return result['value']
+
+    @staticmethod
+    def command(*args: str, input: str = None) -> str:
+        try:
+            return subprocess.run(args, input=input, capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError) as error:
+            detail = error.stderr.strip() if isinstance(error, subprocess.CalledProcessError) else str(error)
+            ErrorMessages.send_error_message(local_message=ErrorMessages.BENCH_SELF_TEST.format(command=' '.join(args), error=detail))
+
+    @classmethod
+    def setup_self_test(cls, directory: Path):
+        netns, (local_underlay, remote_underlay), (local_tunnel, remote_tunnel) = cls.SELF_TEST_NETNS, cls.SELF_TEST_UNDERLAY, cls.SELF_TEST_TUNNEL
+        cls.command('ip', 'netns', 'add', netns)
+        cls.command('ip', 'link', 'add', 'wsbench0', 'type', 'veth', 'peer', 'name', 'wsbench1', 'netns', netns)
+        cls.command('ip', 'link', 'add', 'wsbench-wg0', 'type', 'wireguard')
+        cls.command('ip', '-n', netns, 'link', 'add', 'wsbench-wg1', 'type', 'wireguard')  # Created inside, so its UDP socket lives there too
+        keys = []
+        for side in (0, 1):
+            private = cls.command('wg', 'genkey')
+            directory.joinpath(f'{side}.key').write_text(private)
+            keys.append(cls.command('wg', 'pubkey', input=private))
+        cls.command('wg', 'set', 'wsbench-wg0', 'private-key', str(directory.joinpath('0.key')))
+        cls.command('ip', 'netns', 'exec', netns, 'wg', 'set', 'wsbench-wg1', 'private-key', str(directory.joinpath('1.key')))
+        ports = (cls.command('wg', 'show', 'wsbench-wg0', 'listen-port'), cls.command('ip', 'netns', 'exec', netns, 'wg', 'show', 'wsbench-wg1', 'listen-port'))
+        cls.command('wg', 'set', 'wsbench-wg0', 'peer', keys[1], 'allowed-ips', f'{remote_tunnel}/32', 'endpoint', f'{remote_underlay}:{ports[1]}')
+        cls.command('ip', 'netns', 'exec', netns, 'wg', 'set', 'wsbench-wg1', 'peer', keys[0], 'allowed-ips', f'{local_tunnel}/32', 'endpoint', f'{local_underlay}:{ports[0]}')
+        for prefix, veth, wg, underlay, tunnel in ((('ip',), 'wsbench0', 'wsbench-wg0', local_underlay, local_tunnel), (('ip', '-n', netns), 'wsbench1', 'wsbench-wg1', remote_underlay, remote_tunnel)):
+            cls.command(*prefix, 'address', 'add', f'{underlay}/30', 'dev', veth)
+            cls.command(*prefix, 'address', 'add', f'{tunnel}/30', 'dev', wg)
+            cls.command(*prefix, 'link', 'set', veth, 'up')
+            cls.command(*prefix, 'link', 'set', wg, 'up')
+        cls.command('ip', '-n', netns, 'link', 'set', 'lo', 'up')
+
+    @classmethod
+    def cleanup_self_test(cls):
+        for args in (('ip', 'link', 'del', 'wsbench0'), ('ip', 'link', 'del', 'wsbench-wg0'), ('ip', 'netns', 'del', cls.SELF_TEST_NETNS)):
+            subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    @classmethod
+    def self_test(cls, seconds: float, count: int):
+        (local_underlay, remote_underlay), (local_tunnel, remote_tunnel) = cls.SELF_TEST_UNDERLAY, cls.SELF_TEST_TUNNEL
+        cls.cleanup_self_test()  # Leftovers of an interrupted run
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                cls.setup_self_test(Path(directory))
+            server = cls.in_netns(cls.SELF_TEST_NETNS, lambda: BenchServer(addresses=(remote_underlay, remote_tunnel), allowed=(local_underlay, local_tunnel)))
+            with server:
+                paths = {'underlay': (remote_underlay, *server.ports[str(remote_underlay)], None), 'wirescale': (remote_tunnel, *server.ports[str(remote_tunnel)], None)}
+                results = cls.run(paths, seconds=seconds, count=count)
+        finally:
+            cls.cleanup_self_test()
+        print('\n'.join(cls.report(results, title=Messages.BENCH_SELF_TEST)), flush=True)
+        if any('error' in result for result in results.values()):
+            sys.exit(1)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+
+import json
+import subprocess
+import sys
+from ipaddress import IPv4Address
+from threading import Lock
+from time import monotonic
+from typing import Dict, Tuple
+
+from wirescale.communications.commands import COMMANDS
+from wirescale.communications.common import SHUTDOWN
+from wirescale.communications.messages import ErrorMessages
+from wirescale.vpn.tsmanager import TSManager
+
+
+class CachedEndpoint:
+    def __init__(self, endpoint: Tuple[IPv4Address, int], rtt: float, netmap: Tuple):
+        self.endpoint = endpoint
+        self.rtt = rtt
+        self.netmap = netmap
+        self.time = monotonic()
+        self.ts_stops = TSManager.STOPS
+
+    @property
+    def age(self) -> float:
+        return monotonic() - self.time
+
+
+class EndpointCache:
+    MAX_AGE = 180
+    PROBE_COUNT = 10
+    REFRESH_INTERVAL = 60
+    STATUS_TTL = 30
+
+    def __init__(self):
+        self.entries: Dict[IPv4Address, CachedEndpoint] = {}
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.status: Tuple[float, Dict] = None
+
+    def tailnet(self, refresh: bool = False) -> Dict:
+        status = self.status
+        if refresh or status is None or monotonic() - status[0] > self.STATUS_TTL:
+            result = COMMANDS.run(['tailscale', 'status', '--json'], capture_output=True, text=True)
+            if result.returncode != 0:
+                return {}
+            status = self.status = (monotonic(), json.loads(result.stdout))
+        return status[1]
+
+    def netmap(self, refresh: bool = False) -> Dict[IPv4Address, Tuple]:
+        res = {}
+        for peer in (self.tailnet(refresh).get('Peer') or {}).values():
+            ip = next((IPv4Address(ip) for ip in peer.get('TailscaleIPs') or () if '.' in ip), None)
+            if ip is not None:
+                res[ip] = (peer.get('CurAddr'), tuple(peer.get('Addrs') or ()), peer.get('Relay'))
+        return res
+
+    def get(self, ip: IPv4Address) -> CachedEndpoint | None:
+        with self.lock:
+            entry = self.entries.get(ip)
+        # Only a fresh netmap tells whether the peer restarted tailscaled or moved since the probe, and a cached endpoint still saves its 30 pings
+        if entry is None or entry.ts_stops != TSManager.STOPS or entry.age > self.MAX_AGE or self.netmap(refresh=True).get(ip) != entry.netmap:
+            self.misses += 1
+            self.invalidate(ip)
+            return None
+        self.hits += 1
+        return entry
+
+    def store(self, ip: IPv4Address, endpoint: Tuple[IPv4Address, int], rtt: float, netmap: Tuple = None):
+        netmap = netmap if netmap is not None else self.netmap(refresh=True).get(ip)  # The probe may have just moved the peer to a direct path
+        with self.lock:
+            self.entries[ip] = CachedEndpoint(endpoint=endpoint, rtt=rtt, netmap=netmap)
+
+    def invalidate(self, ip: IPv4Address = None):
+        with self.lock:
+            if ip is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(ip, None)
+
+    def configured_peers(self) -> Dict[IPv4Address, str]:
+        status, res = self.tailnet(), {}
+        suffix = (status.get('MagicDNSSuffix') or '').lower()
+        for peer in (status.get('Peer') or {}).values():
+            ip = next((IPv4Address(ip) for ip in peer.get('TailscaleIPs') or () if '.' in ip), None)
+            name = TSManager.node_name(peer, suffix)
+            if ip is not None and TSManager.config_file(name).is_file():
+                res[ip] = name
+        return res
+
+    def refresh(self):
+        netmap = self.netmap(refresh=True)
+        for ip in self.configured_peers():
+            if SHUTDOWN.is_set():
+                return
+            with self.lock:
+                entry = self.entries.get(ip)
+            if entry is not None and entry.ts_stops == TSManager.STOPS and entry.netmap == netmap.get(ip) and entry.age < self.MAX_AGE - self.REFRESH_INTERVAL:
+                continue
+            ts_stops = TSManager.STOPS
+            probe = TSManager.probe_endpoint(ip, count=self.PROBE_COUNT)
+            if probe is None or TSManager.STOPS != ts_stops:  # Tailscale was restarted while probing, so the result means nothing
+                self.invalidate(ip)
+                continue
+            self.store(ip, *probe)
+
+    def refresh_loop(self, interval: float):
+        self.REFRESH_INTERVAL = interval
+        while not SHUTDOWN.is_set():
+            try:
+                self.refresh()
+            except (OSError, subprocess.SubprocessError, ValueError, KeyError) as error:
+                print(ErrorMessages.ENDPOINT_REFRESH.format(interval=interval, error=repr(error)), file=sys.stderr, flush=True)
+            SHUTDOWN.wait(timeout=interval)
+
+
+ENDPOINTS = EndpointCache()
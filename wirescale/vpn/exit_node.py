@@ -5,79 +5,273 @@
 import collections
 import fcntl
 import json
+import os
+import re
 import subprocess
 import sys
 from contextlib import contextmanager
-from ipaddress import ip_network, IPv4Network, IPv6Network
+from ipaddress import collapse_addresses, ip_network, IPv4Network, IPv6Network
 from pathlib import Path
-from typing import Dict, List, Optional, Set
+from time import monotonic
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
-from wirescale.communications.common import EXIT_NODE_MARK, GLOB_MARK, WIRESCALE_TABLE
-from wirescale.communications.messages import Messages
+from wirescale.communications.commands import COMMANDS
+from wirescale.communications.common import EXIT_NODE_MARK, GLOB_MARK, WIRESCALE_PROTOCOL, WIRESCALE_TABLE
+from wirescale.communications.messages import ErrorMessages, Messages
 from wirescale.communications.systemd import Systemd
 
 
+class RuleTransaction:
+    """Routing and firewall changes compiled into a single 'ip -batch' and a single 'iptables-restore' run."""
+
+    def __init__(self):
+        self.ip: List[Tuple[str, str]] = []
+        self.mangle: List[Tuple[str, str]] = []
+        self.elapsed: float = 0
+
+    def add_ip(self, command: str, undo: str) -> None:
+        """Add an 'ip -4' command along with the one that reverts it."""
+        self.ip.append((command, undo))
+
+    def add_mangle(self, rule: str, undo: str) -> None:
+        """Add a rule for the mangle table along with the one that reverts it."""
+        self.mangle.append((rule, undo))
+
+    @staticmethod
+    def batch(commands: List[str], force: bool = False) -> Optional[int]:
+        """Run the commands through 'ip -batch' and return how many of them were applied if one failed."""
+        command = ['ip', '-4', '-force', '-batch', '-'] if force else ['ip', '-4', '-batch', '-']
+        result = COMMANDS.run(command, input='\n'.join(commands) + '\n', stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding='utf-8')
+        if result.returncode == 0:
+            return None
+        failed = re.search(r'Command failed -:(\d+)', result.stderr)
+        return int(failed.group(1)) - 1 if failed else 0
+
+    @staticmethod
+    def restore(rules: List[str]) -> bool:
+        """Apply the rules to the mangle table in a single commit."""
+        rules = '\n'.join(('*mangle', *rules, 'COMMIT', ''))
+        return COMMANDS.run(['iptables-restore', '--noflush'], input=rules, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, encoding='utf-8').returncode == 0
+
+    def apply(self) -> bool:
+        """Apply every change, or none of them."""
+        start = monotonic()
+        try:
+            if self.mangle and not self.restore([rule for rule, _ in self.mangle]):
+                return False
+            if self.ip and (applied := self.batch([command for command, _ in self.ip])) is not None:
+                self.batch([undo for _, undo in reversed(self.ip[:applied])], force=True)
+                self.restore([undo for _, undo in reversed(self.mangle)]) if self.mangle else None
+                return False
+            return True
+        finally:
+            self.elapsed = monotonic() - start
+
+
+class PriorityAllocator:
+    """Rule priorities for the peers that have their own fwmark, kept as a bitmap of the ones in use."""
+    FIRST = 5502
+    LAST = 5999
+
+    def __init__(self, used: Iterable[int]):
+        self.bitmap = 0
+        for priority in used:
+            self.bitmap |= 1 << (priority - self.FIRST)
+
+    def allocate(self) -> Optional[int]:
+        """Take the lowest free priority."""
+        free = ~self.bitmap & (self.bitmap + 1)
+        priority = self.FIRST + free.bit_length() - 1
+        if priority > self.LAST:
+            return None
+        self.bitmap |= free
+        return priority
+
+    def release(self, priority: int) -> None:
+        """Give a priority back."""
+        self.bitmap &= ~(1 << (priority - self.FIRST))
+
+
 class ExitNode:
     GLOBAL_NETWORK = ip_network('0.0.0.0/0')
     DIRECTORY = Path('/run/wirescale/')
     EXIT_FILE = DIRECTORY.joinpath('control/exit-node')
+    JOURNAL = DIRECTORY.joinpath('control/exit-node.journal')
+    JOURNAL_LIMIT = 64 * 1024
+    INTERFACES = Path('/sys/class/net')
     LOCKER = DIRECTORY.joinpath('control/exit-node-locker')
+    MEASUREMENTS = DIRECTORY.joinpath('control/exit-node-measurements.json')
+    HASH_POLICY = 'net.ipv4.fib_multipath_hash_policy=1'  # Balance by flow (addresses, ports and protocol) instead of by address pair only
     ADD_ALLOWEDIPS = 'add-allowedips'
+    BASELINE = 'baseline'
+    CANDIDATES = 'candidates'
     EXIT_NODE = 'exit-node'
+    FAILOVER = 'failover'
+    LATENCY = 'latency'
+    MARKS = 'marks'
+    MEMBERS = 'members'
+    MODE = 'mode'
     NODES = 'nodes'
+    ORDERED = 'ordered'
+    PREFIXES = 'prefixes'
     SUPPRESS = 'suppress'
-    RULES: Dict[str, List[str]] = {
-        SUPPRESS: ['ip', '-4', 'rule', 'add', 'pref', '5500', 'table', 'main', 'suppress_prefixlength', '0'],
-        NODES: ['ip', '-4', 'rule', 'add', 'pref', '5501', 'fwmark', str(GLOB_MARK), 'table', 'main'],
-        EXIT_NODE: ['ip', '-4', 'rule', 'add', 'pref', '6000', 'not', 'fwmark', '{fwmark}', 'table', str(WIRESCALE_TABLE)],
+    PRIORITIES = range(5500, 6001)
+    PRIORITY: Dict[str, int] = {SUPPRESS: 5500, NODES: 5501, EXIT_NODE: 6000}
+    TAG = f'proto {WIRESCALE_PROTOCOL}'
+    RULES: Dict[str, str] = {  # As printed by 'ip rule show', so they can be compared with the installed ones
+        SUPPRESS: 'from all lookup main suppress_prefixlength 0 ' + TAG,
+        NODES: 'from all fwmark {fwmark:#x} lookup main ' + TAG,
+        EXIT_NODE: 'not from all fwmark {fwmark:#x} lookup ' + str(WIRESCALE_TABLE) + ' ' + TAG,
     }
-    SAVE_CONNMARK = ['iptables', '-t', 'mangle', '-I', 'POSTROUTING', '-m', 'mark', '--mark', '{mark}', '-p', 'udp', '-j', 'CONNMARK', '--save-mark', '-m', 'comment', '--comment',
-                     'wirescale-{interface}']
-    RESTORE_CONNMARK = ['iptables', '-t', 'mangle', '-I', 'PREROUTING', '-p', 'udp', '-j', 'CONNMARK', '--restore-mark', '-m', 'comment', '--comment', 'wirescale-{interface}']
+    SAVE_CONNMARK = 'POSTROUTING -m mark --mark {mark} -p udp -j CONNMARK --save-mark -m comment --comment "wirescale-{interface}"'
+    RESTORE_CONNMARK = 'PREROUTING -p udp -j CONNMARK --restore-mark -m comment --comment "wirescale-{interface}"'
     GOOD = '✅'
     BAD = '❌'
 
     @classmethod
     def load_config(cls) -> Optional[Dict]:
-        """Load the exit node configuration from file."""
+        """Load the exit node configuration from file, replaying the changes journaled since it was written."""
         if not cls.EXIT_FILE.exists():
             return None
         with cls.EXIT_FILE.open('r') as f:
-            return json.load(f)
+            config = json.load(f)
+        config.setdefault(cls.MARKS, {})
+        config.setdefault(cls.MEMBERS, {config[cls.EXIT_NODE]: 1})  # Written before an exit node could have several members
+        config.setdefault(cls.BASELINE, {})
+        if isinstance(config[cls.ADD_ALLOWEDIPS], bool):
+            config[cls.ADD_ALLOWEDIPS] = [config[cls.EXIT_NODE]] if config[cls.ADD_ALLOWEDIPS] else []
+        if cls.JOURNAL.exists():
+            with cls.JOURNAL.open('r') as f:
+                for line in f:
+                    try:
+                        cls.replay(config, json.loads(line))
+                    except ValueError:  # A change that was being written when the system went down
+                        break
+        return config
 
     @classmethod
     def save_config(cls, config: Dict) -> None:
         """Save the exit node configuration to file."""
-        with cls.EXIT_FILE.open('w') as f:
+        temporary = cls.EXIT_FILE.with_suffix('.tmp')
+        with temporary.open('w') as f:
             json.dump(config, f)
-        cls.EXIT_FILE.chmod(mode=0o644)
+        temporary.chmod(mode=0o644)
+        os.replace(temporary, cls.EXIT_FILE)
+        cls.JOURNAL.unlink(missing_ok=True)
+
+    @classmethod
+    def replay(cls, config: Dict, change: Dict) -> None:
+        """Apply a journaled change to the configuration."""
+        if change.get('removed'):
+            config[cls.NODES].pop(change['peer'], None)
+            config[cls.MARKS].pop(change['peer'], None)
+            return
+        config[cls.NODES][change['peer']] = change['priority']
+        if change['priority'] is not None:
+            config[cls.MARKS][change['peer']] = change['mark']
+
+    @classmethod
+    def journal(cls, config: Dict, change: Dict) -> None:
+        """Append a single change instead of rewriting the configuration, which is only compacted once the journal grows."""
+        with cls.JOURNAL.open('a') as f:
+            f.write(json.dumps(change) + '\n')
+        if cls.JOURNAL.stat().st_size > cls.JOURNAL_LIMIT:
+            cls.save_config(config)
+
+    @classmethod
+    def allocator(cls, config: Dict) -> PriorityAllocator:
+        """Get an allocator for the priorities not taken by the configuration."""
+        return PriorityAllocator(priority for priority in config[cls.NODES].values() if priority is not None)
+
+    @staticmethod
+    def label(members: Dict[str, int]) -> str:
+        """Name the exit node in messages."""
+        if len(members) == 1:
+            return f"Interface '{next(iter(members))}'"
+        return 'Multipath group ' + ', '.join(f"'{member}' (weight {weight})" for member, weight in members.items())
 
     @classmethod
     def status(cls) -> None:
+        """Print the exit node, along with how the traffic has been shared since it was set up if it has several members."""
         config = cls.load_config()
-        if config is not None:
+        if config is None:
+            return
+        if config.get(cls.FAILOVER) is not None:
+            return cls.failover_status(config)
+        if len(config[cls.MEMBERS]) == 1:
             Messages.send_info_message(local_message=config[cls.EXIT_NODE])
+            return
+        transfer = cls.get_transfer()
+        sent = {member: tx - config[cls.BASELINE].get(member, 0) if tx >= config[cls.BASELINE].get(member, 0) else tx for member, tx in transfer.items() if member in config[cls.MEMBERS]}
+        total, weights = sum(sent.values()), sum(config[cls.MEMBERS].values())
+        for member, weight in config[cls.MEMBERS].items():
+            share = f', {sent[member] / total:.1%} of the traffic sent ({sent[member] / 2 ** 20:.1f} MiB)' if total and member in sent else ''
+            Messages.send_info_message(local_message=f'{member}: weight {weight} ({weight / weights:.1%}){share}')
+
+    @classmethod
+    def load_measurements(cls) -> Dict[str, Dict]:
+        """Load the latest health measurements of the failover candidates taken by the daemon."""
+        try:
+            with cls.MEASUREMENTS.open('r') as f:
+                return json.load(f)[cls.CANDIDATES]
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    @classmethod
+    def failover_status(cls, config: Dict) -> None:
+        """Print every failover candidate, which one is active and how healthy the daemon found each of them."""
+        measurements = cls.load_measurements()
+        for candidate in config[cls.FAILOVER][cls.CANDIDATES]:
+            state = 'active' if candidate == config[cls.EXIT_NODE] else 'standby'
+            if (measured := measurements.get(candidate)) is None or measured['rtt'] is None:
+                health = 'not measured yet'
+            else:
+                health = f"{measured['rtt']:.1f} ms, {measured['loss']:.0%} loss{'' if measured['healthy'] else ', failing'}"
+            Messages.send_info_message(local_message=f'{candidate}: {state} ({health})')
 
     @staticmethod
     def get_fwmark(interface: str) -> Optional[int]:
         """Get the firewall mark for the given interface."""
         command = ['wg', 'show', interface, 'fwmark']
-        mark = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8').stdout.strip()
+        mark = COMMANDS.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8').stdout.strip()
         return int(mark, 16) if mark != 'off' else None
 
+    @staticmethod
+    def get_fwmarks() -> Dict[str, Optional[int]]:
+        """Get the firewall marks of every WireGuard interface from a single dump."""
+        command = ['wg', 'show', 'all', 'fwmark']
+        lines = COMMANDS.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8').stdout.splitlines()
+        marks = (line.split('\t') for line in lines if '\t' in line)
+        return {interface: int(mark, 16) if mark != 'off' else None for interface, mark in marks}
+
+    @staticmethod
+    def get_transfer() -> Dict[str, int]:
+        """Get the bytes sent by every WireGuard interface from a single dump."""
+        command = ['wg', 'show', 'all', 'transfer']
+        lines = COMMANDS.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8').stdout.splitlines()
+        sent = collections.Counter()
+        for interface, _, _, tx in (line.split('\t') for line in lines if line.count('\t') == 3):
+            sent[interface] += int(tx)
+        return dict(sent)
+
     @staticmethod
     def set_fwmark(interface: str, mark: Optional[int]) -> None:
         """Set the firewall mark for the given interface."""
         mark = mark if mark is not None else 0
         command = ['wg', 'set', interface, 'fwmark', str(mark)]
-        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        COMMANDS.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    @classmethod
+    def set_hash_policy(cls) -> None:
+        """Make multipath routes balance every flow on its own."""
+        COMMANDS.run(['sysctl', '-w', cls.HASH_POLICY], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
     @staticmethod
     def get_allowed_ips(interface: str) -> Set[IPv4Network | IPv6Network]:
         """Get the allowed IPs for the given interface."""
         node = Systemd.create_from_autoremove(f'autoremove-{interface}.service')
         command = ['wg', 'show', interface, 'allowed-ips']
-        peers = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8').stdout.splitlines()
+        peers = COMMANDS.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8').stdout.splitlines()
         peers = [x.split() for x in peers]
         return {ip_network(network) for peer in peers if peer[0] == node.remote_pubkey for network in peer[1:]}
 
@@ -97,138 +291,341 @@ class ExitNode:
             all_networks.add(cls.GLOBAL_NETWORK)
         all_networks = ','.join(str(x) for x in all_networks)
         command = ['wg', 'set', interface, 'peer', node.remote_pubkey, 'allowed-ips', all_networks]
-        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        COMMANDS.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         return True
 
     @classmethod
-    def add_iptables_rules(cls, interface: str, fwmark: int) -> None:
-        """Add iptables CONNMARK rules for the exit node."""
-        save_connmark = [x.format(mark=fwmark, interface=interface) for x in cls.SAVE_CONNMARK]
-        restore_connmark = [x.format(interface=interface) for x in cls.RESTORE_CONNMARK]
-        subprocess.run(restore_connmark, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        subprocess.run(save_connmark, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    def current_rules(cls) -> Set[Tuple[int, str]]:
+        """Get the IP rules owned by the exit node: those in its priority range tagged with the wirescale protocol, or looking up its table."""
+        command = ['ip', '-4', 'rule', 'show']
+        lines = COMMANDS.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8').stdout.splitlines()
+        rules = ((priority, spec.strip()) for priority, spec in (line.split(':', 1) for line in lines if ':' in line) if priority.isdigit() and int(priority) in cls.PRIORITIES)
+        legacy = f'lookup {WIRESCALE_TABLE}'  # Untagged, installed before the tag existed, but nobody else uses the table
+        return {(int(priority), spec) for priority, spec in rules if spec.endswith(cls.TAG) or spec.endswith(legacy)}
 
     @classmethod
-    def remove_iptables_rules(cls, interface: str, fwmark: int) -> None:
-        """Remove iptables CONNMARK rules for the exit node."""
-        save_connmark = [x.format(mark=fwmark, interface=interface) for x in cls.SAVE_CONNMARK]
-        restore_connmark = [x.format(interface=interface) for x in cls.RESTORE_CONNMARK]
-        save_connmark[3], restore_connmark[3] = '-D', '-D'
-        subprocess.run(save_connmark, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        subprocess.run(restore_connmark, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    def current_routes(cls) -> Dict[IPv4Network, Tuple[Tuple[str, int], ...]]:
+        """Get the destinations in the custom routing table and the interfaces, with their weights, each one is sent through."""
+        command = ['ip', '-4', '-o', 'route', 'show', 'table', str(WIRESCALE_TABLE)]
+        lines = COMMANDS.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8').stdout.splitlines()
+        routes = {}
+        for network, _, spec in (line.partition(' ') for line in lines):
+            network = cls.GLOBAL_NETWORK if network == 'default' else ip_network(network)
+            if nexthops := re.findall(r'nexthop dev (\S+) weight (\d+)', spec):
+                routes[network] = tuple(sorted((interface, int(weight)) for interface, weight in nexthops))
+            elif device := re.search(r'\bdev (\S+)', spec):
+                routes[network] = ((device.group(1), 1),)
+        return routes
 
-    @classmethod
-    def add_custom_routing_table(cls, interface: str) -> None:
-        """Add a custom routing table for the exit node."""
-        add_route = ['ip', '-4', 'route', 'add', str(cls.GLOBAL_NETWORK), 'dev', interface, 'table', str(WIRESCALE_TABLE)]
-        subprocess.run(add_route, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    @staticmethod
+    def nexthops(members: Dict[str, int]) -> Tuple[Tuple[str, int], ...]:
+        """Get the next hops of a route through the given members, the way 'current_routes' reports them."""
+        return tuple(sorted(members.items())) if len(members) > 1 else ((next(iter(members)), 1),)
 
-    @classmethod
-    def flush_custom_routing_table(cls) -> None:
-        """Flush the custom routing table."""
-        del_route = ['ip', 'route', 'flush', 'table', str(WIRESCALE_TABLE)]
-        subprocess.run(del_route, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    @staticmethod
+    def route_spec(nexthops: Tuple[Tuple[str, int], ...]) -> str:
+        """Get the 'ip route' arguments that send a destination through the given next hops."""
+        if len(nexthops) == 1:
+            return f'dev {nexthops[0][0]}'
+        return ' '.join(f'nexthop dev {interface} weight {weight}' for interface, weight in nexthops)
 
     @classmethod
-    def add_ip_rules(cls, fwmark: int) -> None:
-        """Add IP rules for the exit node."""
-        cls.RULES[cls.EXIT_NODE][8] = str(fwmark)
-        for rule in cls.RULES:
-            subprocess.run(cls.RULES[rule], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    def load_prefixes(cls, files: List[Path]) -> List[IPv4Network]:
+        """Load the destinations listed in the given files and collapse them into the smallest set of prefixes covering them."""
+        networks = []
+        for file in files:
+            with file.open('r') as f:
+                for line in f:
+                    if not (line := line.split('#', 1)[0].strip()):
+                        continue
+                    try:
+                        networks.append(IPv4Network(line, strict=False))
+                    except ValueError:
+                        ErrorMessages.send_error_message(local_message=ErrorMessages.EXIT_NODE_BAD_PREFIX.format(prefix=line, file=file))
+        return list(collapse_addresses(networks))
 
     @staticmethod
-    def remove_ip_rule(priority: int) -> None:
-        """Delete an IP rule with the given priority."""
-        del_rule = ['ip', '-4', 'rule', 'del', 'priority', str(priority)]
-        subprocess.run(del_rule, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    def current_connmark(interface: str) -> List[str]:
+        """Get the iptables CONNMARK rules currently installed for the given interface."""
+        command = ['iptables-save', '-t', 'mangle']
+        lines = COMMANDS.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8').stdout.splitlines()
+        return [line.removeprefix('-A ') for line in lines if line.startswith('-A ') and 'CONNMARK' in line and re.search(rf'wirescale-{re.escape(interface)}"?( |$)', line)]
 
     @classmethod
-    def remove_all_ip_rules(cls, config: Dict) -> None:
-        """Remove IP rules for the exit node."""
-        rules = [5500, 5501, 6000]
+    def wanted_rules(cls, config: Optional[Dict], fwmark: Optional[int], current: Set[Tuple[int, str]]) -> Set[Tuple[int, str]]:
+        """Compile the IP rules the given configuration needs, leaving out the catch-all rule while the mark of the exit node is unknown."""
+        if config is None:
+            return set()
+        rules = {(cls.PRIORITY[rule], cls.RULES[rule].format(fwmark=mark)) for rule, mark in ((cls.SUPPRESS, None), (cls.NODES, GLOB_MARK), (cls.EXIT_NODE, fwmark)) if rule != cls.EXIT_NODE or mark is not None}
         for peer, priority in config[cls.NODES].items():
-            cls.set_fwmark(peer, None) if priority is None else rules.append(priority)
-        collections.deque((cls.remove_ip_rule(rule) for rule in rules), maxlen=0)
+            if priority is None:
+                continue
+            if (mark := config[cls.MARKS].get(peer)) is not None:
+                rules.add((priority, cls.RULES[cls.NODES].format(fwmark=mark)))
+            elif (rule := next((rule for rule in current if rule[0] == priority), None)) is not None:
+                rules.add(rule)
+        return rules
 
     @classmethod
-    def add_missing_interfaces(cls) -> None:
-        """Add configurations for new interfaces."""
-        config = cls.load_config()
-        if config is None:
-            return
-        active_peers = set(peer.stem for peer in cls.DIRECTORY.glob('*.conf') if peer.stem != config[cls.EXIT_NODE])
-        stored_nodes = set(config[cls.NODES].keys())
-        add = active_peers - stored_nodes
-        if not add:
+    def compile_rules(cls, transaction: 'RuleTransaction', config: Optional[Dict], fwmark: Optional[int]) -> None:
+        """Compile the changes that take the IP rules from their current state to the one the given configuration needs."""
+        current = cls.current_rules()
+        wanted = cls.wanted_rules(config, fwmark, current)
+        for priority, spec in sorted(wanted - current):  # The exceptions must be in place before the catch-all rule shows up
+            transaction.add_ip(f'rule add pref {priority} {spec}', undo=f'rule del pref {priority} {spec}')
+        for priority, spec in sorted(current - wanted, reverse=True):
+            transaction.add_ip(f'rule del pref {priority} {spec}', undo=f'rule add pref {priority} {spec}')
+
+    @classmethod
+    def compile_routes(cls, transaction: 'RuleTransaction', members: Optional[Dict[str, int]], networks: Optional[Iterable[IPv4Network]] = None) -> str:
+        """Compile the changes that make the custom routing table send the given prefixes, or everything, through the given members, or nowhere."""
+        route = 'route replace {network} table ' + str(WIRESCALE_TABLE) + ' {nexthops}'
+        delete = 'route del {network} table ' + str(WIRESCALE_TABLE)
+        current = cls.current_routes()
+        nexthops = cls.nexthops(members) if members else None
+        wanted = set() if not members else {cls.GLOBAL_NETWORK} if networks is None else set(networks)
+        added = [network for network in wanted if current.get(network) != nexthops]
+        removed = [network for network in current if network not in wanted]
+        for network in added:
+            undo = route.format(network=network, nexthops=cls.route_spec(current[network])) if network in current else delete.format(network=network)
+            transaction.add_ip(route.format(network=network, nexthops=cls.route_spec(nexthops)), undo=undo)
+        for network in removed:
+            transaction.add_ip(delete.format(network=network), undo=route.format(network=network, nexthops=cls.route_spec(current[network])))
+        return f'{len(wanted)} routes, +{len(added)} -{len(removed)}'
+
+    @classmethod
+    def compile_connmark(cls, transaction: 'RuleTransaction', interface: str, fwmark: Optional[int] = None, remove: bool = False) -> None:
+        """Compile the addition or removal of the iptables CONNMARK rules for a member of the exit node."""
+        if remove:
+            collections.deque((transaction.add_mangle(f'-D {rule}', undo=f'-I {rule}') for rule in cls.current_connmark(interface)), maxlen=0)
             return
-        rules = set(config[cls.NODES].values())
-        rules.discard(None)
-        min_priority = 5502
-        max_priority = (max(rules) if rules else min_priority) + len(add) + 1
-        gen = (x for x in range(min_priority, max_priority))
-        gen = (i for i in gen if i not in rules)
-        for peer in add:
-            mark = cls.get_fwmark(peer)
-            if mark is None:
+        for rule in (cls.RESTORE_CONNMARK.format(interface=interface), cls.SAVE_CONNMARK.format(mark=fwmark, interface=interface)):
+            transaction.add_mangle(f'-I {rule}', undo=f'-D {rule}')
+
+    @classmethod
+    def exempt(cls, config: Dict, fwmarks: Dict[str, Optional[int]]) -> Set[str]:
+        """Get the members whose traffic the exit node rule already keeps out of the custom table, and those not marked yet."""
+        fwmark = fwmarks.get(config[cls.EXIT_NODE])
+        return {member for member in config[cls.MEMBERS] if fwmarks.get(member) in (None, fwmark)}
+
+    @classmethod
+    def assign_nodes(cls, config: Dict, fwmarks: Dict[str, Optional[int]]) -> None:
+        """Give every active peer but the exit node a priority or the global mark, and forget those that no longer exist."""
+        active_peers = set(peer.stem for peer in cls.DIRECTORY.glob('*.conf')) - cls.exempt(config, fwmarks)
+        for peer in set(config[cls.NODES].keys()) - active_peers:
+            config[cls.NODES].pop(peer)
+            config[cls.MARKS].pop(peer, None)
+        allocator = cls.allocator(config)
+        for peer in active_peers - set(config[cls.NODES].keys()):
+            if (mark := fwmarks.get(peer)) is None:
                 cls.set_fwmark(peer, GLOB_MARK)
                 config[cls.NODES][peer] = None
+            elif (priority := allocator.allocate()) is None:
+                ErrorMessages.send_error_message(local_message=ErrorMessages.EXIT_NODE_NO_PRIORITY.format(interface=peer))
             else:
-                i = next(gen)
-                config[cls.NODES][peer] = i
-                add_rule = cls.RULES[cls.NODES].copy()
-                add_rule[5] = str(i)
-                add_rule[7] = str(mark)
-                subprocess.run(add_rule, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        cls.save_config(config)
+                config[cls.NODES][peer], config[cls.MARKS][peer] = priority, mark
 
     @classmethod
-    def clean_missing_interfaces(cls) -> None:
-        """Remove configurations for interfaces that no longer exist."""
-        config = cls.load_config()
-        if config is None:
-            return
-        active_peers = set(peer.stem for peer in cls.DIRECTORY.glob('*.conf'))
-        stored_nodes = set(config[cls.NODES].keys())
-        remove = stored_nodes - active_peers
-        if not remove:
+    def sync_interface(cls, config: Dict, interface: str) -> None:
+        """Add or remove a single peer, touching only its own rule and journaling only its own change."""
+        exists = cls.INTERFACES.joinpath(interface).exists()
+        if interface in config[cls.MEMBERS]:
+            return cls.leave(config, interface) if not exists else None
+        transaction = RuleTransaction()
+        if exists and interface not in config[cls.NODES]:
+            if (mark := cls.get_fwmark(interface)) is None:
+                cls.set_fwmark(interface, GLOB_MARK)
+                priority = None
+            elif (priority := cls.allocator(config).allocate()) is None:
+                ErrorMessages.send_error_message(local_message=ErrorMessages.EXIT_NODE_NO_PRIORITY.format(interface=interface))
+            else:
+                rule = f'pref {priority} {cls.RULES[cls.NODES].format(fwmark=mark)}'
+                transaction.add_ip(f'rule add {rule}', undo=f'rule del {rule}')
+            change = {'peer': interface, 'priority': priority, 'mark': mark}
+        elif not exists and interface in config[cls.NODES]:
+            if (priority := config[cls.NODES][interface]) is not None:
+                if (mark := config[cls.MARKS].get(interface)) is None:  # Written before marks were kept, so only a full sync knows its rule
+                    return cls.sync()
+                rule = f'pref {priority} {cls.RULES[cls.NODES].format(fwmark=mark)}'
+                transaction.add_ip(f'rule del {rule}', undo=f'rule add {rule}')
+            change = {'peer': interface, 'removed': True}
+        else:
             return
-        rules = {(priority, config[cls.NODES].pop(node, None))[0] for node in remove if (priority := config[cls.NODES][node]) is not None}
-        collections.deque((cls.remove_ip_rule(rule) for rule in rules), maxlen=0)
+        if not transaction.apply():
+            ErrorMessages.send_error_message(local_message=ErrorMessages.EXIT_NODE_ROLLBACK.format(interface=config[cls.EXIT_NODE]))
+        cls.replay(config, change)
+        cls.journal(config, change)
+
+    @classmethod
+    def leave(cls, config: Dict, interface: str) -> None:
+        """Take a member that went down out of the exit node, sending its share of the traffic through the remaining ones."""
+        members = {member: weight for member, weight in config[cls.MEMBERS].items() if member != interface}
+        config[cls.ADD_ALLOWEDIPS] = [member for member in config[cls.ADD_ALLOWEDIPS] if member != interface]  # Its peer is already gone
+        if not members:
+            cls.save_config(config)
+            if (candidate := cls.next_candidate(config, interface)) is not None:
+                Messages.send_info_message(local_message=f"Interface '{interface}' went down, so the exit node fails over to '{candidate}'")
+                return cls.fail_over(candidate)
+            return cls.remove_exit_node()
+        fwmarks = cls.get_fwmarks()
+        config[cls.EXIT_NODE], config[cls.MEMBERS] = next(iter(members)), members
+        config[cls.BASELINE].pop(interface, None)
+        config[cls.NODES].pop(interface, None)
+        config[cls.MARKS].pop(interface, None)
+        cls.assign_nodes(config, fwmarks)
+        transaction = RuleTransaction()
+        cls.compile_connmark(transaction, interface, remove=True)
+        networks = cls.load_prefixes([Path(file) for file in config[cls.PREFIXES]]) if config.get(cls.PREFIXES) is not None else None  # The kernel drops a multipath route when one of its devices goes away
+        routes = cls.compile_routes(transaction, members, networks)
+        cls.compile_rules(transaction, config, fwmarks.get(config[cls.EXIT_NODE]))
+        if not transaction.apply():
+            ErrorMessages.send_error_message(local_message=ErrorMessages.EXIT_NODE_ROLLBACK.format(interface=config[cls.EXIT_NODE]))
         cls.save_config(config)
+        Messages.send_info_message(local_message=f"Interface '{interface}' has left the exit node {cls.BAD} ({cls.label(members)} remains, {routes}, installed in {transaction.elapsed * 1000:.1f} ms)")
+
+    @classmethod
+    def release_nodes(cls, config: Dict, keep: Set[str] = frozenset()) -> None:
+        """Remove the global mark from the peers that were given one."""
+        collections.deque((cls.set_fwmark(peer, None) for peer, priority in config[cls.NODES].items() if priority is None and peer not in keep), maxlen=0)
+
+    @classmethod
+    def release_exit_node(cls, config: Dict, fwmarks: Dict[str, Optional[int]]) -> None:
+        """Undo the WireGuard changes made to the interfaces that were members of the exit node."""
+        for member in config[cls.MEMBERS]:
+            if fwmarks.get(member) == EXIT_NODE_MARK:
+                cls.set_fwmark(member, None)
+            if member in config[cls.ADD_ALLOWEDIPS]:
+                cls.modify_allowed_ips(interface=member, remove=True)
 
     @classmethod
-    def sync(cls) -> None:
+    def sync(cls, interface: Optional[str] = None) -> None:
         """Sync state between peers and config file"""
         config = cls.load_config()
         if config is None:
             sys.exit(0)
-        cls.clean_missing_interfaces()
-        cls.add_missing_interfaces()
+        if interface is not None:
+            return cls.sync_interface(config, interface)
+        fwmarks = cls.get_fwmarks()
+        if (gone := next((member for member in config[cls.MEMBERS] if member not in fwmarks), None)) is not None:  # Without its mark, the catch-all rule would catch the tunnel itself
+            return cls.leave(config, gone)
+        cls.assign_nodes(config, fwmarks)
+        transaction = RuleTransaction()
+        cls.compile_rules(transaction, config, fwmarks.get(config[cls.EXIT_NODE]))
+        if not transaction.apply():
+            ErrorMessages.send_error_message(local_message=ErrorMessages.EXIT_NODE_ROLLBACK.format(interface=config[cls.EXIT_NODE]))
+        cls.save_config(config)
 
     @classmethod
-    def set_exit_node(cls, interface: str) -> None:
-        """Set up the given interface as the exit node."""
-        config = cls.load_config()
-        if config is not None:
-            if interface == config[cls.EXIT_NODE]:
-                Messages.send_info_message(local_message=f"Warning: Interface '{interface}' is already the exit node")
+    def set_exit_node(cls, members: str | Dict[str, int], prefixes: Optional[List[Path]] = None, failover: Optional[Dict] = None) -> None:
+        """Set up the given interfaces as the exit node, sharing the flows among them by weight, for every destination or only for the prefixes listed in the given files."""
+        members = {members: 1} if isinstance(members, str) else members
+        interface = next(iter(members))
+        previous = cls.load_config()
+        networks = cls.load_prefixes(prefixes) if prefixes is not None else None
+        if previous is not None and interface == previous[cls.EXIT_NODE] and members.keys() == previous[cls.MEMBERS].keys():
+            if prefixes is None and previous.get(cls.PREFIXES) is None and members == previous[cls.MEMBERS] and failover == previous.get(cls.FAILOVER):
+                Messages.send_info_message(local_message=f"Warning: {cls.label(members)} is already the exit node")
                 sys.exit(0)
-            else:
-                cls.remove_exit_node()
-
-        modified = cls.modify_allowed_ips(interface)
-        fwmark = cls.get_fwmark(interface) or cls.set_fwmark(interface, EXIT_NODE_MARK) or EXIT_NODE_MARK
+            return cls.update_routes(previous, members, prefixes, networks, failover)
+        fwmarks = cls.get_fwmarks()
+        previous_members = previous[cls.MEMBERS] if previous is not None else {}
+        previous_nodes, previous_marks = (previous[cls.NODES], previous[cls.MARKS]) if previous is not None else ({}, {})
+        remarked: List[Tuple[str, Optional[int]]] = []  # The marks to put back if the transaction fails
+        for member in members:
+            if member in previous_nodes and previous_nodes[member] is None:
+                remarked.append((member, GLOB_MARK))
+                fwmarks[member] = cls.set_fwmark(member, None)
+        for member in previous_members:
+            if member not in members and fwmarks.get(member) == EXIT_NODE_MARK:
+                remarked.append((member, EXIT_NODE_MARK))
+                fwmarks[member] = cls.set_fwmark(member, None)  # It becomes one more peer, and gets the global mark below
+
+        added = [member for member in members if member not in previous_members and cls.modify_allowed_ips(member)]
+        for member in members:
+            if fwmarks.get(member) is None:
+                remarked.append((member, None))
+                cls.set_fwmark(member, EXIT_NODE_MARK)
+                fwmarks[member] = EXIT_NODE_MARK
+        fwmark = fwmarks[interface]
+
+        involved = set(previous_members) | set(members)  # Whether they need a rule of their own is decided again below
+        transfer = cls.get_transfer()
+        config = {cls.EXIT_NODE: interface, cls.MEMBERS: members, cls.NODES: {peer: priority for peer, priority in previous_nodes.items() if peer not in involved},
+                  cls.ADD_ALLOWEDIPS: added + [member for member in members if member in previous_members and member in previous[cls.ADD_ALLOWEDIPS]],
+                  cls.MARKS: {peer: mark for peer, mark in previous_marks.items() if peer not in involved},
+                  cls.BASELINE: {member: previous[cls.BASELINE][member] if member in previous_members and member in previous[cls.BASELINE] else transfer.get(member, 0) for member in members}}
+        cls.assign_nodes(config, fwmarks)
+
+        transaction = RuleTransaction()
+        for member in previous_members:
+            cls.compile_connmark(transaction, member, remove=True)
+        for member in members:
+            cls.compile_connmark(transaction, member, fwmarks[member])
+        if len(members) > 1:
+            cls.set_hash_policy()
+        routes = cls.compile_routes(transaction, members, networks)
+        cls.compile_rules(transaction, config, fwmark)
+        if not transaction.apply():
+            cls.release_nodes(config, keep=set(previous_nodes))
+            collections.deque((cls.set_fwmark(member, mark) for member, mark in reversed(remarked)), maxlen=0)
+            collections.deque((cls.modify_allowed_ips(member, remove=True) for member in added), maxlen=0)
+            ErrorMessages.send_error_message(local_message=ErrorMessages.EXIT_NODE_ROLLBACK.format(interface=interface))
+
+        config[cls.PREFIXES] = [str(file) for file in prefixes] if prefixes is not None else None
+        config[cls.FAILOVER] = failover
+        cls.save_config(config)
+        for member in previous_members:
+            if member in members:
+                continue
+            if member in previous[cls.ADD_ALLOWEDIPS]:
+                cls.modify_allowed_ips(interface=member, remove=True)
+            Messages.send_info_message(local_message=f"Interface '{member}' has been deactivated as an exit node {cls.BAD}")
+        Messages.send_info_message(local_message=f"{cls.label(members)} has been enabled as an exit node {cls.GOOD} ({routes}, installed in {transaction.elapsed * 1000:.1f} ms)")
 
-        config = {cls.EXIT_NODE: interface, cls.ADD_ALLOWEDIPS: modified, cls.NODES: {}}
+    @classmethod
+    def update_routes(cls, config: Dict, members: Dict[str, int], prefixes: Optional[List[Path]], networks: Optional[List[IPv4Network]], failover: Optional[Dict] = None) -> None:
+        """Change the weights of the current members, or which destinations they are used for, installing only the difference."""
+        transaction = RuleTransaction()
+        if len(members) > 1:
+            cls.set_hash_policy()
+        routes = cls.compile_routes(transaction, members, networks)
+        if not transaction.apply():
+            ErrorMessages.send_error_message(local_message=ErrorMessages.EXIT_NODE_ROLLBACK.format(interface=config[cls.EXIT_NODE]))
+        config[cls.MEMBERS] = members
+        config[cls.PREFIXES] = [str(file) for file in prefixes] if prefixes is not None else None
+        config[cls.FAILOVER] = failover
         cls.save_config(config)
+        mode = 'the listed prefixes' if prefixes is not None else 'all traffic'
+        Messages.send_info_message(local_message=f"{cls.label(members)} is now the exit node for {mode} {cls.GOOD} ({routes}, installed in {transaction.elapsed * 1000:.1f} ms)")
 
-        cls.add_missing_interfaces()
+    @classmethod
+    def set_failover(cls, candidates: List[str], mode: str, prefixes: Optional[List[Path]] = None) -> None:
+        """Set up the first candidate that is up as the exit node, and let the daemon move it to another one when it fails or falls behind."""
+        interface = next((candidate for candidate in candidates if cls.INTERFACES.joinpath(candidate).exists()), candidates[0])
+        cls.set_exit_node(interface, prefixes=prefixes, failover={cls.CANDIDATES: candidates, cls.MODE: mode})
+        Messages.send_info_message(local_message=f"Failover candidates, {'ranked by latency' if mode == cls.LATENCY else 'in order of preference'}: {', '.join(candidates)}")
 
-        cls.add_iptables_rules(interface, fwmark)
-        cls.add_custom_routing_table(interface)
-        cls.add_ip_rules(fwmark)
+    @classmethod
+    def next_candidate(cls, config: Dict, exclude: str) -> Optional[str]:
+        """Get the failover candidate to use instead of the given one, the healthiest according to the daemon or else the next one in order."""
+        if config.get(cls.FAILOVER) is None:
+            return None
+        measurements = cls.load_measurements()
+        candidates = [candidate for candidate in config[cls.FAILOVER][cls.CANDIDATES] if candidate != exclude and cls.INTERFACES.joinpath(candidate).exists()]
+        if config[cls.FAILOVER][cls.MODE] == cls.LATENCY:
+            ranking = lambda candidate: (not measurements.get(candidate, {}).get('healthy', False), measurements.get(candidate, {}).get('rtt') or 0)
+        else:  # Ties keep the order of preference
+            ranking = lambda candidate: not measurements.get(candidate, {}).get('healthy', False)
+        return min(candidates, key=ranking, default=None)
 
-        Messages.send_info_message(local_message=f"Interface '{interface}' has been enabled as an exit node {cls.GOOD}")
+    @classmethod
+    def fail_over(cls, interface: str) -> None:
+        """Move the exit node to another of its failover candidates, keeping the prefixes and the candidates it had."""
+        config = cls.load_config()
+        if config is None or config.get(cls.FAILOVER) is None:
+            return
+        prefixes = [Path(file) for file in config[cls.PREFIXES]] if config.get(cls.PREFIXES) is not None else None
+        cls.set_exit_node(interface, prefixes=prefixes, failover=config[cls.FAILOVER])
 
     @classmethod
     def remove_exit_node(cls) -> None:
@@ -237,21 +634,22 @@ class ExitNode:
         if config is None:
             Messages.send_info_message(local_message='Warning: There is currently no active exit node')
             sys.exit(0)
-        interface = config[cls.EXIT_NODE]
-        fwmark = cls.get_fwmark(interface)
-
-        if fwmark == EXIT_NODE_MARK:
-            cls.set_fwmark(interface, None)
-
-        if config[cls.ADD_ALLOWEDIPS]:
-            cls.modify_allowed_ips(interface=interface, remove=True)
-
-        cls.remove_iptables_rules(interface, fwmark)
-        cls.flush_custom_routing_table()
-        cls.remove_all_ip_rules(config)
-
+        fwmarks = cls.get_fwmarks()
+
+        transaction = RuleTransaction()
+        cls.compile_rules(transaction, None, None)
+        routes = cls.compile_routes(transaction, None)
+        for member in config[cls.MEMBERS]:
+            cls.compile_connmark(transaction, member, remove=True)
+        if not transaction.apply():
+            ErrorMessages.send_error_message(local_message=ErrorMessages.EXIT_NODE_ROLLBACK.format(interface=config[cls.EXIT_NODE]))
+
+        cls.release_exit_node(config, fwmarks)
+        cls.release_nodes(config)
         cls.EXIT_FILE.unlink()
-        Messages.send_info_message(local_message=f"Interface '{interface}' has been deactivated as an exit node {cls.BAD}")
+        cls.JOURNAL.unlink(missing_ok=True)
+        cls.MEASUREMENTS.unlink(missing_ok=True)
+        Messages.send_info_message(local_message=f"{cls.label(config[cls.MEMBERS])} has been deactivated as an exit node {cls.BAD} ({routes}, removed in {transaction.elapsed * 1000:.1f} ms)")
 
     @classmethod
     @contextmanager
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+
+import json
+import re
+import subprocess
+from contextlib import suppress
+from ipaddress import IPv4Address
+from time import monotonic, time
+from typing import Dict, Optional, Tuple
+
+from parallel_utils.thread import create_thread
+
+from wirescale.communications.commands import COMMANDS
+from wirescale.communications.common import SHUTDOWN
+from wirescale.communications.messages import Messages
+from wirescale.communications.systemd import Systemd
+from wirescale.vpn.exit_node import ExitNode
+
+
+class FailoverCandidate:
+
+    def __init__(self, interface: str):
+        self.interface = interface
+        self.peer: IPv4Address = None
+        self.rtt: float = None
+        self.loss = 0.0
+        self.lost_rounds = 0
+        self.better_since: float = None
+
+    @property
+    def healthy(self) -> bool:
+        return self.rtt is not None and self.lost_rounds < ExitNodeFailover.FAIL_ROUNDS and self.loss < ExitNodeFailover.LOSS_LIMIT
+
+    @property
+    def score(self) -> float:
+        return self.rtt + ExitNodeFailover.LOSS_PENALTY * self.loss
+
+    def update(self, rtt: Optional[float], loss: float):
+        alpha = ExitNodeFailover.ALPHA
+        self.loss = alpha * loss + (1 - alpha) * self.loss
+        if rtt is None:
+            self.lost_rounds += 1
+            return
+        self.lost_rounds = 0
+        self.rtt = rtt if self.rtt is None else alpha * rtt + (1 - alpha) * self.rtt
+
+    def measure(self):
+        if not ExitNode.INTERFACES.joinpath(self.interface).exists():
+            self.peer = None
+            return self.update(None, 1)
+        if self.peer is None:
+            with suppress(SystemExit):
+                self.peer = Systemd.create_from_autoremove(f'autoremove-{self.interface}.service').wg_ip
+        if self.peer is None:
+            return self.update(None, 1)
+        command = ['ping', '-n', '-q', '-c', str(ExitNodeFailover.PROBES), '-i', '0.2', '-W', '1', '-I', self.interface, str(self.peer)]
+        output = COMMANDS.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8').stdout
+        sent_received = re.search(r'(\d+) packets transmitted, (\d+) received', output)
+        sent, received = (int(sent_received.group(1)), int(sent_received.group(2))) if sent_received else (ExitNodeFailover.PROBES, 0)
+        rtt = re.search(r'= [\d.]+/([\d.]+)/', output)
+        self.update(float(rtt.group(1)) if rtt and received else None, 1 - received / max(sent, 1))
+
+
+class ExitNodeFailover:
+    ALPHA = 0.3
+    DWELL = 60
+    FAIL_ROUNDS = 2
+    HOLD = 30
+    INTERVAL = 2
+    LOSS_LIMIT = 0.3
+    LOSS_PENALTY = 1000  # Milliseconds added to the score of a candidate that loses every probe
+    PROBES = 5
+    THRESHOLD = 20
+    THRESHOLD_RATIO = 0.25
+
+    def __init__(self):
+        self.candidates: Dict[str, FailoverCandidate] = {}
+        self.active: str = None
+        self.switched = 0
+        self.stalled = False
+
+    def start(self):
+        create_thread(self.run)
+
+    def run(self):
+        while not SHUTDOWN.wait(timeout=self.INTERVAL):
+            config = ExitNode.load_config()
+            if config is None or config.get(ExitNode.FAILOVER) is None:
+                self.candidates, self.active = {}, None
+                continue
+            failover = config[ExitNode.FAILOVER]
+            if list(self.candidates) != failover[ExitNode.CANDIDATES]:
+                self.candidates = {interface: self.candidates.get(interface) or FailoverCandidate(interface) for interface in failover[ExitNode.CANDIDATES]}
+            if config[ExitNode.EXIT_NODE] != self.active:  # Set from the command line, or by the hook of an interface that went down
+                self.active, self.switched = config[ExitNode.EXIT_NODE], monotonic()
+            probes = [create_thread(candidate.measure) for candidate in self.candidates.values()]
+            for probe in probes:
+                probe.result()
+            self.save()
+            if (decision := self.decide(failover[ExitNode.MODE])) is not None:
+                self.switch(*decision)
+
+    def decide(self, mode: str) -> Optional[Tuple[FailoverCandidate, str]]:
+        active = self.candidates.get(self.active)
+        healthy = [candidate for candidate in self.candidates.values() if candidate.healthy]
+        if mode == ExitNode.LATENCY:
+            healthy.sort(key=lambda candidate: candidate.score)
+        if active is None or not active.healthy:
+            if not healthy:
+                if not self.stalled:
+                    print(Messages.FAILOVER_STALLED.format(interface=self.active), flush=True)
+                self.stalled = True
+                return None
+            self.stalled = False
+            return healthy[0], Messages.FAILOVER_FAILED.format(interface=self.active)
+        self.stalled = False
+        now = monotonic()
+        best = healthy[0]
+        for candidate in self.candidates.values():
+            if candidate is not best:
+                candidate.better_since = None
+        if best is active:
+            return None
+        if mode == ExitNode.LATENCY and active.score - best.score < max(self.THRESHOLD, active.score * self.THRESHOLD_RATIO):
+            best.better_since = None
+            return None
+        best.better_since = best.better_since or now
+        if now - best.better_since < self.HOLD or now - self.switched < self.DWELL:  # Hysteresis, so a node that comes and goes does not take the traffic back and forth
+            return None
+        if mode == ExitNode.LATENCY:
+            return best, Messages.FAILOVER_FASTER.format(interface=best.interface, milliseconds=active.score - best.score, seconds=self.HOLD)
+        return best, Messages.FAILOVER_PREFERRED.format(interface=best.interface, seconds=self.HOLD)
+
+    def switch(self, candidate: FailoverCandidate, reason: str):
+        print(Messages.FAILOVER_SWITCH.format(previous=self.active, interface=candidate.interface, reason=reason), flush=True)
+        with suppress(SystemExit), ExitNode.locker():
+            ExitNode.fail_over(candidate.interface)
+        self.active, self.switched = candidate.interface, monotonic()
+        candidate.better_since = None
+
+    def save(self):
+        measurements = {candidate.interface: {'rtt': candidate.rtt, 'loss': candidate.loss, 'healthy': candidate.healthy} for candidate in self.candidates.values()}
+        temporary = ExitNode.MEASUREMENTS.with_suffix('.tmp')
+        with temporary.open('w') as f:
+            json.dump({'time': time(), ExitNode.CANDIDATES: measurements}, f)
+        temporary.chmod(mode=0o644)
+        temporary.replace(ExitNode.MEASUREMENTS)
+
+
+EXIT_FAILOVER = ExitNodeFailover()
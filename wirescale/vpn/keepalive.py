@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+
+import subprocess
+from time import monotonic
+
+from wirescale.communications.commands import COMMANDS
+from wirescale.communications.messages import Messages
+
+
+class KeepaliveTuner:
+    DEFAULT = 10
+    LADDER = (10, 15, 20, 25, 30, 45, 60, 90, 120)
+    MARGIN = 0.8
+    MINIMUM = 5
+    REPROBE = 60 * 60
+    SETTLE = 3
+
+    def __init__(self, interface: str, remote_pubkey: str, ceiling: int = LADDER[-1]):
+        self.interface = interface
+        self.remote_pubkey = remote_pubkey
+        self.ceiling = ceiling
+        self.interval = self.DEFAULT
+        self.good = self.DEFAULT
+        self.bad: int = None
+        self.last_bad = 0
+        self.reprobe = self.REPROBE
+        self.testing_since = monotonic()
+
+    def apply(self, interval: int, reason: str):
+        COMMANDS.run(['wg', 'set', self.interface, 'peer', self.remote_pubkey, 'persistent-keepalive', str(interval)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.interval, self.testing_since = interval, monotonic()
+        print(Messages.KEEPALIVE_SET.format(interface=self.interface, interval=interval, reason=reason), flush=True)
+
+    def healthy(self):
+        # The binding survived the current interval long enough to trust it, so try the next step unless a longer one already failed recently
+        if monotonic() - self.testing_since < self.interval * self.SETTLE:
+            return
+        self.good = max(self.good, self.interval)
+        if (self.bad is None or monotonic() - self.last_bad > self.reprobe) and (candidate := next((step for step in self.LADDER if self.interval < step <= self.ceiling), None)) is not None:
+            self.apply(candidate, Messages.KEEPALIVE_PROBING.format(seconds=self.good))
+
+    def failed(self):
+        failed = self.interval
+        if failed <= self.good:
+            self.good = max((step for step in self.LADDER if step < failed), default=self.MINIMUM)
+        self.reprobe = self.reprobe * 2 if failed == self.bad else self.REPROBE  # Do not break the tunnel every hour over the same step
+        self.bad, self.last_bad = failed, monotonic()
+        self.apply(max(self.MINIMUM, int(self.good * self.MARGIN)), Messages.KEEPALIVE_FAILED.format(seconds=failed, good=self.good, margin=self.MARGIN))
+
+    def network_changed(self):
+        self.good, self.bad, self.reprobe = self.DEFAULT, None, self.REPROBE
+        if self.interval != self.DEFAULT:
+            self.apply(self.DEFAULT, Messages.KEEPALIVE_NETWORK_CHANGED)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+
+import os
+import socket
+import struct
+import subprocess
+import sys
+from contextlib import suppress
+from threading import Lock
+from time import monotonic, time
+from typing import Dict, Set, Tuple
+
+from parallel_utils.thread import create_thread
+
+from wirescale.communications.commands import COMMANDS
+from wirescale.communications.common import SHUTDOWN
+from wirescale.communications.messages import ActionCodes, ErrorMessages, MessageFields, Messages
+from wirescale.communications.systemd import Systemd
+from wirescale.vpn.keepalive import KeepaliveTuner
+from wirescale.vpn.tsmanager import TSManager
+from wirescale.vpn.tunnels import TUNNELS
+
+
+class MonitoredTunnel:
+    ICMP_FILTER = 1
+    SOL_RAW = 255
+
+    def __init__(self, config: Systemd):
+        self.config = config
+        self.interface = self.config.interface
+        self.registered = monotonic()
+        self.last_received = 0
+        self.last_progress = monotonic()
+        self.last_probe = 0
+        self.last_warm = 0
+        self.unanswered = 0
+        self.recovering = False
+        self.sequence = 0
+        self.probe_socket: socket.socket = None
+
+    @property
+    def keep_warm(self) -> bool:
+        return self.config.nat and monotonic() - self.registered < TunnelMonitor.NAT_WARM_TIME
+
+    def received(self, received: int) -> bool:
+        if received > self.last_received:
+            self.last_received, self.last_progress, self.unanswered = received, monotonic(), 0
+            return True
+        return False
+
+    def reset(self):
+        self.last_progress, self.unanswered = monotonic(), 0
+        self.recovering = False
+
+    @staticmethod
+    def echo_request(identifier: int, sequence: int) -> bytes:
+        header = struct.pack('!BBHHH', 8, 0, 0, identifier, sequence)
+        checksum = sum(struct.unpack('!4H', header))
+        checksum = (checksum >> 16) + (checksum & 0xffff)
+        checksum = ~(checksum + (checksum >> 16)) & 0xffff
+        return struct.pack('!BBHHH', 8, 0, checksum, identifier, sequence)
+
+    def probe(self):
+        # The reply is what makes the received bytes grow, just like the periodic ping did
+        with suppress(OSError):
+            if self.probe_socket is None:
+                self.probe_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW | socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC, socket.IPPROTO_ICMP)
+                self.probe_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, self.interface.encode())
+                self.probe_socket.setsockopt(self.SOL_RAW, self.ICMP_FILTER, struct.pack('I', 0xffffffff))  # We never read replies
+            self.last_probe = monotonic()
+            self.unanswered = self.unanswered or self.last_probe
+            self.sequence = (self.sequence + 1) & 0xffff
+            self.probe_socket.sendto(self.echo_request(os.getpid() & 0xffff, self.sequence), (str(self.config.wg_ip), 0))
+
+    def close(self):
+        if self.probe_socket is not None:
+            self.probe_socket.close()
+            self.probe_socket = None
+
+
+class TunnelMonitor:
+    MAX_DETECTION = 60
+    NAT_WARM_TIME = 62 * 60
+    RECHECK_WAIT = 3
+    RECOVER_WAIT = 30
+    RECREATE_WAIT = 60
+    RX_WINDOW = 20
+    TICK = 5
+
+    def __init__(self):
+        self.tunnels: Dict[str, MonitoredTunnel] = {}
+        self.keepalives: Dict[str, KeepaliveTuner] = {}
+        self.peers: Dict[str, Dict[str, Tuple[int, int, int]]] = {}
+        self.recovers: Dict[str, int] = {}
+        self.lock = Lock()
+        self.thread = None
+
+    def register(self, config: Systemd):
+        tunnel = MonitoredTunnel(config)
+        with self.lock:
+            if (previous := self.tunnels.get(tunnel.interface)) is not None:
+                previous.close()
+            self.tunnels[tunnel.interface] = tunnel
+            if (tuner := self.keepalives.get(tunnel.interface)) is None or tuner.remote_pubkey != config.remote_pubkey:  # A recovered tunnel keeps what was measured
+                self.keepalives[tunnel.interface] = KeepaliveTuner(tunnel.interface, config.remote_pubkey, ceiling=self.MAX_DETECTION - self.RX_WINDOW - self.TICK)
+        self.start()
+
+    def unregister(self, interface: str):
+        with self.lock:
+            tunnel = self.tunnels.pop(interface, None)
+            self.keepalives.pop(interface, None)
+        if tunnel is not None:
+            tunnel.close()
+
+    def is_registered(self, tunnel: MonitoredTunnel) -> bool:
+        with self.lock:
+            return self.tunnels.get(tunnel.interface) is tunnel
+
+    def load(self):
+        interfaces = self.dump()
+        for interface, config in TUNNELS.all().items():
+            if interface not in interfaces:
+                TUNNELS.remove(interface)
+            elif not Systemd.is_active(f'autoremove-{interface}.service'):  # Otherwise a unit from --autoremove-units is still watching it
+                self.register(config)
+                print(Messages.MONITOR_WATCHING.format(interface=interface), flush=True)
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = create_thread(self.run)
+                create_thread(self.keep_warm)
+
+    @staticmethod
+    def dump() -> Dict[str, Dict[str, Tuple[int, int, int]]]:
+        dump = COMMANDS.run(['wg', 'show', 'all', 'dump'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+        res: Dict[str, Dict[str, Tuple[int, int, int]]] = {}
+        for line in dump.splitlines():
+            fields = line.split('\t')
+            if len(fields) == 5:
+                res.setdefault(fields[0], {})
+            elif len(fields) == 9:
+                res.setdefault(fields[0], {})[fields[1]] = (int(fields[5]), int(fields[6]), int(fields[7]))
+        return res
+
+    def run(self):
+        while not SHUTDOWN.wait(timeout=self.TICK):
+            dump = self.dump()
+            with self.lock:
+                self.peers = dump  # Read by the metrics endpoint, so a scrape never runs wg itself
+                tunnels = tuple((tunnel, self.keepalives[tunnel.interface]) for tunnel in self.tunnels.values())
+            for tunnel, tuner in tunnels:
+                if tunnel.recovering:
+                    continue
+                if (peers := dump.get(tunnel.interface)) is None:
+                    print(Messages.MONITOR_REMOVED.format(interface=tunnel.interface), flush=True)
+                    self.unregister(tunnel.interface)
+                    TUNNELS.remove(tunnel.interface)
+                    continue
+                latest_handshake, received, _ = peers.get(tunnel.config.remote_pubkey, (0, 0, 0))
+                if tunnel.received(received):
+                    tuner.healthy()
+                elif tunnel.unanswered and monotonic() - tunnel.unanswered >= self.RX_WINDOW and time() - latest_handshake >= self.RX_WINDOW:
+                    tuner.failed()
+                    self.start_recovery(tunnel, Messages.MONITOR_BROKEN.format(interface=tunnel.interface, seconds=monotonic() - tunnel.last_progress))
+                    continue
+                # The probe doubles as the keepalive under test, but once one goes unanswered they follow the tick, so the window is always RX_WINDOW
+                if monotonic() - tunnel.last_probe >= (self.TICK if tunnel.unanswered else tuner.interval):
+                    tunnel.probe()
+
+    def recheck(self, interfaces: Set[str] = None):
+        with self.lock:
+            tunnels = tuple(tunnel for tunnel in self.tunnels.values() if not tunnel.recovering and (interfaces is None or tunnel.interface in interfaces))
+            tuners = tuple(self.keepalives[tunnel.interface] for tunnel in tunnels)
+        if not tunnels:
+            return
+        for tuner in tuners:
+            tuner.network_changed()
+        before = self.dump()
+        for tunnel in tunnels:
+            tunnel.probe()
+        if SHUTDOWN.wait(timeout=self.RECHECK_WAIT):
+            return
+        after = self.dump()
+        for tunnel in tunnels:
+            if (peers := after.get(tunnel.interface)) is None or not self.is_registered(tunnel):
+                continue
+            received = peers.get(tunnel.config.remote_pubkey, (0, 0, 0))[1]
+            if received > before.get(tunnel.interface, {}).get(tunnel.config.remote_pubkey, (0, 0, 0))[1]:
+                tunnel.received(received)
+            else:
+                self.start_recovery(tunnel, Messages.MONITOR_RECHECK_BROKEN.format(interface=tunnel.interface, seconds=self.RECHECK_WAIT))
+
+    def start_recovery(self, tunnel: MonitoredTunnel, reason: str):
+        with self.lock:
+            if tunnel.recovering:
+                return
+            tunnel.recovering = True
+        print(reason, flush=True)
+        create_thread(self.recover, tunnel)
+
+    def keep_warm(self):
+        while not SHUTDOWN.wait(timeout=self.TICK):
+            with self.lock:
+                tunnels = tuple((tunnel, self.keepalives[tunnel.interface]) for tunnel in self.tunnels.values() if tunnel.keep_warm)
+            for tunnel, tuner in tunnels:
+                if monotonic() - tunnel.last_warm >= tuner.interval:  # Follow the measured binding lifetime, not the tick
+                    tunnel.last_warm = monotonic()
+                    TSManager.disco_ping(tunnel.config.ts_ip)
+
+    def recover(self, tunnel: MonitoredTunnel):
+        from wirescale.communications.unix_server import UnixServer
+        config, tries = tunnel.config, tunnel.config.recover_tries
+        while tries != 0 and self.is_registered(tunnel) and (peers := self.dump().get(tunnel.interface)) is not None:
+            print(Messages.MONITOR_RECOVERING.format(interface=tunnel.interface), flush=True)
+            with self.lock:
+                self.recovers[tunnel.interface] = self.recovers.get(tunnel.interface, 0) + 1
+            message = {
+                MessageFields.CODE: ActionCodes.RECOVER,
+                MessageFields.ERROR_CODE: None,
+                MessageFields.INTERFACE: tunnel.interface,
+                MessageFields.LATEST_HANDSHAKE: peers.get(config.remote_pubkey, (0, 0, 0))[0],
+                MessageFields.PEER_IP: str(config.ts_ip),
+            }
+            match UnixServer.run_local(message):
+                case 0:  # The recovered tunnel has been registered again
+                    return
+                case 1 | 3:
+                    print(ErrorMessages.MONITOR_RECOVER_FAILED.format(interface=tunnel.interface), file=sys.stderr, flush=True)
+                    break
+                case 4:
+                    print(ErrorMessages.MONITOR_UNREACHABLE.format(interface=tunnel.interface, seconds=self.RECOVER_WAIT), file=sys.stderr, flush=True)
+                case 5:
+                    print(Messages.MONITOR_HANDSHAKE_UPDATED.format(interface=tunnel.interface), flush=True)
+                    return tunnel.reset()
+            if SHUTDOWN.wait(timeout=self.RECOVER_WAIT):
+                return
+            if tries > 0:
+                tries -= 1
+        if SHUTDOWN.is_set() or not self.is_registered(tunnel):
+            return
+        self.remove(tunnel)
+        if config.recreate_tries != 0:
+            self.recreate(config)
+
+    def remove(self, tunnel: MonitoredTunnel):
+        self.unregister(tunnel.interface)
+        TUNNELS.remove(tunnel.interface)
+        with self.lock:
+            self.recovers.pop(tunnel.interface, None)
+        if tunnel.interface not in self.dump():
+            return
+        print(Messages.MONITOR_REMOVING.format(interface=tunnel.interface), flush=True)
+        COMMANDS.run(['wg-quick', 'down', f'/run/wirescale/{tunnel.interface}.conf'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def recreate(self, config: Systemd):
+        from wirescale.communications.unix_server import UnixServer
+        print(Messages.MONITOR_RECREATING.format(interface=config.interface), flush=True)
+        message = {
+            MessageFields.CODE: ActionCodes.UPGRADE,
+            MessageFields.ERROR_CODE: None,
+            MessageFields.ALLOW_SUFFIX: False,
+            MessageFields.EXPECTED_INTERFACE: config.remote_interface,
+            MessageFields.INTERFACE: config.interface.removesuffix(str(config.suffix)) if config.suffix else config.interface,
+            MessageFields.IPTABLES_ACCEPT: config.iptables_accept,
+            MessageFields.IPTABLES_FORWARD: config.iptables_forward,
+            MessageFields.IPTABLES_MASQUERADE: config.iptables_masquerade,
+            MessageFields.PEER: str(config.ts_ip),
+            MessageFields.RECOVER_TRIES: config.recover_tries,
+            MessageFields.RECREATE_TRIES: config.recreate_tries,
+            MessageFields.SUFFIX_NUMBER: config.suffix or None,
+        }
+        tries = config.recreate_tries
+        while tries != 0:
+            if UnixServer.run_local(message) in (0, 2, 3):
+                return
+            if tries > 0:
+                tries -= 1
+            if SHUTDOWN.wait(timeout=self.RECREATE_WAIT):
+                return
+
+
+TUNNEL_MONITOR = TunnelMonitor()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+
+import ctypes
+import errno
+import socket
+import struct
+import subprocess
+import sys
+from contextlib import suppress
+from ipaddress import IPv4Address
+from pathlib import Path
+from threading import Event, Lock
+from time import monotonic
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from parallel_utils.thread import create_thread
+
+from wirescale.communications.commands import COMMANDS
+from wirescale.communications.common import SHUTDOWN
+from wirescale.communications.messages import ErrorMessages, Messages
+from wirescale.vpn.monitor import TUNNEL_MONITOR
+
+
+class NetworkWatcher:
+    RTMGRP_LINK = 0x1
+    RTMGRP_IPV4_IFADDR = 0x10
+    RTMGRP_IPV4_ROUTE = 0x40
+    RTM_NEWLINK, RTM_DELLINK, RTM_NEWADDR, RTM_DELADDR, RTM_NEWROUTE, RTM_DELROUTE = 16, 17, 20, 21, 24, 25
+    IFLA_IFNAME = 3
+    RTA_OIF = 4
+    RT_TABLE_MAIN = 254
+    SO_ATTACH_FILTER = 26
+    SO_RCVBUFFORCE = 33
+    RECEIVE_BUFFER = 4 * 1024 * 1024
+    DEBOUNCE = 2
+    MIN_INTERVAL = 10
+    REOPEN_WAIT = 5
+    IGNORED_INTERFACES = ('lo', 'tailscale')
+    RESYNC = 'unknown, the kernel dropped events'
+    ROUTES = Path('/proc/net/route')
+
+    def __init__(self):
+        self.changes: Set[str] = set()
+        self.changed = Event()
+        self.last_change = 0
+        self.last_recheck = 0
+        self.lock = Lock()
+        self.uplinks: Set[str] = set()
+
+    def start(self):
+        self.uplinks = self.default_interfaces(self.routes())
+        create_thread(self.listen)
+        create_thread(self.debounce)
+
+    @staticmethod
+    def attributes(data: bytes, offset: int, end: int) -> Dict[int, bytes]:
+        res = {}
+        while offset + 4 <= end:
+            length, kind = struct.unpack_from('=HH', data, offset)
+            if length < 4:
+                break
+            res[kind] = data[offset + 4:offset + length]
+            offset += (length + 3) & ~3
+        return res
+
+    @staticmethod
+    def interface_name(index: int) -> str:
+        try:
+            return socket.if_indextoname(index)
+        except OSError:
+            return f'#{index}'
+
+    def parse(self, data: bytes) -> Iterator[str]:
+        offset = 0
+        while offset + 16 <= len(data):
+            length, kind = struct.unpack_from('=IH', data, offset)
+            if length < 16:
+                return
+            payload, end = offset + 16, offset + length
+            match kind:
+                case self.RTM_NEWLINK | self.RTM_DELLINK:
+                    index = struct.unpack_from('=BxHiII', data, payload)[2]
+                    name = self.attributes(data, payload + 16, end).get(self.IFLA_IFNAME, b'').rstrip(b'\0').decode() or self.interface_name(index)
+                    yield f'link {name}'
+                case self.RTM_NEWADDR | self.RTM_DELADDR:
+                    index = struct.unpack_from('=BBBBI', data, payload)[4]
+                    yield f'address {self.interface_name(index)}'
+                case self.RTM_NEWROUTE | self.RTM_DELROUTE:
+                    dst_len, table = struct.unpack_from('=xBxxB', data, payload)
+                    oif = self.attributes(data, payload + 12, end).get(self.RTA_OIF)
+                    if dst_len == 0 and table == self.RT_TABLE_MAIN:
+                        name = self.interface_name(struct.unpack('=I', oif)[0]) if oif else ''
+                        yield f'default route {name}'.strip()
+            offset += (length + 3) & ~3
+
+    def relevant(self, change: str) -> bool:
+        interface = change.rsplit(' ', 1)[-1]
+        if interface.startswith(self.IGNORED_INTERFACES):
+            return False
+        with TUNNEL_MONITOR.lock:
+            if interface in TUNNEL_MONITOR.tunnels:  # Our own tunnels change whenever they are set up or recovered
+                return False
+        return change.startswith('default route') or interface in self.uplinks  # Containers and bridges come and go without touching the uplinks
+
+    @classmethod
+    def routes(cls) -> List[Tuple[int, int, str]]:
+        # Destination, mask and interface of every route in the main table, which is the one /proc/net/route shows, both numbers as the kernel stores them
+        res = []
+        with suppress(OSError):
+            for fields in (line.split() for line in cls.ROUTES.read_text().splitlines()[1:]):
+                if len(fields) >= 8:
+                    res.append((int(fields[1], 16), int(fields[7], 16), fields[0]))
+        return res
+
+    @staticmethod
+    def default_interfaces(routes: List[Tuple[int, int, str]]) -> Set[str]:
+        return {interface for destination, mask, interface in routes if destination == mask == 0}
+
+    @staticmethod
+    def egress(routes: List[Tuple[int, int, str]], ip: IPv4Address) -> Optional[str]:
+        address = struct.unpack('=I', ip.packed)[0]
+        route = max((route for route in routes if address & route[1] == route[0]), key=lambda route: route[1].bit_count(), default=None)
+        return route[2] if route is not None else None
+
+    def affected(self, changes: Set[str]) -> Optional[Set[str]]:
+        # The tunnels whose endpoints are reached through one of the changed interfaces. None means all of them, as after lost events
+        interfaces = {change.rsplit(' ', 1)[-1] for change in changes if change != self.RESYNC and change != 'default route'}
+        if len(interfaces) < len(changes):
+            return None
+        routes = self.routes()
+        endpoints = COMMANDS.run(['wg', 'show', 'all', 'endpoints'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+        res = set()
+        for tunnel, _, endpoint in (line.split('\t') for line in endpoints.splitlines() if line.count('\t') == 2):
+            try:
+                egress = self.egress(routes, IPv4Address(endpoint.rsplit(':', 1)[0]))
+            except ValueError:  # No endpoint yet, or an IPv6 one that /proc/net/route does not cover
+                egress = None
+            if egress is None or egress in interfaces:
+                res.add(tunnel)
+        return res
+
+    def route_filter(self) -> bytes:
+        # Socket filter that drops every route event but those of default routes in the main table before they are queued, since an exit
+        # node limited to some prefixes installs tens of thousands of routes in its own table, which would overflow the receive buffer
+        kind = 4 if sys.byteorder == 'little' else 5  # Low byte of nlmsg_type, the high one is always zero for rtnetlink
+        program = (
+            (0x30, 0, 0, kind),  # ldb [nlmsg_type]
+            (0x15, 1, 0, self.RTM_NEWROUTE),  # jeq
+            (0x15, 0, 4, self.RTM_DELROUTE),  # jeq, or accept
+            (0x30, 0, 0, 17),  # ldb [rtm_dst_len]
+            (0x15, 0, 3, 0),  # jeq, or drop
+            (0x30, 0, 0, 20),  # ldb [rtm_table]
+            (0x15, 0, 1, self.RT_TABLE_MAIN),  # jeq, or drop
+            (0x06, 0, 0, 0xffffffff),  # accept
+            (0x06, 0, 0, 0),  # drop
+        )
+        return b''.join(struct.pack('=HBBI', *instruction) for instruction in program)
+
+    def open(self) -> socket.socket:
+        netlink = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_CLOEXEC, socket.NETLINK_ROUTE)
+        try:
+            netlink.setsockopt(socket.SOL_SOCKET, self.SO_RCVBUFFORCE, self.RECEIVE_BUFFER)
+        except PermissionError:  # Without CAP_NET_ADMIN the buffer can only grow up to net.core.rmem_max
+            netlink.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECEIVE_BUFFER)
+        code = self.route_filter()
+        program = ctypes.create_string_buffer(code, len(code))
+        netlink.setsockopt(socket.SOL_SOCKET, self.SO_ATTACH_FILTER, struct.pack('HL', len(code) // 8, ctypes.addressof(program)))
+        netlink.bind((0, self.RTMGRP_LINK | self.RTMGRP_IPV4_IFADDR | self.RTMGRP_IPV4_ROUTE))
+        netlink.settimeout(1)
+        return netlink
+
+    def record(self, changes: Set[str]):
+        with self.lock:
+            self.changes |= changes
+            self.last_change = monotonic()
+        self.changed.set()
+
+    def receive(self):
+        with self.open() as netlink:
+            while not SHUTDOWN.is_set():
+                try:
+                    changes = set(self.parse(netlink.recv(65536)))
+                    if any(change.startswith('default route') for change in changes):
+                        self.uplinks = self.default_interfaces(self.routes())
+                    changes = {change for change in changes if self.relevant(change)}
+                except TimeoutError:
+                    continue
+                except OSError as error:
+                    if error.errno != errno.ENOBUFS:
+                        raise
+                    changes = {self.RESYNC}  # The receive buffer overflowed, so any change may have been lost and every tunnel is checked
+                    self.uplinks = self.default_interfaces(self.routes())
+                if changes:
+                    self.record(changes)
+
+    def listen(self):
+        while not SHUTDOWN.is_set():
+            try:
+                self.receive()
+            except OSError as error:
+                print(ErrorMessages.NETLINK_FAILED.format(error=error, seconds=self.REOPEN_WAIT), file=sys.stderr, flush=True)
+                self.record({self.RESYNC})
+                SHUTDOWN.wait(timeout=self.REOPEN_WAIT)
+
+    def debounce(self):
+        while not SHUTDOWN.is_set():
+            if not self.changed.wait(timeout=1):
+                continue
+            # Wait until the network settles, so a burst of events from one failover leads to a single check
+            while (quiet := monotonic() - self.last_change) < self.DEBOUNCE or monotonic() - self.last_recheck < self.MIN_INTERVAL:
+                wait = max(self.DEBOUNCE - quiet, self.MIN_INTERVAL - (monotonic() - self.last_recheck))
+                if SHUTDOWN.wait(timeout=wait):
+                    return
+            with self.lock:
+                changes, self.changes = self.changes, set()
+                self.changed.clear()
+            self.last_recheck = monotonic()
+            print(Messages.NETWORK_CHANGED.format(changes=', '.join(sorted(changes))), flush=True)
+            TUNNEL_MONITOR.recheck(interfaces=self.affected(changes))
+
+
+NETWORK_WATCHER = NetworkWatcher()
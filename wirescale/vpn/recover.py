@@ -21,11 +21,14 @@ from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from parallel_utils.thread import create_thread
 
 from wirescale.communications.checkers import check_configfile, check_updated_handshake
+from wirescale.communications.commands import COMMANDS
 from wirescale.communications.common import BytesStrConverter, CONNECTION_PAIRS, file_locker
 from wirescale.communications.connection_pair import ConnectionPair
 from wirescale.communications.messages import ActionCodes, ErrorCodes, ErrorMessages, Messages
 from wirescale.communications.systemd import Systemd
+from wirescale.communications.timing import TIMINGS
 from wirescale.vpn.tsmanager import TSManager
+from wirescale.vpn.wgconfig import WGConfig
 
 
 class RecoverConfig:
@@ -88,8 +91,8 @@ class RecoverConfig:
         iptables = 'iptables -{action} INPUT -p udp --dport {port} -j ACCEPT -m comment --comment "wirescale-{interface}"'
         add_iptables = iptables.format(action='I', port=self.new_port, interface=self.interface).split()
         remove_iptables = iptables.format(action='D', port=self.current_port, interface=self.interface).split()
-        subprocess.run(remove_iptables, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        subprocess.run(add_iptables, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        COMMANDS.run(remove_iptables, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        COMMANDS.run(add_iptables, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
     def modify_wgconfig(self):
         with open(self.runfile, 'r') as f:
@@ -106,8 +109,8 @@ class RecoverConfig:
             f.write(text)
 
     def load_keys(self):
-        privkey = subprocess.run(['wg', 'show', self.interface, 'private-key'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8').stdout.strip()
-        pubkey_psk = subprocess.run(['wg', 'show', self.interface, 'preshared-keys'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8').stdout.strip()
+        privkey = COMMANDS.run(['wg', 'show', self.interface, 'private-key'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8').stdout.strip()
+        pubkey_psk = COMMANDS.run(['wg', 'show', self.interface, 'preshared-keys'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8').stdout.strip()
         pubkey, psk = pubkey_psk.split('\n')[0].split('\t')
         self.remote_pubkey_str = pubkey.strip()
         privkey = base64.urlsafe_b64decode(privkey)
@@ -137,23 +140,21 @@ class RecoverConfig:
             self.fix_iptables()
         pair = CONNECTION_PAIRS[get_ident()]
         stack = ExitStack()
-        stack.enter_context(file_locker())
-        Messages.send_info_message(local_message='Stopping tailscale...')
-        TSManager.stop()
+        with TIMINGS.span('lock'):
+            stack.enter_context(file_locker())
         Messages.send_info_message(local_message=f"Modifying WireGuard interface '{self.interface}'...")
-        subprocess.run(['wg', 'set', self.interface, 'listen-port', str(self.new_port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        subprocess.run(['wg', 'set', self.interface, 'peer', self.remote_pubkey_str, 'endpoint', f'{self.endpoint[0]}:{self.endpoint[1]}'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        Messages.send_info_message(local_message='Starting tailscale...')
-        TSManager.start()
+        with TIMINGS.span('tailscale_outage'), TSManager.outage(action='recover', interface=self.interface):
+            WGConfig.set_endpoint(self.interface, self.new_port, self.remote_pubkey_str, self.endpoint)
         create_thread(TSManager.wait_tailscale_restarted, pair, stack)
         Messages.send_info_message(local_message=f"Checking latest handshake of interface '{self.interface}' after changing the endpoint...")
-        updated = check_updated_handshake(self.interface, self.latest_handshake)
+        with TIMINGS.span('check_updated_handshake'):
+            updated = check_updated_handshake(self.interface, self.latest_handshake)
         if not updated:
             self.undo_recover()
             error = ErrorMessages.HANDSHAKE_FAILED_RECOVER.format(interface=self.interface)
             ErrorMessages.send_error_message(local_message=error, error_code=ErrorCodes.TS_UNREACHABLE)
         if pair.running_in_remote:
-            Systemd.stop(f'autoremove-{self.interface}.service')
+            Systemd.stop_autoremove(self.interface)
         success_message = Messages.RECOVER_SUCCES.format(interface=self.interface)
         Messages.send_info_message(local_message=success_message, code=ActionCodes.SUCCESS)
         create_thread(Systemd.launch_autoremove, config=self, pair=pair)
@@ -163,5 +164,4 @@ class RecoverConfig:
         self.modify_wgconfig()
         if self.iptables_accept:
             self.fix_iptables()
-        subprocess.run(['wg', 'set', self.interface, 'listen-port', str(self.new_port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        subprocess.run(['wg', 'set', self.interface, 'peer', self.remote_pubkey_str, 'endpoint', f'{self.endpoint[0]}:{self.endpoint[1]}'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        WGConfig.set_endpoint(self.interface, self.new_port, self.remote_pubkey_str, self.endpoint)
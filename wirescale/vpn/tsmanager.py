@@ -5,15 +5,19 @@
 import json
 import os
 import re
+import socket
 import subprocess
 import sys
-from contextlib import ExitStack
+from collections import deque
+from contextlib import contextmanager, ExitStack
 from functools import lru_cache
 from ipaddress import IPv4Address
+from pathlib import Path
 from threading import get_ident
-from time import sleep
-from typing import Dict, Tuple, TYPE_CHECKING
+from time import monotonic, sleep, time
+from typing import Deque, Dict, Tuple, TYPE_CHECKING
 
+from wirescale.communications.commands import COMMANDS
 from wirescale.communications.common import check_with_timeout, CONNECTION_PAIRS
 from wirescale.communications.messages import ErrorCodes, ErrorMessages, Messages
 from wirescale.communications.systemd import Systemd
@@ -23,18 +27,44 @@ if TYPE_CHECKING:
 
 
 class TSManager:
+    CONFIG_DIR = Path('/etc/wirescale')
+    DOWNTIME: float = 0
+    LOCAL_API_SOCKET = Path('/run/tailscale/tailscaled.sock')
+    OUTAGES: Deque[Tuple[float, str, str, float]] = deque(maxlen=100)
+    PEER_DIRECTORY: Dict[str, IPv4Address] = {}
+    PEER_DIRECTORY_TIME: float = None
+    PEER_DIRECTORY_TTL = 30
+    STOPS: int = 0
+
     @classmethod
     def start(cls) -> bool:
         return Systemd.start('tailscaled.service')
 
     @classmethod
     def stop(cls) -> bool:
+        cls.STOPS += 1
         return Systemd.stop('tailscaled.service')
 
+    @classmethod
+    @contextmanager
+    def outage(cls, action: str, interface: str):
+        # Everything that does not need the port Tailscale is listening on must be done before entering here
+        Messages.send_info_message(local_message='Stopping tailscale...')
+        start = monotonic()
+        cls.stop()
+        try:
+            yield
+        finally:
+            cls.start()
+            seconds = monotonic() - start
+            cls.DOWNTIME += seconds
+            cls.OUTAGES.append((time(), action, interface, seconds))
+            Messages.send_info_message(local_message=Messages.TS_OUTAGE.format(milliseconds=seconds * 1000, action=action, interface=interface))
+
     @classmethod
     def status(cls) -> Dict:
         cls.check_service_running()
-        status = subprocess.run(['tailscale', 'status', '--json'], capture_output=True, text=True)
+        status = COMMANDS.run(['tailscale', 'status', '--json'], capture_output=True, text=True)
         return json.loads(status.stdout)
 
     @staticmethod
@@ -92,19 +122,19 @@ class TSManager:
 
     @classmethod
     def my_name(cls) -> str:
-        return cls.status()['Self']['DNSName'].removesuffix(f'.{cls.dns_suffix()}')
+        return cls.node_name(cls.status()['Self'], cls.dns_suffix())
 
     @classmethod
     @lru_cache(maxsize=None)
     def my_ip(cls) -> IPv4Address:
         cls.check_running()
-        ip = subprocess.run(['tailscale', 'ip', '-4'], capture_output=True, text=True).stdout.strip()
+        ip = COMMANDS.run(['tailscale', 'ip', '-4'], capture_output=True, text=True).stdout.strip()
         return IPv4Address(ip)
 
     @classmethod
     def peer(cls, ip: IPv4Address) -> Dict:
         cls.check_running()
-        peer = subprocess.run(['tailscale', 'whois', '--json', str(ip)], capture_output=True, text=True)
+        peer = COMMANDS.run(['tailscale', 'whois', '--json', str(ip)], capture_output=True, text=True)
         if peer.returncode != 0:
             no_peer = ErrorMessages.TS_NO_PEER.format(ip=ip)
             ErrorMessages.send_error_message(local_message=no_peer)
@@ -113,26 +143,73 @@ class TSManager:
 
     @classmethod
     def peer_name(cls, ip: IPv4Address) -> str:
-        return cls.peer(ip)['DNSName'].removesuffix(f'.{cls.dns_suffix()}')
+        return cls.node_name(cls.peer(ip), cls.dns_suffix())
+
+    @staticmethod
+    def node_name(node: Dict, suffix: str) -> str:
+        return node['DNSName'].removesuffix(f'.{suffix}')
+
+    @classmethod
+    def config_file(cls, peer_name: str) -> Path:
+        return cls.CONFIG_DIR.joinpath(f'{peer_name}.conf')
 
     @classmethod
     def peer_ip(cls, name: str) -> IPv4Address:
         cls.check_running()
-        ip = subprocess.run(['tailscale', 'ip', '-4', name], capture_output=True, text=True)
+        ip = COMMANDS.run(['tailscale', 'ip', '-4', name], capture_output=True, text=True)
         if ip.returncode != 0:
             no_ip = ErrorMessages.TS_NO_IP.format(peer_name=name)
             ErrorMessages.send_error_message(local_message=no_ip)
         return IPv4Address(ip.stdout.strip())
 
+    @classmethod
+    def peer_directory(cls, refresh: bool = False) -> Dict[str, IPv4Address]:
+        if refresh or cls.PEER_DIRECTORY_TIME is None or monotonic() - cls.PEER_DIRECTORY_TIME > cls.PEER_DIRECTORY_TTL:
+            status = cls.status()
+            suffix = f'.{cls.dns_suffix()}'
+            directory = {}
+            for peer in (status['Self'], *(status.get('Peer') or {}).values()):
+                ip = next((IPv4Address(ip) for ip in peer.get('TailscaleIPs') or () if '.' in ip), None)
+                if ip is None:
+                    continue
+                dns_name = peer['DNSName'].lower().removesuffix('.')
+                directory.update({str(ip): ip, dns_name: ip, dns_name.removesuffix(suffix): ip})
+                directory.setdefault(peer['HostName'].lower(), ip)
+            cls.PEER_DIRECTORY, cls.PEER_DIRECTORY_TIME = directory, monotonic()
+        return cls.PEER_DIRECTORY
+
+    @classmethod
+    def resolve_peer(cls, peer: str) -> IPv4Address | None:
+        peer = peer.strip().lower().removesuffix('.')
+        if (ip := cls.peer_directory().get(peer)) is None:  # The peer may have joined since the last refresh
+            ip = cls.peer_directory(refresh=True).get(peer)
+        return ip
+
     @classmethod
     def peer_is_online(cls, ip: IPv4Address, timeout: int = 2) -> bool:
         if not cls.check_has_state():
             ErrorMessages.send_error_message(local_message=ErrorMessages.TS_COORD_OFFLINE)
-        check_ping = subprocess.run(['tailscale', 'ping', '-c', '1', '--until-direct=false', '--timeout', f'{timeout}s', str(ip)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        check_ping = COMMANDS.run(['tailscale', 'ping', '-c', '1', '--until-direct=false', '--timeout', f'{timeout}s', str(ip)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         if check_ping.returncode == 0:
-            check_ping = subprocess.run(['ping', '-c', '1', '-W', str(timeout), str(ip)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            check_ping = COMMANDS.run(['ping', '-c', '1', '-W', str(timeout), str(ip)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         return check_ping.returncode == 0
 
+    @classmethod
+    def disco_ping(cls, ip: IPv4Address, timeout: float = 2) -> bool:
+        if not cls.LOCAL_API_SOCKET.is_socket():
+            ping = COMMANDS.run(['tailscale', 'ping', '-c', '1', '--timeout', f'{timeout}s', str(ip)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            return ping.returncode == 0
+        request = f'POST /localapi/v0/ping?ip={ip}&type=disco HTTP/1.0\r\nHost: local-tailscaled.sock\r\nSec-Tailscale: localapi\r\n\r\n'
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as api:
+                api.settimeout(timeout)
+                api.connect(str(cls.LOCAL_API_SOCKET))
+                api.sendall(request.encode())
+                status = api.recv(64).split(b'\r\n', 1)[0]
+        except OSError:
+            return False
+        return b' 200 ' in status
+
     @classmethod
     def wait_until_peer_is_online(cls, ip: IPv4Address, timeout: int = None) -> bool:
         single_ping_timeout = 2
@@ -156,23 +233,37 @@ class TSManager:
 
     @classmethod
     def peer_endpoint(cls, ip: IPv4Address) -> Tuple[IPv4Address, int]:
+        from wirescale.vpn.endpoints import ENDPOINTS
         cls.check_running()
         pair = CONNECTION_PAIRS.get(get_ident())
         peer_name = pair.peer_name if pair is not None else cls.peer_name(ip)
         checking_endpoint = Messages.CHECKING_ENDPOINT.format(peer_name=peer_name, peer_ip=ip)
         Messages.send_info_message(local_message=checking_endpoint, send_to_local=False)
+        if (cached := ENDPOINTS.get(ip)) is not None:
+            endpoint, rtt = f'{cached.endpoint[0]}:{cached.endpoint[1]}', f'{cached.rtt:.0f} ms' if cached.rtt is not None else 'unknown'
+            cached_endpoint = Messages.CACHED_ENDPOINT.format(peer_name=peer_name, peer_ip=ip, endpoint=endpoint, age=cached.age, rtt=rtt)
+            Messages.send_info_message(local_message=cached_endpoint, send_to_local=False)
+            return cached.endpoint
         if not cls.wait_until_peer_is_online(ip, timeout=25):
             peer_is_offline = ErrorMessages.TS_PEER_OFFLINE.format(peer_name=peer_name, peer_ip=ip)
             ErrorMessages.send_error_message(local_message=peer_is_offline, error_code=ErrorCodes.TS_UNREACHABLE, exit_code=4)
-        force_endpoint = subprocess.run(['tailscale', 'ping', '-c', '30', str(ip)], capture_output=True, text=True)
-        if force_endpoint.returncode != 0:
+        probe = cls.probe_endpoint(ip, count=30)
+        if probe is None:
             no_endpoint = ErrorMessages.TS_NO_ENDPOINT.format(peer_name=peer_name, peer_ip=ip)
             ErrorMessages.send_error_message(local_message=no_endpoint, error_code=ErrorCodes.TS_UNREACHABLE, exit_code=4)
-        else:
-            reachable = Messages.REACHABLE.format(peer_name=peer_name, peer_ip=ip)
-            Messages.send_info_message(local_message=reachable, send_to_local=False)
-            endpoint = force_endpoint.stdout.split()[-3]
-        return IPv4Address(endpoint.split(':')[0]), int(endpoint.split(':')[1])
+        reachable = Messages.REACHABLE.format(peer_name=peer_name, peer_ip=ip)
+        Messages.send_info_message(local_message=reachable, send_to_local=False)
+        ENDPOINTS.store(ip, *probe)
+        return probe[0]
+
+    @staticmethod
+    def probe_endpoint(ip: IPv4Address, count: int) -> Tuple[Tuple[IPv4Address, int], float] | None:
+        force_endpoint = COMMANDS.run(['tailscale', 'ping', '-c', str(count), str(ip)], capture_output=True, text=True)
+        pong = re.search(r'via (\d+\.\d+\.\d+\.\d+):(\d+) in ([\d.]+)(µs|ms|s)\s*$', force_endpoint.stdout)
+        if force_endpoint.returncode != 0 or pong is None:
+            return None
+        rtt = float(pong.group(3)) * {'µs': 0.001, 'ms': 1, 's': 1000}[pong.group(4)]
+        return (IPv4Address(pong.group(1)), int(pong.group(2))), rtt
 
     @classmethod
     def local_port(cls) -> int:
@@ -183,7 +274,7 @@ class TSManager:
             print(ErrorMessages.SUDO, file=sys.stderr, flush=True)
             sys.exit(1)
         while True:
-            result = subprocess.run(['ss', '-lunp4'], capture_output=True, text=True)
+            result = COMMANDS.run(['ss', '-lunp4'], capture_output=True, text=True)
             port: int = None
             try:
                 generator = (int(match.group(1)) for match in (re.search(r':(\d+)', line) for line in result.stdout.split('\n') if 'tailscale' in line) if match)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# encoding:utf-8
+
+
+import json
+import os
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Tuple
+
+from wirescale.communications.systemd import Systemd
+
+
+class TunnelStore:
+    INTERFACES = Path('/sys/class/net')
+    PATH = Path('/run/wirescale/tunnels.json')
+
+    def __init__(self):
+        self.tunnels: Dict[str, Systemd] = {}
+        self.version: Tuple[int, int] = None
+        self.lock = Lock()
+
+    def load(self):
+        try:
+            stat = self.PATH.stat()
+        except FileNotFoundError:
+            self.tunnels, self.version = {}, None
+            return
+        if (stat.st_ino, stat.st_mtime_ns) == self.version:
+            return
+        with open(self.PATH, 'r') as f:
+            records = json.load(f)
+        self.tunnels = {interface: Systemd.create_from_record(record) for interface, record in records.items()}
+        self.version = (stat.st_ino, stat.st_mtime_ns)
+
+    def save(self):
+        records = {interface: tunnel.record() for interface, tunnel in self.tunnels.items()}
+        temporary = self.PATH.with_suffix('.tmp')
+        with open(temporary, 'w') as f:
+            json.dump(records, f)
+        os.replace(temporary, self.PATH)
+        stat = self.PATH.stat()
+        self.version = (stat.st_ino, stat.st_mtime_ns)
+
+    def get(self, interface: str) -> Systemd | None:
+        with self.lock:
+            self.load()
+            tunnel = self.tunnels.get(interface)
+        if tunnel is None or not self.INTERFACES.joinpath(interface).exists():  # The entry outlived its interface
+            return None
+        return tunnel
+
+    def all(self) -> Dict[str, Systemd]:
+        with self.lock:
+            self.load()
+            return dict(self.tunnels)
+
+    def put(self, tunnel: Systemd):
+        with self.lock:
+            self.load()
+            self.tunnels[tunnel.interface] = tunnel
+            self.save()
+
+    def remove(self, interface: str):
+        with self.lock:
+            self.load()
+            if self.tunnels.pop(interface, None) is not None:
+                self.save()
+
+
+TUNNELS = TunnelStore()
@@ -2,7 +2,7 @@
 
 
 from threading import Event
-from time import sleep
+from time import monotonic, sleep
 from typing import TYPE_CHECKING
 
 from parallel_utils.thread import create_thread, StaticMonitor
@@ -15,6 +15,8 @@ if TYPE_CHECKING:
 
 
 class ActiveSockets:
+    INTERVAL = 15
+
     def __init__(self):
         self._client: 'ConnectionPair' = None
         self._client_thread: int = None
@@ -24,6 +26,11 @@ class ActiveSockets:
         self.waiter_server_switched, self.waiter_switched = Event(), Event()
         self.waiter_server_switched.set()
         self.waiter_switched.set()
+        self.switched_at: float = None
+        self.detection: float = None
+        self.deadlocks = 0
+        self.detection_seconds = 0
+        self.resolution_seconds = 0
 
     def client_exists(self) -> bool:
         if CONNECTION_PAIRS.get(self._client_thread) != self._client:
@@ -42,20 +49,21 @@ class ActiveSockets:
         self._client_thread = new_client_thread
         self._client = CONNECTION_PAIRS.get(new_client_thread)
 
-    def needs_switch(self, counter: int) -> bool:
+    def needs_switch(self) -> bool:
         if not self.client_exists() or not self.server_exists():
             return False
         if self.server_is_running():
             return False
-        if self.client_is_running():
-            if counter > 1 and self._server.peer_ip == self._client.peer_ip:
-                return True
+        if self.client_is_running():  # Only the side with the higher IP yields, however long the switched session takes on the other one
             return self._server.peer_ip < self._client.my_ip
         return False
 
     def capture_semaphore(self):
         self.waiter_server_switched.wait()
         StaticMonitor.lock_code(uid=Semaphores.EXCLUSIVE)
+        resolution = monotonic() - self.switched_at
+        self.resolution_seconds += resolution
+        print(Messages.DEADLOCK_RESOLVED.format(detection=self.detection, resolution=resolution), flush=True)
         self.waiter_switched.set()
 
     def server_exists(self) -> bool:
@@ -77,23 +85,22 @@ class ActiveSockets:
 
     def watch(self):
         server, client = None, None
-        counter = 0
         while True:
             if SHUTDOWN.is_set() and not (self.server_exists() and self.client_exists()):
                 return
             if self._server != server or self._client != client or None in (self._server, self._client):
                 server, client = self._server, self._client
-                counter = 0
-            else:
-                if self.waiter_switched.is_set():
-                    counter += 1
-                    if self.needs_switch(counter):
-                        print(Messages.DEADLOCK, flush=True)
-                        self.waiter_server_switched.clear()
-                        self.waiter_switched.clear()
-                        StaticMonitor.unlock_code(uid=Semaphores.EXCLUSIVE)
-                        create_thread(self.capture_semaphore)
-            sleep(15)
+            elif self.waiter_switched.is_set() and self.needs_switch():
+                print(Messages.DEADLOCK, flush=True)
+                self.switched_at = monotonic()
+                self.deadlocks += 1
+                self.detection = self.switched_at - max(server.started, client.started)
+                self.detection_seconds += self.detection
+                self.waiter_server_switched.clear()
+                self.waiter_switched.clear()
+                StaticMonitor.unlock_code(uid=Semaphores.EXCLUSIVE)
+                create_thread(self.capture_semaphore)
+            sleep(self.INTERVAL)
 
 
 ACTIVE_SOCKETS = ActiveSockets()
@@ -19,11 +19,14 @@ from typing import Dict, FrozenSet, Tuple
 from cryptography.utils import cached_property
 from parallel_utils.thread import create_thread
 
+from wirescale.communications.commands import COMMANDS
 from wirescale.communications.common import BytesStrConverter, CONNECTION_PAIRS, file_locker, subprocess_run_tmpfile
 from wirescale.communications.messages import ActionCodes, ErrorMessages, Messages
 from wirescale.communications.systemd import Systemd
+from wirescale.communications.timing import TIMINGS
 from wirescale.vpn.exit_node import ExitNode
 from wirescale.vpn.iptables import IPTABLES
+from wirescale.vpn.keepalive import KeepaliveTuner
 from wirescale.vpn.tsmanager import TSManager
 
 
@@ -64,6 +67,7 @@ class WGConfig:
         self.psk = self.get_field('Peer', 'PresharedKey')
         self.has_psk: bool = self.psk is not None
         self.psk = self.psk or self.generate_wg_psk()
+        self.postup_hooks: Tuple[str, ...] = ()
         self.start_time: int = datetime.now().second
         self.suffix: int = None
 
@@ -143,7 +147,7 @@ class WGConfig:
         postdown_forward = IPTABLES.or_true(IPTABLES.remove_rule(postup_forward))
         self.add_script('postup', postup_forward)
         self.add_script('postdown', postdown_forward, first_place=True)
-        subprocess.run(['sysctl', '-w', 'net.ipv4.ip_forward=1'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        COMMANDS.run(['sysctl', '-w', 'net.ipv4.ip_forward=1'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
     def add_iptables_masquerade(self):
         postup_mark = IPTABLES.FORWARD_MARK.format(mark=self.mark, interface=self.interface)
@@ -167,7 +171,7 @@ class WGConfig:
         self.add_script('predown', wipe_allowed_ips)
 
     def sync_exit_node(self):
-        sync = r"/bin/sh -c 'wirescale exit-node --sync'"
+        sync = r"/bin/sh -c 'wirescale exit-node --sync %i'"
         self.add_script('postup', sync, first_place=True)
         self.add_script('postdown', sync)
 
@@ -182,11 +186,11 @@ class WGConfig:
 
     @staticmethod
     def generate_wg_privkey() -> str:
-        return subprocess.run(['wg', 'genkey'], capture_output=True, text=True).stdout.strip()
+        return COMMANDS.run(['wg', 'genkey'], capture_output=True, text=True).stdout.strip()
 
     @staticmethod
     def generate_wg_pubkey(privkey: str) -> str:
-        return subprocess.run(['wg', 'pubkey'], input=privkey, capture_output=True, text=True).stdout.strip()
+        return COMMANDS.run(['wg', 'pubkey'], input=privkey, capture_output=True, text=True).stdout.strip()
 
     @classmethod
     def generate_wg_keypair(cls) -> Tuple[str, str]:
@@ -196,7 +200,7 @@ class WGConfig:
 
     @staticmethod
     def generate_wg_psk() -> str:
-        return subprocess.run(['wg', 'genpsk'], capture_output=True, text=True).stdout.strip()
+        return COMMANDS.run(['wg', 'genpsk'], capture_output=True, text=True).stdout.strip()
 
     def generate_new_config(self):
         new_config = ConfigParser(interpolation=None)
@@ -225,7 +229,7 @@ class WGConfig:
         new_config.set(peer, 'PublicKey', self.remote_pubkey)
         new_config.set(peer, 'PresharedKey', self.psk)
         new_config.set(peer, 'Endpoint', f'{self.endpoint[0]}:{self.endpoint[1]}')
-        new_config.set(peer, 'PersistentKeepalive', '10')
+        new_config.set(peer, 'PersistentKeepalive', str(KeepaliveTuner.DEFAULT))
         if self.table != 'off' and ExitNode.GLOBAL_NETWORK in self.allowed_ips:
             self.exit_node = True
             if len(self.allowed_ips) == 1:
@@ -237,6 +241,31 @@ class WGConfig:
         new_config.set(peer, allowedips, ', '.join(str(x) for x in self.allowed_ips))
         new_config = self.write_config(new_config, self.suffix)
         self.new_config_path.write_text(new_config, encoding='utf-8')
+        self.stage_config(new_config)
+
+    def stage_config(self, new_config: str):
+        # The interface is brought up without the port Tailscale is using, so tailscaled only has to be stopped to hand that port over
+        self.postup_hooks = tuple(re.findall(r'^PostUp\s*=\s*(.*)$', new_config, flags=re.IGNORECASE | re.MULTILINE))
+        staging = re.sub(r'^(PostUp|ListenPort|Endpoint)\s*=.*\n', '', new_config, flags=re.IGNORECASE | re.MULTILINE)
+        self.staging_config_path.parent.mkdir(exist_ok=True)
+        self.staging_config_path.write_text(staging, encoding='utf-8')
+
+    @staticmethod
+    def set_endpoint(interface: str, port: int, remote_pubkey: str, endpoint: Tuple[IPv4Address, int]) -> bool:
+        command = ['wg', 'set', interface, 'listen-port', str(port), 'peer', remote_pubkey, 'endpoint', f'{endpoint[0]}:{endpoint[1]}']
+        return COMMANDS.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+    def run_postup_hooks(self) -> subprocess.CompletedProcess[str]:
+        output, hook = [], subprocess.CompletedProcess(args=(), returncode=0, stdout='')
+        for command in self.postup_hooks:
+            command = command.replace('%i', self.interface)
+            output.append(f'[#] {command}')
+            hook = subprocess_run_tmpfile(['bash', '-c', command], stderr=STDOUT)
+            output.append(hook.stdout.strip()) if hook.stdout.strip() else None
+            if hook.returncode != 0:
+                break
+        hook.stdout = '\n'.join(output)
+        return hook
 
     def get_wirescale_field(self, field, func=None):
         ws = 'Wirescale'
@@ -259,6 +288,10 @@ class WGConfig:
     def new_config_path(self):
         return Path('/run/wirescale/').joinpath(f'{self.interface}.conf')
 
+    @property
+    def staging_config_path(self):
+        return Path('/run/wirescale/staging/').joinpath(f'{self.interface}.conf')
+
     @classmethod
     def write_config(cls, config: ConfigParser, suffix: int = None):
         string_io = StringIO()
@@ -282,29 +315,44 @@ class WGConfig:
         from wirescale.communications.checkers import check_updated_handshake
         pair = CONNECTION_PAIRS[get_ident()]
         stack = ExitStack()
-        stack.enter_context(file_locker())
-        Messages.send_info_message(local_message='Stopping tailscale...')
-        TSManager.stop()
+        with TIMINGS.span('lock'):
+            stack.enter_context(file_locker())
         Messages.send_info_message(local_message=f"Setting up WireGuard interface '{self.interface}'...")
-        wgquick = subprocess_run_tmpfile(['wg-quick', 'up', str(self.new_config_path)], stderr=STDOUT)
-        Messages.send_info_message(local_message='Starting tailscale...')
-        TSManager.start()
-        create_thread(TSManager.wait_tailscale_restarted, pair, stack)
+        with TIMINGS.span('wg-quick'):
+            wgquick = subprocess_run_tmpfile(['wg-quick', 'up', str(self.staging_config_path)], stderr=STDOUT)
+        self.staging_config_path.unlink(missing_ok=True)
+        if wgquick.returncode == 0:
+            with TIMINGS.span('tailscale_outage'), TSManager.outage(action='set up', interface=self.interface):
+                applied = self.set_endpoint(self.interface, self.listen_port, self.remote_pubkey, self.endpoint)
+            create_thread(TSManager.wait_tailscale_restarted, pair, stack)
+            if not applied:
+                error = ErrorMessages.ENDPOINT_NOT_APPLIED.format(interface=self.interface, port=self.listen_port, endpoint=f'{self.endpoint[0]}:{self.endpoint[1]}')
+                COMMANDS.run(['wg-quick', 'down', str(self.new_config_path)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                ErrorMessages.send_error_message(local_message=error)
+            with TIMINGS.span('postup_hooks'):
+                wgquick = self.run_postup_hooks()
+            if wgquick.returncode != 0:
+                COMMANDS.run(['wg-quick', 'down', str(self.new_config_path)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            stack.close()
         if wgquick.returncode == 0:
             Messages.send_info_message(local_message='Verifying handshake with the other peer...')
-            updated = check_updated_handshake(self.interface)
+            with TIMINGS.span('check_updated_handshake'):
+                updated = check_updated_handshake(self.interface)
             if not updated:
                 error = ErrorMessages.HANDSHAKE_FAILED.format(interface=self.interface)
-                subprocess.run(['wg-quick', 'down', str(self.new_config_path)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                COMMANDS.run(['wg-quick', 'down', str(self.new_config_path)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
                 ErrorMessages.send_error_message(local_message=error)
-            Systemd.launch_autoremove(config=self, pair=pair)
+            with TIMINGS.span('autoremove'):
+                Systemd.launch_autoremove(config=self, pair=pair)
             if self.exit_node:
-                ExitNode.modify_allowed_ips(self.interface)
-                ExitNode.set_exit_node(self.interface)
+                with TIMINGS.span('exit_node'):
+                    ExitNode.modify_allowed_ips(self.interface)
+                    ExitNode.set_exit_node(self.interface)
             success = Messages.SUCCESS.format(interface=self.interface)
             Messages.send_info_message(local_message=success, code=ActionCodes.SUCCESS)
         else:
-            self.new_config_path.unlink()
+            self.new_config_path.unlink(missing_ok=True)
             final_error = '\n'.join(Messages.add_id(pair.id, m) for m in wgquick.stdout.strip().split('\n'))
             final_error = final_error.strip() + '\n' + Messages.add_id(pair.id, ErrorMessages.FINAL_ERROR)
             ErrorMessages.send_error_message(local_message=final_error)
@@ -3,24 +3,14 @@
 
 
 import os
-import shutil
 import subprocess
 import sys
 from pathlib import Path
-
-from parallel_utils.thread import create_thread
+from time import monotonic
 
 from wirescale.__main__ import SCRIPT_PATH
-from wirescale.communications.messages import ErrorMessages
-from wirescale.communications.systemd import Systemd
-from wirescale.communications.tcp_server import TCPServer
-from wirescale.communications.udp_server import UDPServer
-from wirescale.communications.unix_client import UnixClient
-from wirescale.communications.unix_server import UnixServer
 from wirescale.parsers import top_parser
 from wirescale.parsers.args import ARGS, parse_args
-from wirescale.vpn.exit_node import ExitNode
-from wirescale.vpn.watch import ACTIVE_SOCKETS
 
 sys.tracebacklimit = 0
 
@@ -31,6 +21,7 @@ def check_root(message: str = None):
     try:
         os.setuid(0)
     except PermissionError:
+        from wirescale.communications.messages import ErrorMessages
         if message:
             print(message, file=sys.stderr, flush=True)
         else:
@@ -39,60 +30,126 @@ def check_root(message: str = None):
 
 
 def copy_script():
+    import shutil
     script_file = Path('/run/wirescale/wirescale-autoremove')
     script_file.unlink(missing_ok=True)
     shutil.copy(SCRIPT_PATH.joinpath('wirescale-autoremove'), script_file)
     script_file.chmod(0o744)
 
 
+def daemon():
+    check_root(message="Error: Wirescale daemon must be managed by root's systemd")
+    unit = 'wirescaled.service'
+    systemd_exec_pid = int(os.environ.get('SYSTEMD_EXEC_PID', default=-1))
+    if ARGS.START:
+        if systemd_exec_pid == -1 or os.getpgid(systemd_exec_pid) != os.getpgid(os.getpid()):
+            systemd = subprocess.run(['systemctl', 'start', unit], text=True)
+            sys.exit(systemd.returncode)
+        systemd_envvars = ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES')
+        if next((True for e in systemd_envvars if e not in os.environ), False):
+            print('Error: Wirescale needs a UNIX socket supplied by systemd', file=sys.stderr, flush=True)
+            sys.exit(1)
+        from parallel_utils.thread import create_thread
+        from wirescale.communications.messages import Messages
+        from wirescale.communications.systemd import Systemd
+        from wirescale.communications.tcp_server import TCPServer
+        from wirescale.communications.udp_server import UDPServer
+        from wirescale.communications.unix_server import UnixServer
+        from wirescale.vpn.endpoints import ENDPOINTS
+        from wirescale.vpn.failover import EXIT_FAILOVER
+        from wirescale.vpn.monitor import TUNNEL_MONITOR
+        from wirescale.vpn.watch import ACTIVE_SOCKETS
+        copy_script()
+        start = monotonic()
+        UDPServer.occupy_port_41641()
+        port_ready = monotonic()
+        UnixServer.set_server()
+        unix_ready = monotonic()
+        TCPServer.set_server()
+        tcp_ready = monotonic()
+        if ARGS.METRICS_PORT:
+            from wirescale.communications.metrics import METRICS
+            METRICS.serve(ARGS.METRICS_PORT)
+        timing = Messages.STARTUP_TIMING.format(total=tcp_ready - start, port=port_ready - start, unix=unix_ready - port_ready, tcp=tcp_ready - unix_ready)
+        Systemd.notify('READY=1', f'STATUS={timing}')
+        print(timing, flush=True)
+        tcp_thread = create_thread(TCPServer.run_server)
+        unix_thread = create_thread(UnixServer.run_server)
+        watch_thread = create_thread(ACTIVE_SOCKETS.watch)
+        endpoint_refresh = ARGS.ENDPOINT_REFRESH if ARGS.ENDPOINT_REFRESH is not None else ENDPOINTS.REFRESH_INTERVAL
+        if endpoint_refresh > 0:
+            create_thread(ENDPOINTS.refresh_loop, endpoint_refresh)
+        if not ARGS.AUTOREMOVE_UNITS:
+            from wirescale.vpn.netlink import NETWORK_WATCHER
+            TUNNEL_MONITOR.load()
+            NETWORK_WATCHER.start()
+        EXIT_FAILOVER.start()
+        tcp_thread.result(), unix_thread.result(), watch_thread.result()
+    elif ARGS.STOP:
+        if systemd_exec_pid == -1 or os.getpgid(systemd_exec_pid) != os.getpgid(os.getpid()):
+            from wirescale.communications.systemd import Systemd
+            if Systemd.is_active(unit):
+                systemd = subprocess.run(['systemctl', 'stop', 'wirescaled.service'], text=True)
+                sys.exit(systemd.returncode)
+            sys.exit(0)
+        from wirescale.communications.unix_client import UnixClient
+        UnixClient.stop()
+
+
+def exit_node():
+    from wirescale.vpn.exit_node import ExitNode
+    if ARGS.STATUS:
+        ExitNode.status()
+    else:
+        check_root(message="Error: The 'exit-node' option requires sudo privileges.")
+        with ExitNode.locker():
+            if ARGS.STOP:
+                ExitNode.remove_exit_node()
+            elif ARGS.SYNC:
+                ExitNode.sync(interface=None if ARGS.SYNC is True else ARGS.SYNC)
+            elif ARGS.FAILOVER:
+                ExitNode.set_failover(list(ARGS.EXIT_MEMBERS), ARGS.FAILOVER, prefixes=ARGS.PREFIXES)
+            else:
+                ExitNode.set_exit_node(ARGS.EXIT_MEMBERS, prefixes=ARGS.PREFIXES)
+
+
+def bench():
+    if ARGS.SELF_TEST:
+        from wirescale.vpn.bench import DataPlaneBench
+        check_root(message="Error: The 'bench --self-test' option requires sudo privileges.")
+        DataPlaneBench.self_test(seconds=ARGS.DURATION, count=ARGS.COUNT)
+    else:
+        from wirescale.communications.unix_client import UnixClient
+        UnixClient.bench()
+
+
+def recover():
+    from wirescale.communications.systemd import Systemd
+    main_pid = Systemd.main_pid(f'autoremove-{ARGS.INTERFACE}.service')
+    systemd_exec_pid = int(os.environ.get('SYSTEMD_EXEC_PID', default=-1))
+    from wirescale.communications.messages import ErrorMessages
+    from wirescale.communications.unix_client import UnixClient
+    if main_pid == 0 or systemd_exec_pid == -1 or main_pid != os.getpgid(os.getpid()) or os.getpgid(systemd_exec_pid) != os.getpgid(os.getpid()):
+        ErrorMessages.send_error_message(local_message=ErrorMessages.RECOVER_SYSTEMD)
+    UnixClient.recover()
+
+
 def main():
     parse_args()
     if ARGS.DAEMON:
-        check_root(message="Error: Wirescale daemon must be managed by root's systemd")
-        unit = 'wirescaled.service'
-        systemd_exec_pid = int(os.environ.get('SYSTEMD_EXEC_PID', default=-1))
-        if ARGS.START:
-            if systemd_exec_pid == -1 or os.getpgid(systemd_exec_pid) != os.getpgid(os.getpid()):
-                systemd = subprocess.run(['systemctl', 'start', unit], text=True)
-                sys.exit(systemd.returncode)
-            systemd_envvars = ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES')
-            if next((True for e in systemd_envvars if e not in os.environ), False):
-                print('Error: Wirescale needs a UNIX socket supplied by systemd', file=sys.stderr, flush=True)
-                sys.exit(1)
-            copy_script()
-            UDPServer.occupy_port_41641()
-            tcp_thread = create_thread(TCPServer.run_server)
-            unix_thread = create_thread(UnixServer.run_server)
-            watch_thread = create_thread(ACTIVE_SOCKETS.watch)
-            tcp_thread.result(), unix_thread.result(), watch_thread.result()
-        elif ARGS.STOP:
-            if systemd_exec_pid == -1 or os.getpgid(systemd_exec_pid) != os.getpgid(os.getpid()):
-                if Systemd.is_active(unit):
-                    systemd = subprocess.run(['systemctl', 'stop', 'wirescaled.service'], text=True)
-                    sys.exit(systemd.returncode)
-                sys.exit(0)
-            UnixClient.stop()
+        daemon()
     elif ARGS.UPGRADE:
+        from wirescale.communications.unix_client import UnixClient
         UnixClient.upgrade()
     elif ARGS.EXIT_NODE:
-        if ARGS.STATUS:
-            ExitNode.status()
-        else:
-            check_root(message="Error: The 'exit-node' option requires sudo privileges.")
-            with ExitNode.locker():
-                if ARGS.STOP:
-                    ExitNode.remove_exit_node()
-                elif ARGS.SYNC:
-                    ExitNode.sync()
-                else:
-                    ExitNode.set_exit_node(ARGS.INTERFACE)
+        exit_node()
     elif ARGS.RECOVER:
-        main_pid = subprocess.run(['systemctl', 'show', '-p', 'MainPID', f'autoremove-{ARGS.INTERFACE}.service'], capture_output=True, text=True).stdout.strip()
-        main_pid = int(main_pid.replace('MainPID=', ''))
-        systemd_exec_pid = int(os.environ.get('SYSTEMD_EXEC_PID', default=-1))
-        if main_pid == 0 or systemd_exec_pid == -1 or main_pid != os.getpgid(os.getpid()) or os.getpgid(systemd_exec_pid) != os.getpgid(os.getpid()):
-            ErrorMessages.send_error_message(local_message=ErrorMessages.RECOVER_SYSTEMD)
-        UnixClient.recover()
+        recover()
+    elif ARGS.STATS:
+        from wirescale.communications.unix_client import UnixClient
+        UnixClient.stats()
+    elif ARGS.BENCH:
+        bench()
     elif ARGS.DOWN:
         subprocess.run(['wg-quick', 'down', str(ARGS.CONFIGFILE)], text=True)
     else: